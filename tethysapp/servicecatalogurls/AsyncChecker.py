@@ -0,0 +1,381 @@
+"""
+# Initial Creation:
+#   asyncio link checker backend - an alternative to the blocking checks in QueryCatalog.get_site_status().
+# General Description:
+#   get_site_status() makes blocking requests, so every check in flight holds a whole OS thread.  The functions
+#   here talk HTTP directly over asyncio streams so that thousands of URLs can be in flight from a single event loop.
+#   get_site_status_async() has the same interface as get_site_status(): it takes a URL and returns a status of
+#   "up" or "down" along with the status code (or the reason the server could not be reached).
+#
+#   AsyncURLCheckEngine mirrors CheckEngine.URLCheckEngine (submit() returns a concurrent.futures.Future), but runs
+#   the checks on an event loop in a background thread, so QueryCatalog.ProcessURLs() can use either backend and the
+#   synchronous callers (e.g. the Django queryresult controller) do not change.
+#
+#   The proxies set in the environment are honoured the same way as by the threads backend (see
+#   ConnectionPool.get_proxy()): HTTPS URLs go through a CONNECT tunnel, plain HTTP URLs are sent to the proxy.
+"""
+import asyncio
+import concurrent.futures
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from .CheckEngine import HEAD_REJECTED_CODES, PROBE_BYTE_CAP, CONNECT_TIMEOUT, READ_TIMEOUT, STATUS_NOT_CHECKED, \
+    DEADLINE_CODE, MAX_REDIRECTS, REDIRECT_CODES, deadline_passed
+from .ConnectionPool import get_ssl_context, get_proxy, USER_AGENT
+from .HostScheduler import HostScheduler, HostBusy, BUSY_CODES, MAX_BUSY_RETRIES, MAX_RETRY_AFTER, \
+    HOST_UNREACHABLE_CODE, host_of, parse_retry_after
+from .Metrics import RunMetrics
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+# Default number of URL checks allowed in flight at the same time on the event loop.
+DEFAULT_MAX_IN_FLIGHT = 200
+
+
+async def open_connection(hostname, port, context, resolver=None):
+    """
+    # Opens a connection to the host - to its addresses cached by the HostPreflight passed in as the resolver (if
+    # any), resolving (and caching) them on the host's first use.  Returns the (reader, writer) pair.
+    """
+    if resolver is None:
+        return await asyncio.open_connection(hostname, port, ssl=context)
+
+    addresses = resolver.lookup(hostname)
+    if addresses is None:
+        infos = await asyncio.get_event_loop().getaddrinfo(hostname, None, type=socket.SOCK_STREAM)
+        addresses = resolver.remember(hostname, infos)
+    error = None
+    for family, socktype, proto, sockaddr in addresses:
+        try:
+            return await asyncio.open_connection(sockaddr[0], port, ssl=context, family=family,
+                                                 server_hostname=hostname if context is not None else None)
+        except OSError as e:
+            error = e
+    raise error if error is not None else OSError("getaddrinfo returns an empty list")
+
+
+async def open_tunnel(proxy, hostname, port, context):
+    """
+    # Opens a connection to the host through a CONNECT tunnel of the proxy (a (host, port, headers) tuple from
+    # get_proxy()), with TLS to the host over the tunnel if a context is passed in.  Returns the (reader, writer) pair.
+    """
+    proxyHost, proxyPort, proxyHeaders = proxy
+    loop = asyncio.get_event_loop()
+    sock = None
+    error = None
+    for family, socktype, proto, canonname, sockaddr in await loop.getaddrinfo(proxyHost, proxyPort,
+                                                                               type=socket.SOCK_STREAM):
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, sockaddr)
+            break
+        except OSError as e:
+            error = e
+            sock.close()
+            sock = None
+    if sock is None:
+        raise error if error is not None else OSError("getaddrinfo returns an empty list")
+
+    try:
+        target = "[{0}]:{1}".format(hostname, port) if ":" in hostname else "{0}:{1}".format(hostname, port)
+        request = "CONNECT {0} HTTP/1.1\r\nHost: {0}\r\n".format(target)
+        for name, value in proxyHeaders.items():
+            request += "{0}: {1}\r\n".format(name, value)
+        await loop.sock_sendall(sock, (request + "\r\n").encode("latin-1"))
+
+        # The answer to a CONNECT is only a status line and headers - the host's own bytes only follow our own.
+        response = b""
+        while b"\r\n\r\n" not in response:
+            data = await loop.sock_recv(sock, 4096)
+            if not data or len(response) > 65536:
+                raise ConnectionError("Tunnel connection failed: the proxy closed the connection")
+            response += data
+        status = response.split(b"\r\n", 1)[0].decode("latin-1").split(None, 2)
+        if len(status) < 2 or status[1] != "200":
+            raise OSError("Tunnel connection failed: {0}".format(" ".join(status[1:]).strip()))
+        return await asyncio.open_connection(sock=sock, ssl=context,
+                                             server_hostname=hostname if context is not None else None)
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def fetch_status_code(url, method="GET", headers=None, connect_timeout=CONNECT_TIMEOUT,
+                            read_timeout=READ_TIMEOUT, resolver=None, proxies=None):
+    """
+    # Sends a single request for the URL and returns the status code and Location header of the response - or raises
+    # HostBusy for a 429/503 response with a Retry-After header.
+    # Only the status line and headers are read - the connection is closed without reading the body.
+    # connect_timeout limits the time to connect (and TLS handshake), read_timeout limits each read.  resolver is the
+    # run's HostPreflight (see open_connection()), and proxies are as for ConnectionPool.get_proxy().
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("unknown url type: {0}".format(url))
+
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    # SSL contexts are shared with the threads backend (built once, "tethys" URLs get an 'unverified' context).
+    context = get_ssl_context(url) if parts.scheme == "https" else None
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    host = parts.hostname if parts.port is None else "{0}:{1}".format(parts.hostname, parts.port)
+    requestHeaders = dict(headers or {})
+
+    proxy = get_proxy(url, proxies)
+    if proxy is None:
+        opening = open_connection(parts.hostname, port, context, resolver)
+    elif context is not None:
+        opening = open_tunnel(proxy, parts.hostname, port, context)
+    else:
+        # Plain HTTP through a proxy - the proxy is sent the whole URL.
+        opening = asyncio.open_connection(proxy[0], proxy[1])
+        path = urllib.parse.urlunsplit(parts[:4] + ("",))
+        requestHeaders.update(proxy[2])
+
+    reader, writer = await asyncio.wait_for(opening, connect_timeout)
+    try:
+        request = "{0} {1} HTTP/1.1\r\nHost: {2}\r\nUser-Agent: {3}\r\nAccept: */*\r\nConnection: close\r\n"
+        request = request.format(method, path, host, USER_AGENT)
+        for name, value in requestHeaders.items():
+            request += "{0}: {1}\r\n".format(name, value)
+        writer.write((request + "\r\n").encode("latin-1"))
+        await asyncio.wait_for(writer.drain(), read_timeout)
+
+        # Status line looks like: "HTTP/1.1 404 Not Found"
+        status_line = (await asyncio.wait_for(reader.readline(), read_timeout)).decode("latin-1").split(None, 2)
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+            raise ConnectionError("Remote end closed connection without response")
+        code = int(status_line[1])
+
+        location = None
+        retryAfter = None
+        while True:
+            line = await asyncio.wait_for(reader.readline(), read_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            if name == "location":
+                location = value.strip()
+            elif name == "retry-after" and code in BUSY_CODES:
+                retryAfter = parse_retry_after(value)
+
+        if retryAfter is not None:
+            raise HostBusy(code, retryAfter)
+        return code, location
+
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+
+async def follow_redirects(url, method="GET", headers=None, connect_timeout=CONNECT_TIMEOUT,
+                           read_timeout=READ_TIMEOUT, resolver=None, proxies=None):
+    # Requests the URL, following redirects the same way urlopen() does, and returns the final status code.
+    for redirect in range(MAX_REDIRECTS + 1):
+        code, location = await fetch_status_code(url, method, headers, connect_timeout, read_timeout, resolver,
+                                                 proxies)
+        if code in REDIRECT_CODES and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        break
+    return code
+
+
+async def get_site_status_async(url, probe=True, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                                raise_busy=False, resolver=None, proxies=None):
+    """
+    # asyncio version of QueryCatalog.get_site_status().  Passes back ('up', code) or ('down', code) - or
+    # ('down', reason) when the server could not be reached at all.  A 429/503 answer with a Retry-After header
+    # raises HostBusy if raise_busy is set (see HostScheduler.py).  resolver is the run's HostPreflight, if any (see
+    # open_connection()), and proxies are as for ConnectionPool.get_proxy() - the environment's proxies if none are
+    # passed in.
+    #
+    # In probe mode, a HEAD request is sent first and servers that reject HEAD get a GET for just the first bytes
+    # (Range header).  The body is never read either way, so these checks do not draw on the run's byte budget.
+    """
+    if proxies is None:
+        proxies = urllib.request.getproxies()
+    timeouts = {"connect_timeout": connect_timeout, "read_timeout": read_timeout, "resolver": resolver,
+                "proxies": proxies}
+    try:
+        if probe:
+            code = await follow_redirects(url, "HEAD", **timeouts)
+            if code in HEAD_REJECTED_CODES:
+                rangeHeader = {"Range": "bytes=0-{0}".format(PROBE_BYTE_CAP - 1)}
+                code = await follow_redirects(url, headers=rangeHeader, **timeouts)
+                if code == 416:
+                    # "Range Not Satisfiable" - the resource is there, it is just empty.
+                    return 'up', code
+        else:
+            code = await follow_redirects(url, **timeouts)
+
+        if code >= 400:
+            # The server couldn't fulfill the request.
+            return 'down', code
+        # everything is fine
+        return 'up', code
+
+    except HostBusy as e:
+        if raise_busy:
+            raise
+        return 'down', e.Code
+
+    except asyncio.TimeoutError:
+        # Reported the same way as a timeout of the threads backend (and retried the same way - see HostScheduler.py).
+        return 'down', socket.timeout("timed out")
+
+    except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+        # We failed to reach a server.
+        return 'down', e
+
+
+class AsyncURLCheckEngine(object):
+    """
+    # Same interface as CheckEngine.URLCheckEngine, but all checks run on one event loop in a background thread.
+    # max_in_flight limits how many checks are running at the same time.  Checks that have not started by the
+    # deadline (a time.time() value) are skipped and reported as not checked.
+    #
+    # Each check waits for its host's turn from the HostScheduler passed in (if any) before it takes one of the
+    # max_in_flight places, so a host that is rate limited or paused never holds up the checks of other hosts.  Failed
+    # checks are tried again, and hosts given up on, the same way as in URLCheckEngine - and the metrics of the checks
+    # are recorded the same way too.
+    """
+
+    def __init__(self, checker=get_site_status_async, max_in_flight=DEFAULT_MAX_IN_FLIGHT, deadline=None,
+                 scheduler=None, metrics=None):
+        self.Checker = checker
+        self.MaxInFlight = max(1, int(max_in_flight))
+        self.Deadline = deadline
+        self.Scheduler = scheduler or HostScheduler(rate=None, max_per_host=None)
+        self.Metrics = metrics if metrics is not None else RunMetrics()
+        self.Latencies = {}  # URL -> seconds the check took.
+        self._lock = threading.Lock()
+        self._futures = {}  # URL -> concurrent.futures.Future of the (status, code) tuple.
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._thread = threading.Thread(target=self._run_loop, name="AsyncURLCheckEngine", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _wait_turn(self, host):
+        # Waits until the scheduler lets a check of the host start.  Returns False if the deadline passes first.
+        while True:
+            if deadline_passed(self.Deadline):
+                return False
+            wait = self.Scheduler.try_acquire(host)
+            if wait == 0:
+                return True
+            if self.Deadline is not None:
+                wait = min(wait, max(0, self.Deadline - time.time()))
+            await asyncio.sleep(wait)
+
+    async def _check(self, url):
+        host = host_of(url)
+        result = await self._check_host(url, host)
+        self.Metrics.finish_url(url, host, result[0], result[1])
+        return result
+
+    async def _check_host(self, url, host):
+        if self._semaphore is None:
+            # Created on the loop's own thread so it is bound to the right event loop.
+            self._semaphore = asyncio.Semaphore(self.MaxInFlight)
+        attempt = 0
+        while True:
+            if self.Scheduler.unreachable(host) and not deadline_passed(self.Deadline):
+                return "down", HOST_UNREACHABLE_CODE
+            if not await self._wait_turn(host):
+                return STATUS_NOT_CHECKED, DEADLINE_CODE
+            try:
+                async with self._semaphore:
+                    if deadline_passed(self.Deadline):
+                        return STATUS_NOT_CHECKED, DEADLINE_CODE
+                    if self.Scheduler.unreachable(host):
+                        # The breaker opened while this check waited for a place.
+                        return "down", HOST_UNREACHABLE_CODE
+                    timeStart = time.time()
+                    try:
+                        result = await self.Checker(url)
+                    except HostBusy as e:
+                        if attempt >= MAX_BUSY_RETRIES or e.RetryAfter > MAX_RETRY_AFTER:
+                            return "down", e.Code
+                        Logfile.info("### BUSY ### {0} asked us to wait {1} seconds - {2} paused.".format(
+                            url, e.RetryAfter, host))
+                        self.Scheduler.pause(host, e.RetryAfter)
+                        attempt += 1
+                        continue
+                    except Exception as e:
+                        Logfile.error("### ERROR ### checking {0}: {1}".format(url, e))
+                        return "down", "Connection Error"
+                    finally:
+                        self.Latencies[url] = time.time() - timeStart
+                        self.Metrics.attempt(url, host, self.Latencies[url])
+            finally:
+                self.Scheduler.release(host)
+
+            delay = self.Scheduler.retry_delay(host, result[0], result[1], attempt)
+            if delay is None:
+                return result
+            Logfile.info("### RETRY ### {0} failed ({1}) - trying again in {2:.1f} seconds.".format(
+                url, result[1], delay))
+            if self.Deadline is not None:
+                delay = min(delay, max(0, self.Deadline - time.time()))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def submit(self, url):
+        # Schedules the check for the URL on the event loop (once per URL) and returns its Future.
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                future = asyncio.run_coroutine_threadsafe(self._check(url), self._loop)
+                self._futures[url] = future
+            return future
+
+    def result(self, url):
+        # Blocks until the check for the URL is finished and returns its (status, code) tuple.
+        return self.submit(url).result()
+
+    def urls(self):
+        # Returns the list of unique URLs submitted so far.
+        with self._lock:
+            return list(self._futures)
+
+    async def _cancel_all(self):
+        # Cancels every check still running on the loop and waits for them to clean up (close their connections).
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def shutdown(self, wait=True):
+        # With wait=False, the checks still running are cancelled instead of waited on.
+        if wait:
+            with self._lock:
+                futures = list(self._futures.values())
+            # Unlike future.exception(), wait() does not raise for the checks that were cancelled.
+            concurrent.futures.wait(futures)
+        else:
+            asyncio.run_coroutine_threadsafe(self._cancel_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
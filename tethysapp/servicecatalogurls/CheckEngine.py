@@ -0,0 +1,219 @@
+"""
+# Initial Creation:
+#   Concurrent URL verification engine used by QueryCatalog.ProcessURLs().
+# General Description:
+#   Checking the catalog one URL at a time means a run takes as long as every slow or timed-out host added together.
+#   The URLCheckEngine hands the URL checks off to a pool of worker threads so that the checks for all services and
+#   all categories (DATA, TOOLS, NEWS, TRAINING MATERIALS) run in parallel.  Each unique URL is only ever fetched
+#   once - if the same URL is submitted again (even while the first check is still in flight), the caller simply
+#   gets back the Future of the check that is already running.
+#
+#   The worker threads take the checks from a HostScheduler (see HostScheduler.py) rather than in the order they were
+#   submitted, so the checks are spread across hosts and every host's rate limit and Retry-After pauses are kept.  The
+#   scheduler also decides which failed checks are tried again, and which hosts are given up on (circuit breaker).
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from .HostScheduler import HostScheduler, HostBusy, host_of, MAX_BUSY_RETRIES, MAX_RETRY_AFTER, HOST_UNREACHABLE_CODE
+from .Metrics import RunMetrics
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+# The app workspace folder, where the checker keeps its files (caches, etc.).
+APP_WORKSPACE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workspaces", "app_workspace")
+
+# Default number of worker threads used to check URLs.  URL checks spend nearly all of their time waiting on the
+# network, so this can be set much higher than the number of CPUs.
+DEFAULT_MAX_WORKERS = 16
+
+# Probe mode settings (see QueryCatalog.get_site_status()).
+HEAD_REJECTED_CODES = (405, 501)  # Status codes of servers that do not support HEAD requests.
+PROBE_BYTE_CAP = 1024  # Most body bytes ever read from a single fallback GET.
+RUN_BYTE_BUDGET = 10 * 1024 * 1024  # Most body bytes read across a whole run.
+
+# Same redirect limit and codes as urllib.request.HTTPRedirectHandler.
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Timeouts (in seconds) for each URL check: how long to wait for the connection to be made, and then how long to wait
+# on each read from the server once it is connected.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 20
+
+# Status and code reported for URLs that could not be checked before the run's deadline.
+STATUS_NOT_CHECKED = "not checked"
+DEADLINE_CODE = "NOT CHECKED (deadline)"
+
+
+def seconds_until(deadline):
+    # Returns the number of seconds left until the deadline (a time.time() value), or None if there is no deadline.
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
+
+
+def deadline_passed(deadline):
+    return deadline is not None and time.time() >= deadline
+
+
+class ByteBudget(object):
+    """
+    # Thread safe count of the response body bytes a run is still allowed to read, so that one run cannot pull
+    # gigabytes from data portals.  A limit of None means there is no limit.
+    #
+    # A budget with a parent (e.g. the bytes of one URL check, drawn from the run's budget) takes its bytes from the
+    # parent as well, so it counts the bytes of its own reads while the parent keeps the limit.
+    """
+
+    def __init__(self, limit=None, parent=None):
+        self.Limit = limit
+        self.Parent = parent
+        self.Used = 0
+        self._lock = threading.Lock()
+
+    def take(self, n):
+        # Reserves up to n bytes from the budget and returns how many bytes may actually be read.
+        if self.Parent is not None:
+            n = self.Parent.take(n)
+        with self._lock:
+            if self.Limit is not None:
+                n = max(0, min(n, self.Limit - self.Used))
+            self.Used += n
+            return n
+
+    def refund(self, n):
+        # Gives back bytes that were reserved by take() but not actually read.
+        if self.Parent is not None:
+            self.Parent.refund(n)
+        with self._lock:
+            self.Used -= n
+
+    def remaining(self):
+        with self._lock:
+            return None if self.Limit is None else self.Limit - self.Used
+
+
+class URLCheckEngine(object):
+    """
+    # Runs a checker function (e.g. QueryCatalog.get_site_status) for each unique URL on a pool of worker threads.
+    # The checker must take a URL and return a (status, code) tuple - or raise HostBusy, in which case the host is
+    # paused for the Retry-After time and the URL is put back in line (up to MAX_BUSY_RETRIES times).  Checks that have
+    # not started by the deadline (a time.time() value) are skipped and reported as not checked.  A check that could
+    # not reach its host may be put back in line after a backoff, and once a host's circuit breaker is open, its checks
+    # are reported as ('down', HOST_UNREACHABLE_CODE) without calling the checker.
+    #
+    # The HostScheduler passed in sets the per-host limits.  Without one, there are no per-host limits (the checks
+    # are still spread across hosts).  Every attempt and result is recorded in the RunMetrics passed in (see
+    # Metrics.py) - or in one of the engine's own.
+    """
+
+    def __init__(self, checker, max_workers=DEFAULT_MAX_WORKERS, deadline=None, scheduler=None, metrics=None):
+        self.Checker = checker
+        self.MaxWorkers = max(1, int(max_workers))
+        self.Deadline = deadline
+        self.Scheduler = scheduler or HostScheduler(rate=None, max_per_host=None)
+        self.Metrics = metrics if metrics is not None else RunMetrics()
+        self.Latencies = {}  # URL -> seconds the check took.
+        self._lock = threading.Lock()
+        self._futures = {}  # URL -> Future of the (status, code) tuple.
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def _check(self, url, host):
+        # Wraps the checker so that an unexpected error is reported as "down" instead of being raised from result().
+        if deadline_passed(self.Deadline):
+            return STATUS_NOT_CHECKED, DEADLINE_CODE
+        timeStart = time.time()
+        try:
+            return self.Checker(url)
+        except HostBusy:
+            raise
+        except Exception as e:
+            Logfile.error("### ERROR ### checking {0}: {1}".format(url, e))
+            return "down", "Connection Error"
+        finally:
+            self.Latencies[url] = time.time() - timeStart
+            self.Metrics.attempt(url, host, self.Latencies[url])
+
+    def _work(self):
+        # Worker thread: runs the checks the scheduler hands out until it is closed.
+        while True:
+            entry = self.Scheduler.get(self.Deadline)
+            if entry is None:
+                return
+            host, (url, future, attempt) = entry
+            if attempt == 0 and not future.set_running_or_notify_cancel():
+                # Cancelled (at the deadline) before it started.
+                self.Scheduler.release(host)
+                continue
+            try:
+                if self.Scheduler.unreachable(host) and not deadline_passed(self.Deadline):
+                    result = "down", HOST_UNREACHABLE_CODE
+                else:
+                    result = self._check(url, host)
+                    delay = self.Scheduler.retry_delay(host, result[0], result[1], attempt)
+                    if delay is not None:
+                        Logfile.info("### RETRY ### {0} failed ({1}) - trying again in {2:.1f} seconds.".format(
+                            url, result[1], delay))
+                        self.Scheduler.put(host, (url, future, attempt + 1), delay)
+                        continue
+            except HostBusy as e:
+                if attempt < MAX_BUSY_RETRIES and e.RetryAfter <= MAX_RETRY_AFTER:
+                    Logfile.info("### BUSY ### {0} asked us to wait {1} seconds - {2} paused.".format(
+                        url, e.RetryAfter, host))
+                    self.Scheduler.pause(host, e.RetryAfter)
+                    self.Scheduler.put(host, (url, future, attempt + 1))
+                    continue
+                result = "down", e.Code
+            finally:
+                self.Scheduler.release(host)
+            self.Metrics.finish_url(url, host, result[0], result[1])
+            future.set_result(result)
+
+    def submit(self, url):
+        """
+        # Schedules the check for the URL (if it has not been scheduled already) and returns its Future.
+        # The lock makes the "already scheduled?" test and the scheduling a single step, so two services submitting
+        # the same URL at the same moment still only result in one fetch.
+        """
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                future = Future()
+                self._futures[url] = future
+                self.Scheduler.put(host_of(url), (url, future, 0))
+                if len(self._workers) < self.MaxWorkers:
+                    worker = threading.Thread(target=self._work, name="URLCheckEngine", daemon=True)
+                    worker.start()
+                    self._workers.append(worker)
+            return future
+
+    def result(self, url):
+        # Blocks until the check for the URL is finished and returns its (status, code) tuple.
+        return self.submit(url).result()
+
+    def urls(self):
+        # Returns the list of unique URLs submitted so far.
+        with self._lock:
+            return list(self._futures)
+
+    def shutdown(self, wait=True):
+        # With wait=False, the checks still waiting in line are reported as not checked instead of waited on (the
+        # running ones are left to finish in the background).
+        if not wait:
+            for url, future, attempt in self.Scheduler.drain():
+                if attempt > 0 or future.set_running_or_notify_cancel():
+                    future.set_result((STATUS_NOT_CHECKED, DEADLINE_CODE))
+        self.Scheduler.close()
+        if wait:
+            for worker in self._workers:
+                worker.join()
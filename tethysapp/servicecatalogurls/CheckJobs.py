@@ -0,0 +1,538 @@
+"""
+# Initial Creation:
+#   Background check runs for the queryresult page.
+# General Description:
+#   A whole run of QueryCatalog.QueryServiceCatalog() can take many minutes, which is longer than a web request should
+#   be held open (proxies time out, and the web worker can not serve anyone else in the meantime).  start_job() runs
+#   the check on a small pool of background threads instead and returns a CheckJob right away.  The job's ID is passed
+#   back to the browser, which polls the job's progress (services done, URLs checked and remaining, errors so far) and
+#   loads the results page once the job has finished.
+#
+#   As the run goes, every invalid entry found is handed to the job's RunProgress, so the entries can be streamed to
+#   the browser (see controllers.querystream) long before the whole run has finished.
+#
+#   A job runs in the web server process that started it, but the app may be served by several worker processes, and
+#   the next poll (or the results page) can reach any of them.  So every job started by start_job() is also saved to
+#   the job store (see JobStore), a SQLite database in the app workspace which every worker process shares: its state
+#   and progress every JOB_SYNC_SECONDS while it is queued or running, every invalid entry found as it goes, and its
+#   results once it has finished.  get_job() answers from the store (see StoredJob) for the jobs of other processes.
+#   A job whose process stopped saving it for JOB_LOST_SECONDS (the process was stopped or restarted) is reported
+#   as failed.  Finished jobs are dropped (from memory and from the store) after JOB_KEEP_SECONDS.
+#
+#   A job can be traced (and profiled) - its trace is then saved in the app workspace once it has finished (see
+#   Tracing.py).
+#
+#   Every finished job is recorded in the run history (see model.py), so its changes since the region's last run can
+#   be looked up later.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .CheckEngine import APP_WORKSPACE_PATH
+from .QueryCatalog import QueryServiceCatalog, NoConnectivityError, capture_exception
+from .ResultStore import InvalidEntry, ResultList
+from .StatusCache import connect
+from .Tracing import Tracer, RunProfiler, trace_name, PROFILE_MODES
+from .URLIndex import canonical_url
+from .model import RunHistory
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+# Most check runs allowed to run at the same time - any more wait in line.
+MAX_CONCURRENT_JOBS = 2
+
+# Seconds a finished job (and its results) is kept after it ends.
+JOB_KEEP_SECONDS = 60 * 60
+
+JobStore_Path = os.path.join(APP_WORKSPACE_PATH, "check_jobs.sqlite3")
+
+# Seconds between two saves of the jobs queued or running in this process to the job store.
+JOB_SYNC_SECONDS = 1
+
+# Seconds a queued or running job may go without being saved before it is taken for lost (its process has stopped).
+JOB_LOST_SECONDS = 60
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_FINISHED = "finished"
+JOB_FAILED = "failed"
+
+_Jobs_Lock = threading.Lock()
+_Jobs = {}  # Job ID -> CheckJob
+_Executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+_Store = None  # The JobStore, once opened (see job_store()).
+_Sync_Thread = None  # Thread saving the active jobs of this process to the job store (see sync_jobs()).
+
+
+class RunProgress(object):
+    """
+    # Thread safe progress counters of one check run, updated by QueryCatalog.ProcessURLs() as the URLs are reported.
+    # A service is "done" once every unique URL found in it has been reported.  Also keeps every invalid entry in the
+    # order it was found, and the run's totals once it has finished.
+    #
+    # The regions of a fan-out run (see QueryCatalog.ProcessRegions()) each call start_checking() and report their
+    # URLs at the same time.  A URL found in more than one region only counts once.  URLs are counted (and reported)
+    # by their canonical form (see URLIndex.py).
+    """
+
+    def __init__(self):
+        self.Stage = "Waiting to start"
+        self.ServicesTotal = 0
+        self.ServicesDone = 0
+        self.URLsTotal = 0
+        self.URLsChecked = 0
+        self.Errors = 0
+        self.Entries = []  # Invalid URL entries, in the order they were found.
+        self.CatalogEntries = []  # "INCORRECT CATALOG" entries.
+        self.Summary = None  # Run totals - set once the run has finished.
+        self.Regions = {}  # Region name -> totals and timing of the region (fan-out runs).
+        self.Hosts = []  # Totals and timing of the hosts that took the most time (see Metrics.RunMetrics).
+        self._lock = threading.Lock()
+        self._pending = {}  # Service ID -> number of its unique URLs not reported yet.
+        self._services = {}  # Canonical URL -> IDs of the services it was found in.
+        self._reported = set()  # URLs reported so far.
+
+    def set_stage(self, stage):
+        with self._lock:
+            self.Stage = stage
+
+    def start_checking(self, Services_List, URL_Occurrences, List_ErrCatalogs=()):
+        # Called once the URLs of every service (of the run or region) have been collected, before they are reported.
+        with self._lock:
+            self.CatalogEntries.extend(List_ErrCatalogs)
+            self.ServicesTotal += len(Services_List)
+            Dict_ServiceURLs = {}
+            for svc in Services_List:
+                Dict_ServiceURLs[svc.ID] = set()
+            for svc, svcCategory, lnkName, lnk in URL_Occurrences:
+                lnk = canonical_url(lnk)
+                self._services.setdefault(lnk, set()).add(svc.ID)
+                if lnk not in self._reported:
+                    Dict_ServiceURLs[svc.ID].add(lnk)
+            for svcID, lnks in Dict_ServiceURLs.items():
+                self._pending[svcID] = len(lnks)
+                if not lnks:
+                    self.ServicesDone += 1
+            self.URLsTotal = len(self._services)
+
+    def url_reported(self, lnk, New_ErrURLs):
+        # Called as each unique URL is reported.  New_ErrURLs holds the (index, invalid entry) pairs the caller found
+        # since its last call - each caller keeps track of what it has already handed over.
+        with self._lock:
+            self.Entries.extend(errEntry for idx, errEntry in New_ErrURLs)
+            self.Errors = len(self.Entries)
+            if lnk in self._reported:
+                return
+            self._reported.add(lnk)
+            self.URLsChecked = len(self._reported)
+            for svcID in self._services.get(lnk, ()):
+                self._pending[svcID] -= 1
+                if self._pending[svcID] == 0:
+                    self.ServicesDone += 1
+
+    def finish(self, checked, down, not_checked):
+        # Called by QueryCatalog.QueryServiceCatalog() with the run's totals once every URL has been reported.
+        with self._lock:
+            self.Summary = {"checked": checked, "down": down, "not_checked": not_checked}
+
+    def region_done(self, regionName, stats):
+        # Called by QueryCatalog.ProcessRegions() with the totals and timing of each region as it finishes.
+        with self._lock:
+            self.Regions[regionName] = stats
+
+    def hosts_done(self, rows):
+        # Called by QueryCatalog.ReportRunMetrics() with the summary of the hosts once every URL has been checked.
+        with self._lock:
+            self.Hosts = rows
+
+    def entries_since(self, start):
+        # Returns the invalid entries found after the first start ones.
+        with self._lock:
+            return self.Entries[start:]
+
+    def snapshot(self):
+        # Returns the counters as a dictionary (e.g. for a JSON response).
+        with self._lock:
+            return {
+                "stage": self.Stage,
+                "services_total": self.ServicesTotal,
+                "services_done": self.ServicesDone,
+                "urls_total": self.URLsTotal,
+                "urls_checked": self.URLsChecked,
+                "urls_remaining": self.URLsTotal - self.URLsChecked,
+                "errors": self.Errors,
+            }
+
+
+class CheckJob(object):
+    """
+    # One background check run: its ID, state, progress and - once finished - the two lists returned by
+    # QueryServiceCatalog().  trace is the run's tracing mode (see Tracing.trace_mode()), or None not to trace it.
+    # A job with a JobStore is saved to it as it goes (see sync()), for the other worker processes to read.
+    """
+
+    def __init__(self, region_id, settings=None, run_deadline=None, trace=None, store=None):
+        self.ID = uuid.uuid4().hex
+        self.RegionID = region_id
+        self.Settings = settings
+        self.RunDeadline = run_deadline
+        self.State = JOB_QUEUED
+        self.Progress = RunProgress()
+        self.Created = time.time()
+        self.Started = None
+        self.Finished = None
+        self.Error = None
+        self.ErrURLs = None
+        self.ErrCatalogs = None
+        self.HistoryRunID = None  # ID of the job's run in the run history (see model.py), once recorded.
+        self.Tracer = Tracer(trace_name(self.ID)) if trace else None
+        self.Profiler = RunProfiler(trace) if trace in PROFILE_MODES else None
+        self.Store = store
+        self._syncLock = threading.Lock()
+        self._entriesSaved = 0  # Invalid entries of the progress already saved to the store.
+
+    def run(self):
+        self.State = JOB_RUNNING
+        self.Started = time.time()
+        try:
+            if self.Profiler is not None:
+                # Can fail, e.g. cProfile refuses to run while another job's profiler is on (Python 3.12+).
+                self.Profiler.start()
+            result = QueryServiceCatalog(self.RegionID, self.Settings, self.RunDeadline, progress=self.Progress,
+                                         tracer=self.Tracer)
+            if result is None:
+                # QueryServiceCatalog() logs its own errors and returns nothing when the run fails.
+                self.Error = "The check run failed - see the log for details."
+                self.State = JOB_FAILED
+            else:
+                self.ErrURLs, self.ErrCatalogs = result
+                self.State = JOB_FINISHED
+        except NoConnectivityError as e:
+            self.Error = str(e)
+            self.State = JOB_FAILED
+        except:
+            self.Error = capture_exception()
+            Logfile.error(self.Error)
+            self.State = JOB_FAILED
+        finally:
+            if self.Profiler is not None:
+                self.Profiler.stop()
+            if self.Tracer is not None:
+                self.save_trace()
+            self.Finished = time.time()
+            if self.State == JOB_FINISHED:
+                self.record_history()
+            self.Progress.set_stage("Done")
+            self.sync()
+
+    def save_trace(self):
+        # Saves the job's trace (and profile, if any) to the app workspace (see Tracing.py).  Errors are only logged -
+        # a trace that could not be saved does not fail the run.
+        try:
+            if self.Profiler is not None and self.Profiler.Started and self.Tracer.ProfilePath is None:
+                self.Profiler.save(self.Tracer)
+            Logfile.info("Trace of check job {0} saved to {1}".format(self.ID, self.Tracer.save()))
+        except (OSError, ValueError, TypeError):
+            Logfile.error(capture_exception())
+
+    def record_history(self):
+        # Records the finished job in the run history (see model.py).  Errors are only logged - a run that could not
+        # be recorded still has its results.
+        try:
+            self.HistoryRunID = RunHistory().record_run(self.RegionID, self.Started, self.Finished, self.summary(),
+                                                        self.ErrURLs, self.ErrCatalogs)
+        except (OSError, sqlite3.Error):
+            Logfile.error(capture_exception())
+
+    def sync(self):
+        # Saves the job's state, progress and new invalid entries (and its results, once it has finished) to its
+        # JobStore, if it has one.  Errors are only logged - the job runs on either way.
+        if self.Store is None:
+            return
+        with self._syncLock:
+            try:
+                self._entriesSaved = self.Store.save(self, self._entriesSaved)
+            except (OSError, sqlite3.Error, ValueError, TypeError):
+                Logfile.error(capture_exception())
+
+    def done(self):
+        return self.State in (JOB_FINISHED, JOB_FAILED)
+
+    def entries_since(self, start):
+        # Returns the invalid entries found after the first start ones (see RunProgress.entries_since()).
+        return self.Progress.entries_since(start)
+
+    def catalog_entries(self):
+        # Returns the run's "INCORRECT CATALOG" entries.
+        return list(self.Progress.CatalogEntries)
+
+    def summary(self):
+        # Returns the run's totals (URLs checked, down and not checked) along with its run time.
+        summary = dict(self.Progress.Summary or {"checked": self.Progress.URLsChecked, "down": None,
+                                                 "not_checked": None})
+        if self.Progress.Regions:
+            summary["regions"] = dict(self.Progress.Regions)
+        if self.Progress.Hosts:
+            summary["hosts"] = list(self.Progress.Hosts)
+        summary["run_time"] = round((self.Finished or time.time()) - (self.Started or time.time()), 1)
+        return summary
+
+    def status(self):
+        # Returns the state and progress of the job as a dictionary (e.g. for a JSON response).
+        status = self.Progress.snapshot()
+        status["job"] = self.ID
+        status["state"] = self.State
+        status["error"] = self.Error
+        status["elapsed"] = round((self.Finished or time.time()) - (self.Started or time.time()), 1)
+        if self.HistoryRunID is not None:
+            status["history_run"] = self.HistoryRunID
+        if self.Tracer is not None and self.Tracer.Path is not None:
+            status["trace"] = os.path.basename(self.Tracer.Path)
+        return status
+
+
+class JobStore(object):
+    """
+    # SQLite backed store of the check jobs started by every worker process (see above): one row per job with its
+    # state, status, summary and - once finished - its results, and the invalid entries of each job in the order they
+    # were found (for streaming them).
+    """
+
+    def __init__(self, path=JobStore_Path):
+        self.Path = path
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                             "  job_id TEXT PRIMARY KEY,"
+                             "  region_id TEXT,"
+                             "  state TEXT NOT NULL,"
+                             "  error TEXT,"
+                             "  updated REAL NOT NULL,"
+                             "  status TEXT NOT NULL,"
+                             "  summary TEXT NOT NULL,"
+                             "  results TEXT)")
+                conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)")
+                conn.execute("CREATE TABLE IF NOT EXISTS job_entries ("
+                             "  job_id TEXT NOT NULL,"
+                             "  seq INTEGER NOT NULL,"
+                             "  entry TEXT NOT NULL,"
+                             "  PRIMARY KEY (job_id, seq))")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return connect(self.Path)
+
+    def save(self, job, entries_from=0):
+        """
+        # Saves the job passed in, with the invalid entries its progress found after the first entries_from ones, and
+        # returns the number of its entries saved so far.
+        """
+        entries = job.Progress.entries_since(entries_from)
+        results = None
+        if job.State == JOB_FINISHED:
+            results = json.dumps({"errors": job.ErrURLs.as_dicts(), "catalogs": job.ErrCatalogs.as_dicts()})
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO jobs (job_id, region_id, state, error, updated, status, summary, "
+                             "results) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (job.ID, job.RegionID, job.State, job.Error, time.time(), json.dumps(job.status()),
+                              json.dumps(job.summary()), results))
+                conn.executemany("INSERT OR REPLACE INTO job_entries (job_id, seq, entry) VALUES (?, ?, ?)",
+                                 [(job.ID, entries_from + i, json.dumps(errEntry.as_dict()))
+                                  for i, errEntry in enumerate(entries)])
+        finally:
+            conn.close()
+        return entries_from + len(entries)
+
+    def load(self, job_id, results=False):
+        """
+        # Returns the row of the job as a dictionary (with its results, if asked for), or None if there is no such job.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT region_id, state, error, updated, status, summary{0} FROM jobs "
+                               "WHERE job_id = ?".format(", results" if results else ""), (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = {"region_id": row[0], "state": row[1], "error": row[2], "updated": row[3], "status": json.loads(row[4]),
+               "summary": json.loads(row[5])}
+        if results:
+            job["results"] = json.loads(row[6]) if row[6] else None
+        return job
+
+    def entries(self, job_id, start):
+        # Returns the invalid entries of the job found after the first start ones, in the order they were found.
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT entry FROM job_entries WHERE job_id = ? AND seq >= ? ORDER BY seq",
+                                (job_id, start))
+            return [InvalidEntry.from_dict(json.loads(entry)) for entry, in rows]
+        finally:
+            conn.close()
+
+    def prune(self, keep_seconds=JOB_KEEP_SECONDS):
+        # Deletes the jobs not saved for keep_seconds (finished - or lost - that long ago), along with their entries.
+        cutoff = time.time() - keep_seconds
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM job_entries WHERE job_id IN (SELECT job_id FROM jobs WHERE updated < ?)",
+                             (cutoff,))
+                conn.execute("DELETE FROM jobs WHERE updated < ?", (cutoff,))
+        finally:
+            conn.close()
+
+
+class StoredJob(object):
+    """
+    # A check job of another worker process (or of this one, before it was restarted), read back from the JobStore.
+    # It answers for the job as a CheckJob does - state, status, summary, entries and results - read only.  done()
+    # reads the job's state again, so a stream of the job's entries (see controllers.stream_job()) sees it finish.
+    """
+
+    def __init__(self, store, job_id, saved):
+        self.Store = store
+        self.ID = job_id
+        self.Tracer = None
+        self._results = None
+        self._update(saved)
+
+    def _update(self, saved):
+        self.RegionID = saved["region_id"]
+        self.State = saved["state"]
+        self.Error = saved["error"]
+        self._status = saved["status"]
+        self._summary = saved["summary"]
+        if self.State not in (JOB_FINISHED, JOB_FAILED) and time.time() - saved["updated"] > JOB_LOST_SECONDS:
+            # The process running the job has stopped saving it.
+            self.State = JOB_FAILED
+            self.Error = "The check job was lost - the web server process running it has stopped."
+
+    def refresh(self):
+        saved = self.Store.load(self.ID)
+        if saved is not None:
+            self._update(saved)
+
+    def done(self):
+        if self.State not in (JOB_FINISHED, JOB_FAILED):
+            self.refresh()
+        return self.State in (JOB_FINISHED, JOB_FAILED)
+
+    def _load_results(self):
+        # Reads the two result lists of the finished job from the store (once).
+        if self._results is None:
+            saved = (self.Store.load(self.ID, results=True) or {}).get("results") or {"errors": [], "catalogs": []}
+            self._results = (ResultList.from_dicts(saved["errors"]), ResultList.from_dicts(saved["catalogs"]))
+        return self._results
+
+    @property
+    def ErrURLs(self):
+        return self._load_results()[0] if self.State == JOB_FINISHED else None
+
+    @property
+    def ErrCatalogs(self):
+        return self._load_results()[1] if self.State == JOB_FINISHED else None
+
+    def entries_since(self, start):
+        return self.Store.entries(self.ID, start)
+
+    def catalog_entries(self):
+        # (The "INCORRECT CATALOG" entries are only saved with the results, once the job has finished.)
+        return list(self.ErrCatalogs.filter()) if self.State == JOB_FINISHED else []
+
+    def summary(self):
+        return dict(self._summary)
+
+    def status(self):
+        status = dict(self._status)
+        status["state"] = self.State
+        status["error"] = self.Error
+        return status
+
+
+def job_store():
+    # Returns the app's JobStore, opened the first time it is needed.
+    global _Store
+    with _Jobs_Lock:
+        if _Store is None:
+            _Store = JobStore()
+        return _Store
+
+
+def sync_jobs():
+    # Body of the thread saving the jobs queued or running in this process to the job store every JOB_SYNC_SECONDS.
+    while True:
+        time.sleep(JOB_SYNC_SECONDS)
+        with _Jobs_Lock:
+            active = [job for job in _Jobs.values() if not job.done()]
+        for job in active:
+            job.sync()
+
+
+def prune_jobs(store=None):
+    # Drops the jobs that finished more than JOB_KEEP_SECONDS ago (from the store passed in too, if any).
+    cutoff = time.time() - JOB_KEEP_SECONDS
+    with _Jobs_Lock:
+        for jobID in [jobID for jobID, job in _Jobs.items() if job.Finished is not None and job.Finished < cutoff]:
+            del _Jobs[jobID]
+    if store is not None:
+        try:
+            store.prune()
+        except (OSError, sqlite3.Error):
+            Logfile.error(capture_exception())
+
+
+def start_job(region_id, settings=None, run_deadline=None, trace=None):
+    """
+    # Queues a check run of the region (see QueryServiceCatalog()) on the background threads and returns its CheckJob
+    # right away.  trace is the run's tracing mode, if it is to be traced (see Tracing.trace_mode()).  The job is saved
+    # to the job store right away, so any worker process can answer for it (if the store can not be opened, the job
+    # is only known to this process).
+    """
+    global _Sync_Thread
+    try:
+        store = job_store()
+    except (OSError, sqlite3.Error):
+        Logfile.error(capture_exception())
+        store = None
+    prune_jobs(store)
+    job = CheckJob(region_id, settings, run_deadline, trace, store)
+    job.sync()
+    with _Jobs_Lock:
+        _Jobs[job.ID] = job
+        if store is not None and _Sync_Thread is None:
+            _Sync_Thread = threading.Thread(target=sync_jobs, name="CheckJobSync", daemon=True)
+            _Sync_Thread.start()
+    _Executor.submit(job.run)
+    Logfile.info("Check job {0} queued (region: '{1}').".format(job.ID, region_id))
+    return job
+
+
+def get_job(job_id):
+    """
+    # Returns the CheckJob with the ID passed in - or, for a job started by another worker process, its StoredJob -
+    # or None if there is no such job (or it has been dropped).
+    """
+    with _Jobs_Lock:
+        job = _Jobs.get(job_id)
+    if job is not None or not job_id:
+        return job
+    try:
+        store = job_store()
+        saved = store.load(job_id)
+    except (OSError, sqlite3.Error, ValueError):
+        Logfile.error(capture_exception())
+        return None
+    return StoredJob(store, job_id, saved) if saved is not None else None
@@ -0,0 +1,244 @@
+"""
+# Initial Creation:
+#   Per-host keep-alive connection pooling for the URL checks in QueryCatalog.get_site_status().
+# General Description:
+#   Most catalog links point to the same few hosts (servirglobal.net, gis1.servirglobal.net, rcmrd.org, icimod.org,
+#   etc.), but urlopen() makes a new TCP (and TLS) connection for every URL.  HostConnectionPool keeps the connections
+#   open after each check and hands them out again for the next URL on the same host.  The number of connections to
+#   any one host is capped, TLS contexts are only ever built once, and the TLS session of each host is reused so that
+#   new connections to a host can skip the full handshake.  New connections go to the host addresses cached by the
+#   run's HostPreflight (if any), so the host names are not looked up again for every connection.
+#
+#   The proxies set in the environment (HTTP_PROXY, HTTPS_PROXY and NO_PROXY - the same ones urlopen() uses) are
+#   honoured: HTTPS URLs are tunnelled through the proxy (CONNECT), and plain HTTP URLs are sent to the proxy with
+#   their full URL as the request target.  Connections through a proxy are pooled per target host as well.
+"""
+import base64
+import http.client
+import ssl
+import threading
+import urllib.parse
+import urllib.request
+
+from .CheckEngine import CONNECT_TIMEOUT, READ_TIMEOUT
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+# Most connections (idle or in use) kept open to any one host.
+DEFAULT_MAX_PER_HOST = 4
+
+# Send the same User-Agent as urllib so the answers match what urlopen() used to get.
+USER_AGENT = "Python-urllib/{0}".format(urllib.request.__version__)
+
+_Context_Lock = threading.Lock()
+_SSL_Contexts = {}
+
+
+def get_ssl_context(url):
+    """
+    # Returns the (cached) SSL context to use for the URL.
+    #
+    # Issue: Using urllib2.urlopen() with python 2.7 did not give a problem with SSL certificates.  However, with
+    # python 3.x, urllib2 was divided up between urllib.request and urllib.error, and they implemented a 'fix' that
+    # requires SSL certificate verification on HTTPS calls. Please see https://www.python.org/dev/peps/pep-0476/
+    # for more info.  Currently, our tethys server is reporting a 'certificate verify failed' for some reason, so
+    # we are implementing the unverified context work-around for "tethys" site links.
+    """
+    unverified = "tethys" in url
+    with _Context_Lock:
+        context = _SSL_Contexts.get(unverified)
+        if context is None:
+            if unverified:
+                #  The tethys server has a valid certificate, but for some reason is reporting certificate verify
+                #  failed. Thus, need to provide an 'unverified' context to bypass certificate authorization.
+                context = ssl._create_unverified_context()
+            else:
+                context = ssl.create_default_context()
+            _SSL_Contexts[unverified] = context
+        return context
+
+
+def get_proxy(url, proxies=None):
+    """
+    # Returns the (host, port, headers) of the proxy to send the URL's request through, or None if it goes straight
+    # to the server.  proxies maps URL schemes to proxy URLs (plus "no" for the hosts that bypass them), as returned
+    # by urllib.request.getproxies() - which is what is used if none are passed in.  headers holds the
+    # Proxy-Authorization header for a proxy URL with a user name and password.
+    """
+    if proxies is None:
+        proxies = urllib.request.getproxies()
+    parts = urllib.parse.urlsplit(url)
+    proxy = proxies.get(parts.scheme)
+    if not proxy or not parts.hostname:
+        return None
+    hostport = parts.hostname if parts.port is None else "{0}:{1}".format(parts.hostname, parts.port)
+    if "no" in proxies:
+        if urllib.request.proxy_bypass_environment(hostport, proxies):
+            return None
+    elif urllib.request.proxy_bypass(hostport):
+        return None
+
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    proxyParts = urllib.parse.urlsplit(proxy)
+    headers = {}
+    if proxyParts.username:
+        credentials = "{0}:{1}".format(urllib.parse.unquote(proxyParts.username),
+                                       urllib.parse.unquote(proxyParts.password or ""))
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode("ascii")
+    return proxyParts.hostname, proxyParts.port or 80, headers
+
+
+class TimeoutsMixin(object):
+    """
+    # Lets an http.client connection use one timeout while connecting (including the TLS handshake) and a separate
+    # timeout for every read once it is connected.  urlopen() only supports a single timeout for both.
+    """
+
+    def __init__(self, *args, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ConnectTimeout = connect_timeout
+        self.ReadTimeout = read_timeout
+        self.Reused = False  # True once the connection has been handed out a second time.
+        self.AbsoluteURI = False  # True for a plain HTTP connection to a proxy - requests need the full URL.
+        self.ProxyHeaders = {}  # Headers the proxy needs on every request (Proxy-Authorization).
+
+    def connect(self):
+        self.timeout = self.ConnectTimeout
+        super().connect()
+        self.sock.settimeout(self.ReadTimeout)
+
+
+class PooledHTTPConnection(TimeoutsMixin, http.client.HTTPConnection):
+    pass
+
+
+class PooledHTTPSConnection(TimeoutsMixin, http.client.HTTPSConnection):
+    """
+    # HTTPS connection that resumes the TLS session passed in (if any) instead of doing a full handshake.  Through a
+    # proxy, the connection is made to the proxy and set_tunnel() gives the host the TLS session is with.
+    """
+
+    def __init__(self, *args, tls_session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.TLSSession = tls_session
+
+    def connect(self):
+        self.timeout = self.ConnectTimeout
+        http.client.HTTPConnection.connect(self)
+        # The pool hands out one cached SSL context per host, so the session always belongs to this context.
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host,
+                                              session=self.TLSSession)
+        self.sock.settimeout(self.ReadTimeout)
+
+
+class HostConnectionPool(object):
+    """
+    # Keeps idle keep-alive connections per (scheme, host, port) and hands them out again for the next check of a
+    # URL on the same host.  No more than max_per_host connections to a host are open at any time - a check waits
+    # for a free connection before it starts.  A HostPreflight passed in as the resolver is used to connect to the
+    # cached addresses of the hosts (see HostPreflight.py).  proxies are as for get_proxy() - the environment's
+    # proxies if none are passed in.
+    """
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, resolver=None, proxies=None):
+        self.MaxPerHost = max(1, int(max_per_host))
+        self.ConnectTimeout = connect_timeout
+        self.ReadTimeout = read_timeout
+        self.Resolver = resolver
+        self.Proxies = urllib.request.getproxies() if proxies is None else proxies
+        self.ConnectionsOpened = 0
+        self.ConnectionsReused = 0
+        self._lock = threading.Lock()
+        self._idle = {}  # Host key -> list of idle connections
+        self._slots = {}  # Host key -> semaphore limiting the connections to that host
+        self._sessions = {}  # Host key -> TLS session to resume
+        self._proxies = {}  # Host key -> proxy of the host (see get_proxy())
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def host_key(url):
+        # Connections can only be shared by URLs with the same scheme, host, port and SSL context.
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("unknown url type: {0}".format(url))
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        return parts.scheme, parts.hostname.lower(), port, "tethys" in url
+
+    def acquire(self, url):
+        """
+        # Returns a connection for the URL's host - an idle one if there is one, otherwise a new one.
+        # Blocks while the host already has max_per_host connections in use.
+        """
+        key = self.host_key(url)
+        with self._lock:
+            slots = self._slots.get(key)
+            if slots is None:
+                slots = self._slots[key] = threading.BoundedSemaphore(self.MaxPerHost)
+        slots.acquire()
+
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.Reused = True
+                self.ConnectionsReused += 1
+                return conn
+            self.ConnectionsOpened += 1
+            tls_session = self._sessions.get(key)
+            if key not in self._proxies:
+                self._proxies[key] = get_proxy(url, self.Proxies)
+            proxy = self._proxies[key]
+
+        scheme, host, port, unverified = key
+        timeouts = {"connect_timeout": self.ConnectTimeout, "read_timeout": self.ReadTimeout}
+        connectHost, connectPort = (host, port) if proxy is None else proxy[:2]
+        if scheme == "https":
+            conn = PooledHTTPSConnection(connectHost, connectPort, context=get_ssl_context(url),
+                                         tls_session=tls_session, **timeouts)
+            if proxy is not None:
+                conn.set_tunnel(host, port, headers=proxy[2])
+        else:
+            conn = PooledHTTPConnection(connectHost, connectPort, **timeouts)
+            if proxy is not None:
+                conn.AbsoluteURI = True
+                conn.ProxyHeaders = proxy[2]
+        if self.Resolver is not None and proxy is None:
+            # The preflight only knows the addresses of the hosts themselves - a proxy is resolved as usual.
+            conn._create_connection = self.Resolver.create_connection
+        conn.HostKey = key
+        return conn
+
+    def release(self, conn, reusable):
+        """
+        # Gives the connection back to the pool.  Connections that can not be reused (the response was not fully
+        # read, the server asked to close it, or an error happened) are closed instead.
+        """
+        key = conn.HostKey
+        with self._lock:
+            sock = conn.sock
+            if sock is not None and getattr(sock, "session", None) is not None:
+                # Remember the TLS session so the next new connection to this host can resume it.
+                self._sessions[key] = sock.session
+            if reusable and sock is not None and not self._closed:
+                self._idle.setdefault(key, []).append(conn)
+            else:
+                conn.close()
+        self._slots[key].release()
+
+    def close(self):
+        # Closes every idle connection.  Connections released after this are closed instead of kept.
+        with self._lock:
+            self._closed = True
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
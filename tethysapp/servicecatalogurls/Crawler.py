@@ -0,0 +1,94 @@
+"""
+# Initial Creation:
+#   Headless crawler - checks the Service Catalog on a schedule, without the web app.
+# General Description:
+#   Replaces the old __main__ block of QueryCatalog.py (which only printed the dummy test results).  Each crawl runs
+#   a check of "All" regions (fanned out by region, see QueryCatalog.ProcessRegions()) - or of the regions passed in -
+#   exactly as the queryresult page would, and saves its results as a timestamped snapshot in the app workspace (see
+#   Snapshots.py), which the queryresult page then serves right away.
+#
+#   Run it once (e.g. from cron), or have it keep crawling every N minutes.  From the folder holding tethysapp/, run:
+#       python -m tethysapp.servicecatalogurls.Crawler [--region ID ...] [--every MINUTES] [--deadline SECONDS] ...
+#   (python -m tethysapp.servicecatalogurls.Crawler --help lists every option.)
+"""
+import argparse
+import sys
+import time
+
+from .QueryCatalog import CheckSettings, CHECK_BACKEND_THREADS, CHECK_BACKEND_ASYNCIO, capture_exception
+from .CheckJobs import CheckJob, JOB_FINISHED
+from .Snapshots import save_snapshot
+from .Tracing import trace_mode
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+
+def log_entries(title, entries):
+    # Logs every field of every entry (what the old __main__ block of QueryCatalog.py did).
+    for entry in entries:
+        Logfile.info("------------ {0} ----------------------".format(title))
+        for field in (entry.Status, entry.Region, entry.ServiceArea, entry.Title, entry.ID, entry.Section,
+                      entry.SectionEntry, entry.URL):
+            Logfile.info("{0}".format(field))
+
+
+def crawl(region_id, settings=None, run_deadline=None, trace=None, print_entries=False):
+    """
+    # Runs one check of the region (region_id "" for "All") and saves its snapshot.  Returns the path of the snapshot,
+    # or None if the run failed.
+    """
+    Logfile.info("Crawling region '{0}'.".format(region_id or "All"))
+    job = CheckJob(region_id, settings, run_deadline, trace)
+    job.run()
+    if job.State != JOB_FINISHED:
+        Logfile.error("Crawl of region '{0}' failed: {1}".format(region_id or "All", job.Error))
+        return None
+    if print_entries:
+        log_entries("Invalid URL", job.ErrURLs)
+        log_entries("Invalid Catalog", job.ErrCatalogs)
+    try:
+        return save_snapshot(job)
+    except OSError:
+        error = capture_exception()
+        Logfile.error(error)
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="Crawler", description="Checks the SERVIR Service Catalog URLs and saves "
+                                     "the results as snapshots for the queryresult page.")
+    parser.add_argument("--region", nargs="+", default=[""],
+                        help="region IDs to crawl, one run each (default: all regions in a single run)")
+    parser.add_argument("--every", type=float, default=None,
+                        help="keep crawling, starting a new crawl every this many minutes (default: crawl once)")
+    parser.add_argument("--deadline", type=int, default=None, help="most seconds each run may take (default: none)")
+    parser.add_argument("--backend", choices=(CHECK_BACKEND_THREADS, CHECK_BACKEND_ASYNCIO), default=None,
+                        help="URL checker backend (default: the app's)")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+                        help="check every URL again, ignoring the status cache")
+    parser.add_argument("--trace", default=None, help="trace the runs: 1, cprofile or sample (see Tracing.py)")
+    parser.add_argument("--print", dest="print_entries", action="store_true", help="log every invalid entry found")
+    options = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    settings = CheckSettings(backend=options.backend, use_cache=options.use_cache)
+    regions = [region.strip() for region in options.region]
+
+    failed = False
+    while True:
+        crawlStart = time.time()
+        for region_id in regions:
+            if crawl(region_id, settings, options.deadline, trace_mode(options.trace), options.print_entries) is None:
+                failed = True
+        if options.every is None:
+            return 1 if failed else 0
+
+        # The next crawl starts every minutes after this one started (right away if this one took longer).
+        wait = max(0, crawlStart + options.every * 60 - time.time())
+        Logfile.info("Next crawl in {0:.0f} seconds.".format(wait))
+        time.sleep(wait)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,217 @@
+"""
+# Initial Creation:
+#   Host-level preflight of the URL checks - DNS resolution and TCP reachability of every host, in parallel.
+# General Description:
+#   The catalog's hundreds of URLs point to a few dozen hosts, but every URL check used to look its host name up
+#   again, and a host name that does not exist (or a server refusing connections) was found out once per URL.
+#   Before the HTTP checks start, QueryCatalog.ProcessURLs() hands the URLs to be fetched to HostPreflight.run(),
+#   which
+#       - resolves every new host name at the same time, into a DNS cache kept for the whole run
+#       - opens (and closes again) one TCP connection to every new host and port, also at the same time
+#   The URLs of a host whose name does not exist (NXDOMAIN) or that refuses the connection are reported as "down"
+#   right away, without an HTTP request.  Any other preflight failure (a timeout, a temporary DNS error) is left to
+#   the HTTP checks themselves, which retry and have a circuit breaker per host (see HostScheduler.py).
+#
+#   The HTTP checks then connect to the cached addresses (see create_connection() and ConnectionPool.py, or
+#   AsyncChecker.fetch_status_code()), so a host name is never resolved more than once in a run - a host that only
+#   shows up after a redirect is resolved on its first use and cached as well.
+#
+#   URLs that go through a proxy (HTTP_PROXY, HTTPS_PROXY - see ConnectionPool.get_proxy()) are not preflighted: the
+#   proxy resolves and connects to their hosts, which may well not be reachable (or even known) from here.
+"""
+import socket
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from .ConnectionPool import get_proxy
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+# Threads used to resolve and probe the hosts at the same time.
+DEFAULT_PREFLIGHT_WORKERS = 32
+
+# Seconds each TCP probe waits for its connection.  Kept short: a host that does not answer in time is not reported
+# as down, it is just left to the HTTP checks.
+PREFLIGHT_CONNECT_TIMEOUT = 3
+
+# Codes reported for the URLs of the hosts that failed the preflight.
+HOST_NOT_FOUND_CODE = "HOST NOT FOUND (DNS)"
+CONNECTION_REFUSED_CODE = "CONNECTION REFUSED"
+
+# getaddrinfo() errors that mean the name does not exist, rather than that the lookup failed for now.
+_NOT_FOUND_ERRORS = tuple(getattr(socket, name) for name in ("EAI_NONAME", "EAI_NODATA") if hasattr(socket, name))
+
+
+def host_port(url):
+    # Returns the (host name, port) a URL connects to - or None if it is not an http(s) URL.
+    try:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            return None
+        return parts.hostname.lower(), parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        return None
+
+
+class HostPreflight(object):
+    """
+    # Thread safe DNS cache and TCP reachability of the hosts of one run (see above).  A HostPreflight is shared by
+    # all of the checks of a run - including every region of a fan-out run, so each host is only looked at once.
+    # Host names are looked up with the getaddrinfo passed in, and proxies are as for ConnectionPool.get_proxy().
+    """
+
+    def __init__(self, connect_timeout=PREFLIGHT_CONNECT_TIMEOUT, max_workers=DEFAULT_PREFLIGHT_WORKERS,
+                 getaddrinfo=socket.getaddrinfo, proxies=None):
+        self.ConnectTimeout = connect_timeout
+        self.MaxWorkers = max(1, int(max_workers))
+        self.Proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._getaddrinfo = getaddrinfo
+        self.Resolved = 0  # Host names looked up
+        self._lock = threading.Lock()
+        self._addresses = {}  # Host name -> list of (family, socket type, protocol, address) of the host
+        self._failures = {}  # (host name, port) -> code reported for its URLs
+        self._probed = set()  # (host name, port) already probed
+
+    def lookup(self, host):
+        # Returns the cached addresses of the host name, or None if it has not been resolved (successfully).
+        with self._lock:
+            return self._addresses.get(host.lower())
+
+    def remember(self, host, infos):
+        # Caches the result of a getaddrinfo() call for the host name.
+        addresses = [(family, socktype, proto, sockaddr) for family, socktype, proto, canonname, sockaddr in infos]
+        with self._lock:
+            self._addresses[host.lower()] = addresses
+            self.Resolved += 1
+        return addresses
+
+    def resolve(self, host):
+        # Returns the addresses of the host name - from the cache if it has been resolved already.
+        addresses = self.lookup(host)
+        if addresses is None:
+            addresses = self.remember(host, self._getaddrinfo(host, None, type=socket.SOCK_STREAM))
+        return addresses
+
+    def failure(self, url):
+        # Returns the code to report for the URL if its host failed the preflight, otherwise None.
+        key = host_port(url)
+        with self._lock:
+            return self._failures.get(key)
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """
+        # Drop-in replacement for socket.create_connection() (see ConnectionPool.py) that connects to the cached
+        # addresses of the host - in the order the preflight found them to work - instead of resolving it again.
+        """
+        host, port = address
+        error = None
+        for family, socktype, proto, sockaddr in self.resolve(host):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect((sockaddr[0], port) + tuple(sockaddr[2:]))
+                return sock
+            except OSError as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        raise error if error is not None else OSError("getaddrinfo returns an empty list")
+
+    def _resolve_host(self, host):
+        # Preflight DNS step of one host name.  Returns its addresses - or None if the name does not exist, and an
+        # empty tuple if it could not be looked up for some other reason.
+        try:
+            return self.resolve(host)
+        except socket.gaierror as e:
+            if e.errno in _NOT_FOUND_ERRORS:
+                return None
+            Logfile.debug("Preflight: looking up {0} failed for now ({1}).".format(host, e))
+            return ()
+        except (OSError, UnicodeError) as e:
+            Logfile.debug("Preflight: looking up {0} failed ({1}).".format(host, e))
+            return ()
+
+    def _probe(self, host, port):
+        # Preflight TCP step of one host and port.  Returns True unless every address refused the connection.
+        # The address that answered is moved to the front of the cache, so the HTTP checks try it first.
+        addresses = self.lookup(host) or []
+        refused = 0
+        for address in addresses:
+            family, socktype, proto, sockaddr = address
+            try:
+                with socket.socket(family, socktype, proto) as sock:
+                    sock.settimeout(self.ConnectTimeout)
+                    sock.connect((sockaddr[0], port) + tuple(sockaddr[2:]))
+                with self._lock:
+                    # A new list - the HTTP checks may be going through the old one.
+                    self._addresses[host] = [address] + [other for other in self._addresses[host] if other != address]
+                return True
+            except ConnectionRefusedError:
+                refused += 1
+            except OSError:
+                pass
+        return not addresses or refused < len(addresses)
+
+    def run(self, urls, deadline=None):
+        """
+        # Resolves the hosts of the URLs passed in, and probes their ports, all at the same time.  Hosts that have
+        # been looked at already (by an earlier call) and URLs that go through a proxy are skipped.  Returns the
+        # number of hosts and ports that failed.
+        # Stops waiting at the deadline (a time.time() value), if one is passed in - the unfinished steps are then
+        # treated as passed.
+        """
+        if self.Proxies:
+            urls = [url for url in urls if get_proxy(url, self.Proxies) is None]
+        with self._lock:
+            keys = set(key for key in map(host_port, urls) if key is not None and key not in self._probed)
+            self._probed.update(keys)
+        if not keys:
+            return 0
+
+        timeStart = time.time()
+        hosts = set(host for host, port in keys)
+        executor = ThreadPoolExecutor(max_workers=min(self.MaxWorkers, len(keys)))
+        try:
+            # DNS first (one lookup per host name), then the TCP probes of the hosts that were found.
+            Dict_Lookups = dict((host, executor.submit(self._resolve_host, host)) for host in hosts)
+            Dict_Probes = {}
+            for (host, port) in keys:
+                addresses = self._result(Dict_Lookups[host], deadline, ())
+                if addresses is None:
+                    self._fail((host, port), HOST_NOT_FOUND_CODE)
+                elif addresses:
+                    Dict_Probes[(host, port)] = executor.submit(self._probe, host, port)
+            for key, future in Dict_Probes.items():
+                if not self._result(future, deadline, True):
+                    self._fail(key, CONNECTION_REFUSED_CODE)
+        finally:
+            # Steps still running at the deadline are left to finish in the background.
+            executor.shutdown(wait=deadline is None)
+
+        with self._lock:
+            failed = sum(key in self._failures for key in keys)
+        Logfile.info("Preflight: {0} hosts, {1} host/port pairs probed, {2} failed ({3:.1f} seconds).".format(
+            len(hosts), len(keys), failed, time.time() - timeStart))
+        return failed
+
+    @staticmethod
+    def _result(future, deadline, default):
+        # The result of a preflight step - or the default if the deadline passes first.
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        try:
+            return future.result(timeout)
+        except Exception:
+            return default
+
+    def _fail(self, key, code):
+        Logfile.error("### PREFLIGHT ### {0}:{1} - {2}, its URLs are reported as down.".format(key[0], key[1], code))
+        with self._lock:
+            self._failures[key] = code
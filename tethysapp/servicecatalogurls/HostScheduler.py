@@ -0,0 +1,331 @@
+"""
+# Initial Creation:
+#   Per-host politeness for the URL checks - rate limits, a concurrency cap, and Retry-After.
+# General Description:
+#   Catalog links are bunched on a few partner hub sites, and the checks used to be started in catalog order - so a
+#   run could hit dozens of pages of one hub in a row, and the hub would throttle or block us (false 403/429 "down"
+#   results).  HostScheduler keeps the pending checks grouped by host and hands them out round-robin: the next check
+#   always goes to the host that was served least recently and is allowed another request.  Each host has
+#       - a token bucket: on average no more than rate checks a second, with bursts of no more than burst checks
+#       - a cap on the number of its checks running at the same time (max_per_host)
+#       - a pause, set when the host answers 429 (Too Many Requests) or 503 (Service Unavailable) with a
+#         Retry-After header - none of its checks start again before then
+#   Checks of other hosts carry on in the meantime, so the run as a whole stays fast while no single host sees a
+#   burst.
+#
+#   It also decides what happens after a check could not reach its host at all (see is_connection_failure()):
+#       - a transient error (connection reset or aborted, timeout) is tried again, up to retries times, after an
+#         exponential backoff with jitter - 0.5, 1, 2 ... seconds, each somewhere between half and all of that
+#       - every host has a circuit breaker: after breaker_threshold connection failures in a row (with no answer from
+#         the host in between), the breaker opens and the rest of the host's URLs are reported as "HOST UNREACHABLE"
+#         without another network attempt.  A hub that is down for the day then costs a few timeouts instead of one
+#         per URL.
+#
+#   The threads backend (CheckEngine.URLCheckEngine) takes its work from put()/get().  The asyncio backend
+#   (AsyncChecker.AsyncURLCheckEngine) keeps its own tasks and asks try_acquire() before each check.
+"""
+import asyncio
+import email.utils
+import heapq
+import itertools
+import random
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict, deque
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+# Default per-host limits: checks started per second (on average), and largest burst of checks.  The cap on checks
+# running at the same time is the connection pool's max_per_host (see QueryCatalog.NewCheckEngine()).
+DEFAULT_HOST_RATE = 5
+DEFAULT_HOST_BURST = 5
+
+# Status codes whose Retry-After header pauses the host.
+BUSY_CODES = (429, 503)
+
+# Longest Retry-After (in seconds) that is waited out - a host asking for more is reported with its status code.
+MAX_RETRY_AFTER = 120
+
+# Times a check is put back in line after its host answered "busy", before its status code is reported.
+MAX_BUSY_RETRIES = 2
+
+# Times a check is tried again after a transient error (see is_transient()), and the backoff before each try: the
+# first waits up to BACKOFF_BASE seconds, and every one after that up to twice as long as the one before (never more
+# than BACKOFF_MAX seconds).
+MAX_TRANSIENT_RETRIES = 2
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+
+# Connection failures in a row that open a host's circuit breaker, and the code reported for the URLs of the host
+# that are not tried once it is open.
+BREAKER_THRESHOLD = 5
+HOST_UNREACHABLE_CODE = "HOST UNREACHABLE"
+
+# How long (in seconds) an asyncio check waits before asking again when its host has no free slot.
+SLOT_POLL_SECONDS = 0.05
+
+
+class HostBusy(Exception):
+    """
+    # Raised by a check when the host answered 429/503 with a Retry-After header (see QueryCatalog.get_site_status()).
+    """
+
+    def __init__(self, code, retry_after):
+        super(HostBusy, self).__init__("{0} - retry after {1} seconds".format(code, retry_after))
+        self.Code = code
+        self.RetryAfter = retry_after
+
+
+def parse_retry_after(value):
+    # Returns the number of seconds a Retry-After header value (seconds, or an HTTP date) asks to wait - or None if
+    # there is no (valid) value.
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        retryAt = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retryAt is None:
+        return None
+    return max(0, retryAt.timestamp() - time.time())
+
+
+def is_connection_failure(code):
+    """
+    # True if the code of a "down" result is an error reaching the host (refused, reset, timed out, host name not
+    # found...) rather than an answer from it.  TLS errors do not count - the host is there, its certificate is not.
+    """
+    return isinstance(code, (OSError, asyncio.IncompleteReadError)) and not isinstance(code, ssl.SSLError)
+
+
+def is_transient(code):
+    # True if the connection failure is one that often goes away when the request is simply sent again.
+    if isinstance(code, ConnectionRefusedError):
+        return False
+    return isinstance(code, (ConnectionError, socket.timeout, TimeoutError, asyncio.IncompleteReadError))
+
+
+def backoff_delay(attempt):
+    # Seconds to wait before the retry after the attempt passed in (0 for the first one) - exponential, with jitter.
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def host_of(url):
+    # The politeness key of a URL - its host name, whatever the scheme or port.
+    try:
+        return (urllib.parse.urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class TokenBucket(object):
+    """
+    # Classic token bucket: holds up to burst tokens and gains rate tokens a second.  Not thread safe on its own -
+    # HostScheduler only uses it under its lock.  now is the clock's time the bucket starts full at.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.Rate = rate
+        self.Burst = max(1, burst)
+        self.Tokens = float(self.Burst)
+        self.Updated = now
+
+    def take(self, now):
+        # Takes a token and returns 0, or returns the number of seconds until a token is available.
+        self.Tokens = min(self.Burst, self.Tokens + (now - self.Updated) * self.Rate)
+        self.Updated = now
+        if self.Tokens >= 1:
+            self.Tokens -= 1
+            return 0
+        return (1 - self.Tokens) / self.Rate
+
+
+class HostScheduler(object):
+    """
+    # Thread safe per-host scheduler of the URL checks (see above).  A rate of None means there is no rate limit, and
+    # a max_per_host of None means there is no cap on the checks of a host running at the same time.  A
+    # breaker_threshold of None turns the circuit breakers off.  clock returns the time (in seconds) the rates, pauses
+    # and retry delays are measured by - time.monotonic(), unless a test passes in its own.
+    """
+
+    def __init__(self, rate=DEFAULT_HOST_RATE, burst=DEFAULT_HOST_BURST, max_per_host=None,
+                 retries=MAX_TRANSIENT_RETRIES, breaker_threshold=BREAKER_THRESHOLD, clock=time.monotonic):
+        self.Rate = rate
+        self.Burst = burst
+        self.MaxPerHost = max_per_host
+        self.Retries = retries
+        self.BreakerThreshold = breaker_threshold
+        self._clock = clock
+        self.Paused = 0  # Number of times a host was paused by a Retry-After.
+        self.Retried = 0  # Number of checks tried again after a transient error.
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # Host -> deque of its pending items, least recently served host first.
+        self._delayed = []  # Heap of (clock time it is due, sequence, host, item) of the retries.
+        self._sequence = itertools.count()
+        self._failures = {}  # Host -> connection failures in a row
+        self._unreachable = set()  # Hosts whose circuit breaker is open
+        self._buckets = {}  # Host -> TokenBucket
+        self._running = {}  # Host -> number of its checks running
+        self._pausedUntil = {}  # Host -> clock time its checks may start again
+        self._closed = False
+
+    def _acquire(self, host, now):
+        # Returns 0 if a check of the host may start now (and counts it as running), otherwise the number of seconds
+        # to wait before asking again - or None if it has to wait for one of the host's running checks to finish.
+        # Must be called under the lock.
+        pausedUntil = self._pausedUntil.get(host, 0)
+        if now < pausedUntil:
+            return pausedUntil - now
+        if self.MaxPerHost is not None and self._running.get(host, 0) >= self.MaxPerHost:
+            return None
+        if self.Rate is not None:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.Rate, self.Burst, now)
+            wait = bucket.take(now)
+            if wait:
+                return wait
+        self._running[host] = self._running.get(host, 0) + 1
+        return 0
+
+    def try_acquire(self, host):
+        """
+        # Returns 0 if a check of the host may start now, otherwise the number of seconds to wait before asking again.
+        # Every successful call must be followed by a release() once the check has finished.
+        """
+        with self._cond:
+            wait = self._acquire(host, self._clock())
+        return SLOT_POLL_SECONDS if wait is None else wait
+
+    def release(self, host):
+        # Called when a check of the host has finished.
+        with self._cond:
+            self._running[host] -= 1
+            self._cond.notify()
+
+    def pause(self, host, seconds):
+        # Starts no check of the host for the number of seconds passed in (e.g. from a Retry-After header).
+        with self._cond:
+            self._pausedUntil[host] = max(self._pausedUntil.get(host, 0), self._clock() + seconds)
+            self.Paused += 1
+
+    def unreachable(self, host):
+        # True once the host's circuit breaker is open - its checks are reported without a network attempt.
+        with self._cond:
+            return host in self._unreachable
+
+    def unreachable_hosts(self):
+        with self._cond:
+            return sorted(self._unreachable)
+
+    def retry_delay(self, host, status, code, attempt):
+        """
+        # Called with the (status, code) result of every check of the host that was made over the network.  Keeps
+        # count of the host's connection failures in a row (and opens its circuit breaker), and returns the number of
+        # seconds to wait before the check is tried again - or None if the result stands.  attempt is the number of
+        # times the check has been tried again already.
+        """
+        if status != "down" or not is_connection_failure(code):
+            if status in ("up", "down"):
+                # The host answered.
+                with self._cond:
+                    self._failures[host] = 0
+            return None
+
+        with self._cond:
+            failures = self._failures[host] = self._failures.get(host, 0) + 1
+            if (self.BreakerThreshold is not None and failures >= self.BreakerThreshold and
+                    host not in self._unreachable):
+                self._unreachable.add(host)
+                Logfile.error("### HOST UNREACHABLE ### {0} failed {1} times in a row ({2}) - its other URLs will not "
+                              "be tried.".format(host, failures, code))
+                # Its checks waiting in line can be settled right away.
+                self._cond.notify_all()
+            if host in self._unreachable or not is_transient(code) or attempt >= self.Retries:
+                return None
+            self.Retried += 1
+        return backoff_delay(attempt)
+
+    def put(self, host, item, delay=0):
+        # Adds an item (a pending check) to the host's line - after delay seconds, if one is passed in.
+        with self._cond:
+            if delay > 0:
+                heapq.heappush(self._delayed, (self._clock() + delay, next(self._sequence), host, item))
+            else:
+                self._queues.setdefault(host, deque()).append(item)
+            self._cond.notify()
+
+    def _release_delayed(self, now):
+        # Moves the items whose delay is over into their hosts' lines, and returns the number of seconds until the next
+        # one is due (None if there are none).  Must be called under the lock.
+        while self._delayed and (self._delayed[0][0] <= now or self._delayed[0][2] in self._unreachable):
+            readyAt, sequence, host, item = heapq.heappop(self._delayed)
+            self._queues.setdefault(host, deque()).append(item)
+        return self._delayed[0][0] - now if self._delayed else None
+
+    def get(self, deadline=None):
+        """
+        # Blocks until a check may start and returns its (host, item) - the first item of the least recently served
+        # host that is allowed another check.  Returns None once the scheduler is closed and every line is empty.
+        # Once the deadline (a time.time() value) has passed, the limits no longer apply, so the pending checks can
+        # be handed out (and reported as not checked) right away.  The same goes for the checks of a host whose
+        # circuit breaker is open.
+        """
+        with self._cond:
+            while True:
+                now = self._clock()
+                pastDeadline = deadline is not None and time.time() >= deadline
+                # Past the deadline, the retries still waiting out their backoff are handed out too.
+                nextDelayed = self._release_delayed(float("inf") if pastDeadline else now)
+                if not self._queues:
+                    if self._closed and nextDelayed is None:
+                        return None
+                    if nextDelayed is not None and deadline is not None:
+                        nextDelayed = min(nextDelayed, max(0, deadline - time.time()))
+                    self._cond.wait(nextDelayed)
+                    continue
+
+                shortestWait = nextDelayed
+                for host in self._queues:
+                    if pastDeadline or host in self._unreachable:
+                        self._running[host] = self._running.get(host, 0) + 1
+                        wait = 0
+                    else:
+                        wait = self._acquire(host, now)
+                    if wait == 0:
+                        queue = self._queues.pop(host)
+                        item = queue.popleft()
+                        if queue:
+                            # Back in line behind every other host.
+                            self._queues[host] = queue
+                        return host, item
+                    if wait is not None and (shortestWait is None or wait < shortestWait):
+                        shortestWait = wait
+
+                if deadline is not None:
+                    untilDeadline = max(0, deadline - time.time())
+                    shortestWait = untilDeadline if shortestWait is None else min(shortestWait, untilDeadline)
+                self._cond.wait(shortestWait)
+
+    def drain(self):
+        # Drops every item still waiting in line and returns them, so the caller can settle them.
+        with self._cond:
+            pending = [item for queue in self._queues.values() for item in queue]
+            pending.extend(item for readyAt, sequence, host, item in self._delayed)
+            self._queues.clear()
+            del self._delayed[:]
+        return pending
+
+    def close(self):
+        # No more items will be added - get() returns None once every line is empty.
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
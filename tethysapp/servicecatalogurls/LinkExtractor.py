@@ -0,0 +1,186 @@
+"""
+# Initial Creation:
+#   Link extraction engine for the Data, Tools, News, and Training Materials fields of the Service Catalog.
+# General Description:
+#   The category fields are multiline markup text.  QueryCatalog.GetURLs_FromString() used to build its regular
+#   expression on every call and only found "[name](http...)" links - a URL with parentheses in it (Wikipedia, some
+#   GIS portals) was cut off at the first ")", and bare URLs or reference-style links were skipped without a word.
+#
+#   The single regular expression here is compiled once, when the module is loaded, and finds all of these:
+#       [name](https://site.com/page_(with)_parens)     inline links (balanced parentheses, optional "title")
+#       [name][ref]  /  [name][]   ...   [ref]: https://site.com/page     reference links and their definitions
+#       https://site.com/page   or   <https://site.com/page>              bare URLs and autolinks
+#   extract_service_links() scans the fields of a service in one pass: the fields are joined into one string, and the
+#   separator between them is one more thing the regular expression matches.
+#
+#   That regular expression is several times slower than the old one, so it is kept off the fast path: a field whose
+#   links are all plain "[name](http...)" links - the only kind the old function found, so most of the catalog - is
+#   handled by a lean regular expression of the same shape as the old one (see _plain_links()), and only the other
+#   fields go through the full scan.
+#
+#   See benchmarks/link_extraction.py for a comparison with the old function.
+"""
+import re
+
+# Joins the fields of a service for the single pass.  The NUL can never be part of a link.  The line breaks around it
+# end every field on a line of its own, and start every field on a new line even once the regular expression has
+# matched the NUL and the line break after it (the reference definitions need both).
+FIELD_SEPARATOR = "\n\x00\n\n"
+
+# The rest of a URL after "http://".  It may hold parentheses, as long as they are balanced (nested up to two deep).
+# Written as an "unrolled loop" - runs of plain characters, each broken only by a parenthesized part - so the engine
+# consumes plain characters in bulk and never has to backtrack through more than one way of matching the same URL.
+_URL_CHAR = r"[^\s()<>\x00]"
+_URL_TAIL = (_URL_CHAR + r"*(?:\(" + _URL_CHAR + r"*(?:\(" + _URL_CHAR + r"*\)" + _URL_CHAR + r"*)*\)" +
+             _URL_CHAR + r"*)*")
+
+# Every alternative starts with a plain character ("[", line break, "<", "h" or NUL) rather than a group or an
+# anchor.  That lets the engine skip straight to the next of those characters instead of trying every alternative at
+# every position of the text - which is also why the bare url group leaves out its leading "h".
+_LINK_REGEX = re.compile(r"""
+    # [name] followed by one of
+      \[(?P<name>[^\]\x00]+)\](?:
+        # (url "optional title")
+          \(\s*<?(?P<inline_url>https?://""" + _URL_TAIL + r""")>?(?:\s+(?:"[^"\x00]*"|'[^'\x00]*'|\([^)\x00]*\)))?\s*\)
+        # (url with spaces or other oddities) - everything up to the first ")", like the old regex did.
+        | \(\s*(?P<loose_url>https?://[^)\x00]+?)\s*\)
+        # [ref]  or  []
+        | [ ]?(?P<ref>\[[^\]\x00]*\])(?![(:])
+      )
+    # [ref]: url "optional title"  (reference definition, on a line of its own)
+    | \n[ ]{0,3}\[(?P<def_ref>[^\]\x00]+)\]:[ \t]*<?(?P<def_url>https?://[^\s<>\x00]+?)>?
+        (?:[ \t]+(?:"[^"\n\x00]*"|'[^'\n\x00]*'|\([^)\n\x00]*\)))?[ \t]*$
+    # <url>  or a bare url
+    | <(?P<auto_url>https?://[^\s<>\x00]+)>
+    | h(?P<bare_url>ttps?://(?=[^\s)<>\x00])""" + _URL_TAIL + r""")
+    # The end of a field
+    | \x00(?P<separator>\n)
+""", re.VERBOSE | re.MULTILINE)
+
+# "[name](url)" with nothing else in the parentheses, and no parentheses in the URL.  The same shape as the old regular
+# expression - none of the optional parts and nested repeats that make _LINK_REGEX slow.
+_PLAIN_LINK_REGEX = re.compile(r"\[([^]]+)]\((https?://[^\s()<>\x00]+)\)")
+
+# Punctuation at the end of a bare URL that almost always belongs to the sentence, not the URL.
+_TRAILING_PUNCTUATION = ".,;:!?'\""
+
+
+def _trim_bare_url(url):
+    # Drops sentence punctuation, and a closing parenthesis that has no opening one, from the end of a bare URL.
+    while url:
+        if url[-1] in _TRAILING_PUNCTUATION:
+            url = url[:-1]
+        elif url[-1] == ")" and url.count(")") > url.count("("):
+            url = url[:-1]
+        else:
+            break
+    return url
+
+
+def _normalize_ref(ref):
+    # Reference labels are matched case-insensitively, ignoring extra spaces.
+    return " ".join(ref.split()).lower()
+
+
+def _scan(text, sections):
+    """
+    # Runs the one regular expression over the text - the fields joined with FIELD_SEPARATOR, after a line break.
+    # sections holds the section of each field.  Returns a list of [section, name, URL] entries in the order they
+    # appear.
+    """
+    found = []  # [section, name, URL] - the URL of a reference link is None until it is resolved.
+    references = []  # (index in found, reference key) of each reference link
+    definitions = {}  # reference key -> (URL, index in found of the definition)
+    field = 0
+    section = sections[0]
+    for (name, inline_url, loose_url, ref, def_ref, def_url, auto_url, bare_url,
+         separator) in _LINK_REGEX.findall(text):
+        if inline_url:
+            found.append([section, name, inline_url])
+        elif bare_url:
+            url = _trim_bare_url("h" + bare_url)
+            found.append([section, url, url])
+        elif separator:
+            field += 1
+            section = sections[field]
+        elif loose_url:
+            found.append([section, name, loose_url])
+        elif auto_url:
+            found.append([section, auto_url, auto_url])
+        elif def_url:
+            key = (field, _normalize_ref(def_ref))
+            if key not in definitions:
+                # First definition wins.  It is only reported by itself if no link uses it.
+                definitions[key] = (def_url, len(found))
+                found.append([section, def_ref, def_url])
+        else:
+            references.append((len(found), (field, _normalize_ref(ref[1:-1] or name))))
+            found.append([section, name, None])
+
+    if not references:
+        return found
+
+    # Resolve the reference links now that every definition has been seen (definitions usually come last).  A link
+    # without a definition is dropped, and so is a definition that is used by a link (the link is reported instead).
+    used = set()
+    for idx, key in references:
+        if key in definitions:
+            url, defIdx = definitions[key]
+            found[idx][2] = url
+            used.add(defIdx)
+    return [link for idx, link in enumerate(found) if link[2] is not None and idx not in used]
+
+
+def _plain_links(section, text):
+    """
+    # The fast path.  Returns the field's links as [section, name, URL] entries if they are all plain "[name](url)"
+    # links, or None if the field needs the full scan.  Every kind of link the full scan finds has a "://" of its own
+    # (a reference link only counts once a definition has given it a URL), so when there are as many plain links as
+    # "://" in the field, the plain links are all there is - and _LINK_REGEX would have matched them the same way.
+    """
+    urlCount = text.count("://")
+    # Every plain link has a "](http" too - a field with fewer of those is left to the full scan without trying.
+    if text.count("](http") < urlCount or "\x00" in text:
+        return None
+    links = _PLAIN_LINK_REGEX.findall(text)
+    if len(links) != urlCount:
+        return None
+    return [[section, name, url] for name, url in links]
+
+
+def extract_links(text):
+    """
+    # Returns the links found in one field as a list of [name, URL] entries - either empty or with some items.
+    """
+    return [[name, url] for section, name, url in extract_service_links([(None, text)])]
+
+
+def extract_service_links(fields):
+    """
+    # Finds the links in all of a service's fields - the fields that need the full scan are scanned in one pass.
+    # fields is a list of (section, text) entries - e.g. ("DATA", the Data field).  Returns a list of [section, name,
+    # URL] entries, in field order and then in the order the links appear in each field.
+    """
+    found = []  # The links of each field with any - None until the full scan for the fields that need it
+    scanFields = []  # (index in found, section, text) of the fields that need the full scan
+    for section, text in fields:
+        if not text or "://" not in text:
+            continue
+        links = _plain_links(section, text)
+        if links is None:
+            scanFields.append((len(found), section, text))
+        found.append(links)
+
+    if scanFields:
+        scanText = "\n" + FIELD_SEPARATOR.join(fieldText for idx, section, fieldText in scanFields)
+        if len(scanFields) == len(found):
+            return _scan(scanText, [section for idx, section, fieldText in scanFields])
+        # Some fields took the fast path.  The sections given to _scan() are then the positions in scanFields, to put
+        # every link back in its own field.
+        for idx, section, fieldText in scanFields:
+            found[idx] = []
+        for link in _scan(scanText, range(len(scanFields))):
+            idx, section = scanFields[link[0]][:2]
+            link[0] = section
+            found[idx].append(link)
+    return [link for links in found for link in links]
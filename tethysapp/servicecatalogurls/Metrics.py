@@ -0,0 +1,321 @@
+"""
+# Initial Creation:
+#   Latency metrics of the URL checks - per URL, per host and per run - and their Prometheus endpoint.
+# General Description:
+#   The run's log only said how long the whole run took, not which partner hosts the time went to.  Every check
+#   engine now keeps a RunMetrics, which records
+#       - for each URL: the seconds its check took (all of its attempts), its status and code, the body bytes read
+#         and how many times it was tried again
+#       - for each host: a histogram of the latency of every request attempt made to it
+#   At the end of a run, QueryCatalog.ReportRunMetrics() logs a summary table of the hosts that took the most time
+#   (also shown under the results, see CheckJobs.RunProgress), and adds the run to the totals of every run of the app
+#   - kept in a MetricsRegistry shared by all of the app's processes (see MetricsStore.py), and served in the
+#   Prometheus text format by controllers.metrics().
+"""
+import bisect
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets - the last bucket (+Inf) catches everything else.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+# Hosts listed in the per-run summary table (the ones that took the most time).
+SUMMARY_TOP_HOSTS = 10
+
+# Most hosts the totals keep a histogram for - the requests to any other host are counted under OTHER_HOSTS, so
+# the number of time series stays bounded however many hosts the catalog links to.
+MAX_METRIC_HOSTS = 500
+OTHER_HOSTS = "other"
+
+METRIC_PREFIX = "servicecatalogurls"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def code_label(code):
+    # The label of a status code: the HTTP status code, the code string (e.g. "HOST UNREACHABLE"), or the name of the
+    # error a check failed with - never the error's message, so there are only ever a few label values.
+    if isinstance(code, int) or isinstance(code, str):
+        return str(code)
+    if isinstance(code, BaseException):
+        return type(code).__name__
+    return "unknown"
+
+
+def percentile(values, share):
+    # The value below which the share (0 to 1) of the sorted values fall.
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class LatencyHistogram(object):
+    """
+    # Count of latencies per LATENCY_BUCKETS bucket, plus their number and sum (a Prometheus histogram).
+    """
+
+    __slots__ = ("Counts", "Count", "Sum")
+
+    def __init__(self):
+        self.Counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.Count = 0
+        self.Sum = 0.0
+
+    def observe(self, seconds):
+        self.Counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.Count += 1
+        self.Sum += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.Counts):
+            self.Counts[i] += count
+        self.Count += other.Count
+        self.Sum += other.Sum
+
+
+class URLMetric(object):
+    """
+    # What the check of one URL took: its seconds (all attempts), number of attempts, status, code and bytes read.
+    """
+
+    __slots__ = ("URL", "Host", "Seconds", "Attempts", "Status", "Code", "Bytes")
+
+    def __init__(self, url, host):
+        self.URL = url
+        self.Host = host
+        self.Seconds = 0.0
+        self.Attempts = 0
+        self.Status = None
+        self.Code = None
+        self.Bytes = 0
+
+    @property
+    def Retries(self):
+        return max(0, self.Attempts - 1)
+
+
+class RunMetrics(object):
+    """
+    # Thread safe metrics of the URL checks of one run (see above), kept by its check engine.  The engine calls
+    # attempt() for every request attempt and finish_url() with each URL's result, and get_site_status() adds the body
+    # bytes each check reads (add_bytes()).
+    """
+
+    def __init__(self):
+        self.Started = time.time()
+        self._lock = threading.Lock()
+        self._urls = {}  # URL -> URLMetric
+        self._hosts = {}  # Host -> LatencyHistogram of its request attempts
+
+    def _record(self, url, host):
+        record = self._urls.get(url)
+        if record is None:
+            record = self._urls[url] = URLMetric(url, host)
+        return record
+
+    def attempt(self, url, host, seconds):
+        # One request attempt for the URL took seconds.
+        with self._lock:
+            record = self._record(url, host)
+            record.Seconds += seconds
+            record.Attempts += 1
+            histogram = self._hosts.get(host)
+            if histogram is None:
+                histogram = self._hosts[host] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def add_bytes(self, url, n):
+        if n:
+            with self._lock:
+                self._record(url, None).Bytes += n
+
+    def finish_url(self, url, host, status, code):
+        # The final result of the URL's check (URLs never tried - unreachable host, deadline - have no attempts).
+        with self._lock:
+            record = self._record(url, host)
+            record.Host = host
+            record.Status = status
+            record.Code = code
+
+    def urls(self):
+        # Returns the URLMetric of every URL checked (finished or not).
+        with self._lock:
+            return list(self._urls.values())
+
+    def hosts(self):
+        # Returns a copy of the {host: LatencyHistogram} dictionary.
+        with self._lock:
+            return dict(self._hosts)
+
+    def host_summary(self, top=SUMMARY_TOP_HOSTS):
+        """
+        # Returns one dictionary per host - URLs, URLs down, retries, bytes read, and the total, p50, p95 and longest
+        # seconds of its URL checks - for the top hosts that took the most time in total (all of them if top is None).
+        """
+        byHost = {}
+        for record in self.urls():
+            if record.Status is not None:
+                byHost.setdefault(record.Host, []).append(record)
+        rows = []
+        for host, records in byHost.items():
+            seconds = sorted(record.Seconds for record in records)
+            rows.append({
+                "host": host,
+                "urls": len(records),
+                "down": sum(record.Status == "down" for record in records),
+                "retries": sum(record.Retries for record in records),
+                "bytes": sum(record.Bytes for record in records),
+                "seconds": round(sum(seconds), 2),
+                "p50": round(percentile(seconds, 0.5), 3),
+                "p95": round(percentile(seconds, 0.95), 3),
+                "max": round(seconds[-1], 3),
+            })
+        rows.sort(key=lambda row: row["seconds"], reverse=True)
+        return rows if top is None else rows[:top]
+
+    def summary_lines(self, top=SUMMARY_TOP_HOSTS):
+        # Returns the host summary as the lines of a text table (e.g. for the log).
+        rows = self.host_summary(top)
+        if not rows:
+            return []
+        width = max(20, max(len(row["host"] or "") for row in rows))
+        line = "{0:<{w}} {1:>7} {2:>6} {3:>7} {4:>10} {5:>9} {6:>7} {7:>7} {8:>7}"
+        lines = [line.format("Host", "URLs", "Down", "Retries", "Bytes", "Seconds", "p50", "p95", "Max", w=width)]
+        for row in rows:
+            lines.append(line.format(row["host"] or "", row["urls"], row["down"], row["retries"], row["bytes"],
+                                     row["seconds"], row["p50"], row["p95"], row["max"], w=width))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    # Thread safe totals of every run (see above), and their Prometheus rendering.  as_dict() and from_dict() turn
+    # the totals into (and back from) plain dictionaries, for MetricsStore.py to save them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.Runs = 0
+        self.LastRunSeconds = 0.0
+        self.LastRunFinished = 0.0
+        self.Retries = 0
+        self.Bytes = 0
+        self._results = {}  # (status, code label) -> number of URLs
+        self._hosts = {}  # Host -> LatencyHistogram of its request attempts
+        self._hostResults = {}  # (host, status) -> number of URLs
+
+    def _host_label(self, host):
+        # The host itself - or OTHER_HOSTS once MAX_METRIC_HOSTS hosts are already being kept.
+        host = host or OTHER_HOSTS
+        if host in self._hosts or len(self._hosts) < MAX_METRIC_HOSTS:
+            return host
+        return OTHER_HOSTS
+
+    def add_run(self, metrics):
+        # Adds the RunMetrics of a finished run to the totals.
+        now = time.time()
+        hosts = metrics.hosts()
+        records = metrics.urls()
+        with self._lock:
+            self.Runs += 1
+            self.LastRunSeconds = now - metrics.Started
+            self.LastRunFinished = now
+            for host, histogram in hosts.items():
+                self._hosts.setdefault(self._host_label(host), LatencyHistogram()).merge(histogram)
+            for record in records:
+                if record.Status is None:
+                    continue
+                key = (record.Status, code_label(record.Code))
+                self._results[key] = self._results.get(key, 0) + 1
+                key = (self._host_label(record.Host), record.Status)
+                if key[0] not in self._hosts:
+                    # A host never actually tried (e.g. unreachable) still gets its series.
+                    self._hosts[key[0]] = LatencyHistogram()
+                self._hostResults[key] = self._hostResults.get(key, 0) + 1
+                self.Retries += record.Retries
+                self.Bytes += record.Bytes
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "runs": self.Runs,
+                "last_run_seconds": self.LastRunSeconds,
+                "last_run_finished": self.LastRunFinished,
+                "retries": self.Retries,
+                "bytes": self.Bytes,
+                "results": [[status, code, count] for (status, code), count in self._results.items()],
+                "hosts": dict((host, [histogram.Counts, histogram.Count, histogram.Sum])
+                              for host, histogram in self._hosts.items()),
+                "host_results": [[host, status, count] for (host, status), count in self._hostResults.items()],
+            }
+
+    @classmethod
+    def from_dict(cls, saved):
+        # Builds the totals back from a dictionary made by as_dict().
+        registry = cls()
+        registry.Runs = saved["runs"]
+        registry.LastRunSeconds = saved["last_run_seconds"]
+        registry.LastRunFinished = saved["last_run_finished"]
+        registry.Retries = saved["retries"]
+        registry.Bytes = saved["bytes"]
+        registry._results = dict(((status, code), count) for status, code, count in saved["results"])
+        for host, (counts, count, total) in saved["hosts"].items():
+            histogram = registry._hosts[host] = LatencyHistogram()
+            # (The histograms of totals saved with other LATENCY_BUCKETS start over.)
+            if len(counts) == len(histogram.Counts):
+                histogram.Counts = list(counts)
+                histogram.Count = count
+                histogram.Sum = total
+        registry._hostResults = dict(((host, status), count) for host, status, count in saved["host_results"])
+        return registry
+
+    def render(self):
+        """
+        # Returns the totals in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append("# HELP {0}_{1} {2}".format(METRIC_PREFIX, name, description))
+            lines.append("# TYPE {0}_{1} {2}".format(METRIC_PREFIX, name, kind))
+            for suffix, labels, value in samples:
+                lines.append("{0}_{1}{2}{3} {4}".format(METRIC_PREFIX, name, suffix, format_labels(labels),
+                                                        format_value(value)))
+
+        with self._lock:
+            metric("check_runs_total", "counter", "Check runs finished.", [("", (), self.Runs)])
+            metric("last_run_seconds", "gauge", "Seconds the URL checks of the last run took.",
+                   [("", (), self.LastRunSeconds)])
+            metric("last_run_timestamp_seconds", "gauge", "Time the last run finished (Unix time).",
+                   [("", (), self.LastRunFinished)])
+            metric("url_checks_total", "counter", "URLs checked, by final status and code.",
+                   [("", (("status", status), ("code", code)), count)
+                    for (status, code), count in sorted(self._results.items())])
+            metric("url_check_retries_total", "counter", "Checks tried again after a transient error or a "
+                   "Retry-After.", [("", (), self.Retries)])
+            metric("url_check_bytes_total", "counter", "Response body bytes read while checking URLs.",
+                   [("", (), self.Bytes)])
+            metric("host_url_checks_total", "counter", "URLs checked per host, by final status.",
+                   [("", (("host", host), ("status", status)), count)
+                    for (host, status), count in sorted(self._hostResults.items())])
+            samples = []
+            for host, histogram in sorted(self._hosts.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.Counts):
+                    cumulative += count
+                    samples.append(("_bucket", (("host", host), ("le", str(bound))), cumulative))
+                samples.append(("_sum", (("host", host),), histogram.Sum))
+                samples.append(("_count", (("host", host),), histogram.Count))
+            metric("host_request_seconds", "histogram", "Latency of each request attempt, per host.", samples)
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", "\\n")
+                                             .replace('"', '\\"')) for name, value in labels) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
@@ -0,0 +1,98 @@
+"""
+# Initial Creation:
+#   Shared store of the Prometheus metrics totals of every check run (see Metrics.py).
+# General Description:
+#   Behind a server with several worker processes (gunicorn, uWSGI), the totals kept in one process's memory were
+#   only the runs of that process, and every scrape of the metrics endpoint could land on another process - so the
+#   counters jumped between values and went back down, which Prometheus takes for a counter reset.  The totals of
+#   every run (in any worker process, or the headless crawler) are now added to one SQLite file in the app workspace
+#   instead, and the metrics endpoint renders them from there.
+#
+#   The totals are a single MetricsRegistry (see Metrics.py) saved as JSON.  Adding a run reads, updates and writes
+#   it back in one write transaction, so runs finishing at the same time in different processes are all counted.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from .CheckEngine import APP_WORKSPACE_PATH
+from .Metrics import MetricsRegistry
+from .StatusCache import connect
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+MetricsStore_Path = os.path.join(APP_WORKSPACE_PATH, "metrics.sqlite3")
+
+_Store_Lock = threading.Lock()
+_Stores = {}  # Path -> MetricsStore
+
+
+class MetricsStore(object):
+    """
+    # SQLite backed totals of every check run of the app (see above).
+    """
+
+    def __init__(self, path=MetricsStore_Path):
+        self.Path = path
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS metrics ("
+                             "  id INTEGER PRIMARY KEY CHECK (id = 1),"
+                             "  totals TEXT NOT NULL)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return connect(self.Path)
+
+    @staticmethod
+    def _load(conn):
+        row = conn.execute("SELECT totals FROM metrics WHERE id = 1").fetchone()
+        return MetricsRegistry() if row is None else MetricsRegistry.from_dict(json.loads(row[0]))
+
+    def add_run(self, metrics):
+        # Adds the RunMetrics of a finished run to the totals.
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            # Locks out the other processes from the read until the write, so no run's numbers are lost.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                registry = self._load(conn)
+                registry.add_run(metrics)
+                conn.execute("INSERT OR REPLACE INTO metrics (id, totals) VALUES (1, ?)",
+                             (json.dumps(registry.as_dict()),))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def registry(self):
+        # Returns a MetricsRegistry of the totals so far (e.g. to render them).
+        conn = self._connect()
+        try:
+            return self._load(conn)
+        finally:
+            conn.close()
+
+
+def metrics_store(path=MetricsStore_Path):
+    # Returns the MetricsStore of the file, opened the first time it is needed.
+    with _Store_Lock:
+        store = _Stores.get(path)
+        if store is None:
+            store = _Stores[path] = MetricsStore(path)
+        return store
+
+
+def add_run_metrics(metrics, path=MetricsStore_Path):
+    # Adds a finished run's RunMetrics to the shared totals.  Errors are only logged - they do not fail the run.
+    try:
+        metrics_store(path).add_run(metrics)
+    except (OSError, sqlite3.Error, ValueError, TypeError) as e:
+        Logfile.error("Could not add the run to the metrics totals: {0}".format(e))
@@ -24,14 +24,40 @@
 import linecache  # required for capture_exception()
 import sys  # required for capture_exception()
 import os
+import codecs  # required for decoding the streamed Service Catalog API response
+import hashlib  # required for the hashes of the service fields (incremental runs)
+import itertools
+import json
 import re  # required for Regular Expressions - this library is installed with python!
 import requests  # required for initiating the call to the API to retrieve the data
+import threading  # required for the connectivity check cache
 import time
 
 # import urllib2    # Apparently urllib2 has been split into urllib.request and urllib.error for python 3.x
-import urllib.request  # required for making calls to URLs
-import urllib.error  # required for checking the status of the URL calls
-import ssl  # required for ssl._create_unverified_context()  - this was needed for the tethys URL verifications.
+import urllib.parse  # required for splitting the URLs to check into host and path
+import http.client  # required for the pooled keep-alive connections used to check the URLs
+import sqlite3  # required for catching errors from the URL status cache
+from concurrent.futures import as_completed  # required for reporting URL checks as they finish
+from concurrent.futures import ThreadPoolExecutor  # required for querying and checking the regions in parallel
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from functools import partial
+
+from .CheckEngine import URLCheckEngine, ByteBudget, DEFAULT_MAX_WORKERS, HEAD_REJECTED_CODES, PROBE_BYTE_CAP, \
+    RUN_BYTE_BUDGET, CONNECT_TIMEOUT, READ_TIMEOUT, STATUS_NOT_CHECKED, DEADLINE_CODE, MAX_REDIRECTS, REDIRECT_CODES, \
+    seconds_until, deadline_passed
+from .ConnectionPool import HostConnectionPool, DEFAULT_MAX_PER_HOST, USER_AGENT
+from .StatusCache import URLStatusCache, ServiceLinkCache, CACHE_UP_TTL, CACHE_DOWN_TTL, CACHE_MAX_ENTRIES, \
+    INCREMENTAL_STALENESS, StatusCache_Path
+from .AsyncChecker import AsyncURLCheckEngine, get_site_status_async, DEFAULT_MAX_IN_FLIGHT
+from .HostScheduler import HostScheduler, HostBusy, BUSY_CODES, DEFAULT_HOST_RATE, DEFAULT_HOST_BURST, \
+    MAX_TRANSIENT_RETRIES, BREAKER_THRESHOLD, HOST_UNREACHABLE_CODE, parse_retry_after
+from .HostPreflight import HostPreflight
+from .LinkExtractor import extract_links, extract_service_links
+from .Metrics import RunMetrics
+from .MetricsStore import add_run_metrics, MetricsStore_Path
+from .Tracing import span, end_span
+from .ResultStore import InvalidEntry, ResultList, NO_DATA_STATUS
+from .URLIndex import canonical_url, index_urls
 
 import logging
 # -------------------------------------------
@@ -42,6 +68,43 @@ import logging
 # -------------------------------------------
 Logfile = logging.getLogger(__name__)  # "CheckURLs.QueryCatalog"
 ServiceCatalogAPI_URL = "https://www.servirglobal.net/ServiceCatalogueBackend/graphql"
+API_READ_TIMEOUT = 120  # Seconds to wait on each read of a Service Catalog API response.
+API_CHUNK_SIZE = 64 * 1024  # Bytes read at a time from the streamed searchServices response.
+
+# Services whose links are collected together (one ServiceLinkCache lookup per batch in incremental runs).
+SERVICE_BATCH_SIZE = 500
+
+# Run deadline choices (in seconds) offered on the home page. None means the run is not limited.
+Run_Deadline_Choices = [("No limit", None), ("1 minute", 60), ("2 minutes", 120), ("5 minutes", 300),
+                        ("10 minutes", 600), ("30 minutes", 1800)]
+
+# The service category sections that are checked: (Section name as reported, Service class field name)
+Service_Categories = [("DATA", "Data"), ("TOOLS", "Tools"), ("NEWS", "News"),
+                      ("TRAINING MATERIALS", "TrainingMaterials")]
+
+# The URL checker backends that can be picked: "threads" checks each URL with blocking requests on a thread pool,
+# "asyncio" checks the URLs from a single event loop (see AsyncChecker.py).
+CHECK_BACKEND_THREADS = "threads"
+CHECK_BACKEND_ASYNCIO = "asyncio"
+Check_Backend = CHECK_BACKEND_THREADS
+
+# Endpoints probed (all at the same time) before a run starts, to make sure the internet can be reached - an answer
+# from any one of them will do.  The Service Catalog's own server comes first since a run can not go anywhere
+# without it.
+Connectivity_Endpoints = ["https://www.servirglobal.net/", "http://www.google.com/", "http://www.yahoo.com/"]
+CONNECTIVITY_TIMEOUT = 3  # Seconds each probe waits to connect, and then for the answer.
+CONNECTIVITY_CACHE_SECONDS = 30  # Seconds the result of the connectivity check is reused for the runs that follow.
+
+# Part of every service fields hash - bump it whenever the link extraction (see LinkExtractor.py) changes what it
+# finds, so incremental runs parse every service again instead of reusing links extracted the old way.
+LINK_EXTRACTION_VERSION = 2
+
+
+class NoConnectivityError(Exception):
+    """
+    # Raised by QueryServiceCatalog() when none of the connectivity endpoints could be reached, so there is no point
+    # in starting the run.  The message is meant for the user.
+    """
 
 
 class Service(object):
@@ -81,41 +144,62 @@ class Service(object):
         self.TrainingMaterials = trainingmaterials
 
 
-class InvalidEntry(object):
-
-    def __init__(self, status="", region="", servicearea="", title="", identifier="", section="", sectionentry="", url=""):
-        self.Status = status
-        self.Region = region
-        self.ServiceArea = servicearea
-        self.Title = title
-        self.ID = identifier
-        self.Section = section
-        self.SectionEntry = sectionentry
-        self.URL = url
-
-    def Status(self, status):
-        self.Status = status
-
-    def Region(self, region):
-        self.Region = region
-
-    def ServiceArea(self, servicearea):
-        self.ServiceArea = servicearea
-
-    def Title(self, title):
-        self.Title = title
-
-    def ID(self, identifier):
-        self.ID = identifier
-
-    def Section(self, section):
-        self.Section = section
-
-    def SectionEntry(self, sectionentry):
-        self.SectionEntry = sectionentry
+class CheckSettings(object):
+    """
+    # The settings of a URL check run, passed from QueryServiceCatalog() down to the check engine.
+    #   backend         - "threads" or "asyncio" (defaults to Check_Backend).  See NewCheckEngine().
+    #   max_workers     - number of checks run concurrently (defaults to the backend's default).
+    #   probe           - HEAD-first probe mode (see get_site_status()).
+    #   byte_budget     - most response body bytes read for the whole run.
+    #   connect_timeout - seconds to wait for each connection to be made.
+    #   read_timeout    - seconds to wait on each read from a server.
+    #   max_per_host    - most keep-alive connections open to (and checks running against) any one host (see
+    #                     ConnectionPool.py and HostScheduler.py).
+    #   host_rate, host_burst - most checks started per second against any one host (on average), and largest burst
+    #                     of them (see HostScheduler.py).  A host_rate of None turns the rate limit off.
+    #   retries         - times a check is tried again (with backoff) after a transient connection error.
+    #   breaker_threshold - connection failures in a row after which the rest of a host's URLs are reported as
+    #                     "HOST UNREACHABLE" without being tried (see HostScheduler.py).  None turns this off.
+    #   preflight       - resolve every host and probe its port before the HTTP checks, reporting the URLs of hosts
+    #                     that do not exist or refuse connections as down right away (see HostPreflight.py).
+    #   use_cache       - read (and save) URL results in the persistent status cache (see StatusCache.py).
+    #   cache_up_ttl, cache_down_ttl - seconds a cached "up" / "down" result is good for.
+    #   cache_max_entries - most URLs kept in the status cache.
+    #   cache_path      - the SQLite file of the status cache (and of the service link cache of incremental runs).
+    #   metrics_path    - the SQLite file of the metrics totals the run is added to (see MetricsStore.py).
+    #   incremental     - only check the services that were added or edited since they were last checked.  The
+    #                     links and results of the other services are reused for up to staleness_window seconds.
+    #   fan_out         - for "All" runs, query and check each region in parallel (see ProcessRegions()).
+    """
 
-    def URL(self, url):
-        self.URL = url
+    def __init__(self, backend=None, max_workers=None, probe=True, byte_budget=RUN_BYTE_BUDGET,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_per_host=DEFAULT_MAX_PER_HOST,
+                 use_cache=True, cache_up_ttl=CACHE_UP_TTL, cache_down_ttl=CACHE_DOWN_TTL,
+                 cache_max_entries=CACHE_MAX_ENTRIES, incremental=False, staleness_window=INCREMENTAL_STALENESS,
+                 fan_out=True, host_rate=DEFAULT_HOST_RATE, host_burst=DEFAULT_HOST_BURST,
+                 retries=MAX_TRANSIENT_RETRIES, breaker_threshold=BREAKER_THRESHOLD, preflight=True,
+                 cache_path=StatusCache_Path, metrics_path=MetricsStore_Path):
+        self.Backend = backend or Check_Backend
+        self.MaxWorkers = max_workers
+        self.Probe = probe
+        self.ByteBudget = byte_budget
+        self.ConnectTimeout = connect_timeout
+        self.ReadTimeout = read_timeout
+        self.MaxPerHost = max_per_host
+        self.UseCache = use_cache
+        self.CacheUpTTL = cache_up_ttl
+        self.CacheDownTTL = cache_down_ttl
+        self.CacheMaxEntries = cache_max_entries
+        self.CachePath = cache_path
+        self.MetricsPath = metrics_path
+        self.Incremental = incremental
+        self.StalenessWindow = staleness_window
+        self.FanOut = fan_out
+        self.HostRate = host_rate
+        self.HostBurst = host_burst
+        self.Retries = retries
+        self.BreakerThreshold = breaker_threshold
+        self.Preflight = preflight
 
 
 # Common function used by many!!
@@ -179,48 +263,181 @@ def get_Elapsed_Time_As_String(timeInput):
     return timeElapsed(timeInput)
 
 
-def get_site_status(url):
+def fetch_status_code(url, method="GET", headers=None, pool=None, budget=None, max_bytes=0):
+    """
+    # Sends a single request for the URL over a keep-alive connection from the pool and returns the status code and
+    # Location header of the response - or raises HostBusy for a 429/503 response with a Retry-After header.  No more
+    # than max_bytes of the body are read (taken from the ByteBudget, if one is passed in).  The connection only goes
+    # back to the pool when the whole response was read - otherwise it is closed right away so a large download is
+    # never left hanging on the socket.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    requestHeaders = {"User-Agent": USER_AGENT, "Accept": "*/*"}
+    requestHeaders.update(headers or {})
+
+    for attempt in (1, 2):
+        conn = pool.acquire(url)
+        reusable = False
+        try:
+            target = path
+            if conn.AbsoluteURI:
+                # Plain HTTP through a proxy - the proxy is sent the whole URL.
+                target = urllib.parse.urlunsplit(parts[:4] + ("",))
+            conn.request(method, target, headers=dict(requestHeaders, **conn.ProxyHeaders))
+            resp = conn.getresponse()
+            if method == "HEAD":
+                # There is never a body - this just marks the response as finished so the connection can be reused.
+                resp.read()
+            elif max_bytes > 0:
+                maxBytes = max_bytes if budget is None else budget.take(max_bytes)
+                if maxBytes > 0:
+                    bytesRead = len(resp.read(maxBytes))
+                    if budget is not None:
+                        budget.refund(maxBytes - bytesRead)
+            reusable = resp.isclosed() and not resp.will_close
+            if resp.status in BUSY_CODES:
+                retryAfter = parse_retry_after(resp.getheader("Retry-After"))
+                if retryAfter is not None:
+                    raise HostBusy(resp.status, retryAfter)
+            return resp.status, resp.getheader("Location")
+
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            # A kept-alive connection may have been closed by the server while it sat in the pool.  In that case,
+            # try once more on a brand new connection.
+            if attempt == 1 and conn.Reused:
+                continue
+            raise
+
+        finally:
+            pool.release(conn, reusable)
+
+
+def follow_redirects(url, method="GET", headers=None, pool=None, budget=None, max_bytes=0):
+    # Requests the URL, following redirects the same way urlopen() does, and returns the final status code.
+    for redirect in range(MAX_REDIRECTS + 1):
+        code, location = fetch_status_code(url, method, headers, pool, budget, max_bytes)
+        if code in REDIRECT_CODES and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        break
+    return code
+
+
+def get_site_status(url, probe=True, budget=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                    pool=None, raise_busy=False, metrics=None):
     """
     # Simply checks the internet to see if the URL passed in is valid and passes back a status and status code.
     #
     #  Python 3.6 version!
     #
-    # Issue: Using urllib2.urlopen() with python 2.7 did not give a problem with SSL certificates.  However, with
-    # python 3.x, urllib2 was divided up between urllib.request and urllib.error, and they implemented a 'fix' that
-    # requires SSL certificate verification on HTTPS calls. Please see https://www.python.org/dev/peps/pep-0476/
-    # for more info.  Currently, our tethys server is reporting a 'certificate verify failed' for some reason, so
-    # we are implementing the unverified context work-around for "tethys" site links.
+    # In probe mode (the default), a HEAD request is sent first so no body is ever downloaded.  If the server rejects
+    # HEAD (405/501), it falls back to a GET asking for just the first PROBE_BYTE_CAP bytes (Range header) and never
+    # reads more than that - even if the server ignores the Range header and sends the whole PDF or data file.
+    # Bytes read are taken from the ByteBudget passed in (if any); once the run's budget is used up the status is
+    # still reported, but no body bytes are read at all.  Every response is released as soon as it has been checked.
+    #
+    # The requests go over keep-alive connections from the HostConnectionPool passed in (see ConnectionPool.py).  If
+    # no pool is passed in, a one-off pool using connect_timeout and read_timeout (in seconds) is used.
+    #
+    # A 429 (Too Many Requests) or 503 (Service Unavailable) answer with a Retry-After header is reported as "down"
+    # with its code - unless raise_busy is set, in which case HostBusy is raised so the check engine can wait the
+    # host out and try again (see HostScheduler.py).
+    #
+    # The body bytes read are added to the RunMetrics passed in, if any (see Metrics.py).
     """
+    ownPool = pool is None
+    if ownPool:
+        pool = HostConnectionPool(connect_timeout=connect_timeout, read_timeout=read_timeout)
+    checkBudget = ByteBudget(parent=budget)  # The bytes of this check, drawn from the run's budget.
     try:
-        if "tethys" in url:
-            #  The tethys server has a valid certificate, but for some reason is reporting certificate verify failed.
-            #  Thus, need to provide an 'unverified' context to bypass certificate authorization.
-            context = ssl._create_unverified_context()
-            urlfile = urllib.request.urlopen(url, context=context)
+        if probe:
+            code = follow_redirects(url, "HEAD", pool=pool)
+            if code in HEAD_REJECTED_CODES:
+                # The server does not support HEAD - fall back to a bounded, ranged GET.
+                rangeHeader = {"Range": "bytes=0-{0}".format(PROBE_BYTE_CAP - 1)}
+                code = follow_redirects(url, headers=rangeHeader, pool=pool, budget=checkBudget,
+                                        max_bytes=PROBE_BYTE_CAP)
+                if code == 416:
+                    # "Range Not Satisfiable" - the resource is there, it is just empty.
+                    return 'up', code
         else:
-            #  Do not provide context to bypass certificate authorization...
-            urlfile = urllib.request.urlopen(url)
-    except urllib.error.URLError as e:
-        if hasattr(e, 'code'):
+            code = follow_redirects(url, pool=pool)
+
+        if code >= 400:
             # The server couldn't fulfill the request.
             # NOTE that 403 errors are captured here, but sites are usually able to be accessed anyway. Would
             #  need to put in more logic here to let those pass...  ToDo?
-            return 'down', e.code
-        elif hasattr(e, 'reason'):
-            # We failed to reach a server.
-            return 'down', e.reason
-    else:
+            return 'down', code
         # everything is fine
-        return 'up', urlfile.code
+        return 'up', code
+
+    except HostBusy as e:
+        if raise_busy:
+            raise
+        return 'down', e.Code
+
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        # We failed to reach a server (or the connection failed or timed out while talking to it).
+        return 'down', e
+
+    finally:
+        if metrics is not None:
+            metrics.add_bytes(url, checkBudget.Used)
+        if ownPool:
+            pool.close()
+
+
+_Connectivity_Lock = threading.Lock()
+_Connectivity_Results = {}  # Tuple of endpoints -> (time.time() it was checked, reachable?)
 
 
-def is_internet_reachable():
-    # Checks Google then Yahoo just in case one is down
-    statusGoogle, stat_code = get_site_status('http://www.google.com')
-    statusYahoo, stat_code = get_site_status('http://www.yahoo.com')
-    if statusGoogle == 'down' and statusYahoo == 'down':
-        return False
-    return True
+def probe_endpoint(url, timeout=CONNECTIVITY_TIMEOUT):
+    # Returns True if the server of the URL answers a HEAD request at all - whatever the status code (redirects are
+    # not followed, the first answer is enough).
+    with HostConnectionPool(1, timeout, timeout) as pool:
+        try:
+            fetch_status_code(url, "HEAD", pool=pool)
+            return True
+        except HostBusy:
+            return True
+        except (OSError, ValueError, http.client.HTTPException):
+            return False
+
+
+def is_internet_reachable(endpoints=None, timeout=CONNECTIVITY_TIMEOUT):
+    """
+    # Probes the connectivity endpoints (Connectivity_Endpoints unless others are passed in) all at the same time,
+    # with short timeouts, and returns True as soon as one of them answers - or False once they have all failed or
+    # timed out.  The result is cached for CONNECTIVITY_CACHE_SECONDS, so runs started one after another only probe
+    # once.
+    """
+    endpoints = tuple(Connectivity_Endpoints if endpoints is None else endpoints)
+    with _Connectivity_Lock:
+        checked = _Connectivity_Results.get(endpoints)
+    if checked is not None and time.time() - checked[0] < CONNECTIVITY_CACHE_SECONDS:
+        return checked[1]
+
+    reachable = False
+    executor = ThreadPoolExecutor(max_workers=len(endpoints))
+    try:
+        futures = [executor.submit(probe_endpoint, url, timeout) for url in endpoints]
+        # Every probe is over within its connect timeout plus its read timeout.
+        for future in as_completed(futures, timeout=2 * timeout + 1):
+            if future.result():
+                reachable = True
+                break
+    except FuturesTimeoutError:
+        pass
+    finally:
+        # Probes still running are left to time out in the background.
+        executor.shutdown(wait=False)
+
+    with _Connectivity_Lock:
+        _Connectivity_Results[endpoints] = (time.time(), reachable)
+    return reachable
 
 
 def GetAllRegions():
@@ -237,7 +454,8 @@ def GetAllRegions():
             "operationName": "",
             "variables": {},
             "query": "{"
-            "   allRegions(sort: \"\", limit: 10, start: 0, where: \"\") {"
+            # The limit used to be 10 - fan-out runs (see ProcessRegions()) need every region.
+            "   allRegions(sort: \"\", limit: 100, start: 0, where: \"\") {"
             "       _id"
             "       Name"
             "   }"
@@ -245,7 +463,7 @@ def GetAllRegions():
         }
 
         # Send the API request and get the result.
-        resp = requests.post(ServiceCatalogAPI_URL, json=PAYLOAD)
+        resp = requests.post(ServiceCatalogAPI_URL, json=PAYLOAD, timeout=(CONNECT_TIMEOUT, API_READ_TIMEOUT))
         json_response = resp.json()
 
         # Store the regions into a dictionary... use the "Name" as the key so we can lookup later!
@@ -267,128 +485,390 @@ def GetAllRegions():
         Logfile.error(error)
 
 
+def IterServices(resp, chunk_size=API_CHUNK_SIZE, tracer=None):
+    """
+    # Generator of the service records in a (streamed) searchServices response: {"data": {"services": [...]}}.
+    # The body is read chunk_size bytes at a time and each service record is decoded - and handed on - as soon as
+    # all of it has arrived, so neither the whole response body nor the whole decoded catalog is ever in memory.
+    # Each read and each decode is a span of the Tracer passed in, if any (see Tracing.py).
+    """
+    decoder = json.JSONDecoder()
+    textDecoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")()
+    chunks = resp.iter_content(chunk_size=chunk_size)
+    arrayStart = re.compile(r'"services"\s*:\s*\[')
+    buf = ""
+    pos = None  # Position in buf just after the start of the services array, once found.
+    eof = False
+
+    while True:
+        if pos is None:
+            match = arrayStart.search(buf)
+            if match is not None:
+                pos = match.end()
+        else:
+            # Skip the whitespace and the comma between two records.
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ","):
+                pos += 1
+            if pos < len(buf):
+                if buf[pos] == "]":
+                    return
+                try:
+                    with span(tracer, "Decode service record", "decode"):
+                        service, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # The record is not all there yet (or is broken - which shows once there is nothing more to read).
+                    if eof:
+                        raise
+                else:
+                    buf = buf[end:]
+                    pos = 0
+                    yield service
+                    continue
+
+        if eof:
+            if pos is None:
+                # No services array at all - the API sent back an error instead.
+                raise ValueError("No services found in the Service Catalog API response: {0}".format(buf[:1000]))
+            raise ValueError("The Service Catalog API response ended before the list of services did.")
+
+        with span(tracer, "Read the API response", "network"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf += textDecoder.decode(b"", final=True)
+        else:
+            buf += textDecoder.decode(chunk)
+
+
+def NewService(service):
+    """
+    # Builds a Service from a service record of the searchServices response.
+    """
+    svc = Service()
+    svc.ID = service['_id']
+    svc.Title = service['Title']
+    svc.Regions = service['regions']
+    svc.ServiceAreas = service['serviceareas']
+    svc.Data = service['Data']
+    svc.Tools = service['Tools']
+    svc.News = service['News']
+    svc.TrainingMaterials = service['TrainingMaterials']
+    return svc
+
+
+def Batches(items, size):
+    # Generator of lists of (up to) size items from the iterable passed in.
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
 def GetURLs_FromString(theString):
     """
-    # Uses a regular expression to parse all matching patterns from the string passed in.
-    # Returns a list - either empty or with some items.
+    # Parses all links from the string passed in (see LinkExtractor.py for the kinds of links found).
+    # Returns a list - either empty or with some items - of [Name, URL] entries.
     """
     try:
-        # Init a return list.
-        retList = []
-
-        # Ensure that the string has data...
-        if theString is not None and len(theString) > 0:
-            # We are dealing with a multi-line text field containing name/value markup that looks like this:
-            # "[Some text here](https://www.somesite.com/news/blah/index.html)\n
-            # \n
-            # [More words here](https://another.net/Articles/invading-kenya-ecosystem)\n
-            # \n
-            # [Even additional text](https://anysite.net/Data/SomePage)"
-            # etc.
-
-            # The following pattern kinda works just scanning the entire string, but it grabs the closing ")"
-            # after the URL. So if using this pattern, the last character needs to be removed from
-            # any matching strings...
-            # url_regex = 'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!#*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-
-            #  New approach...
-            #  Since the data in theString is in the markup format, use the name/url combination below to
-            #  extract both the Name and URL tags all at once.  Found this example at:
-            # https://stackoverflow.com/questions/23394608/python-regex-fails-to-identify-markdown-links
-            name_regex = "[^]]+"            # This is the Name portion of the markup tag.
-            url_regex = "http[s]?://[^)]+"  # This is the URL portion of the markup tag.
-            #  Put together to build the full regex pattern...
-            markup_regex = '\[({0})]\(\s*({1})\s*\)'.format(name_regex, url_regex)
-
-            matches = re.findall(markup_regex, theString)
-            for match in matches:
-                # Create an inner list to contain the Name and URL to be added to the return list.
-                # retList will be a nested list like: [[Name1, URL1], [Name2, URL2], [Name3, URL3], ...]
-                innerList = [match[0], match[1]]
-
-                # Add the inner list to the list to be returned.
-                # retList.append(match[1])
-                retList.append(innerList)
-
-        return retList
+        # We are dealing with a multi-line text field containing name/value markup that looks like this:
+        # "[Some text here](https://www.somesite.com/news/blah/index.html)\n
+        # \n
+        # [More words here](https://another.net/Articles/invading-kenya-ecosystem)\n
+        # \n
+        # [Even additional text](https://anysite.net/Data/SomePage)"
+        # etc.
+        #
+        # The regular expression used to be built (and compiled) on every call from:
+        #   markup_regex = '\[({0})]\(\s*({1})\s*\)'.format("[^]]+", "http[s]?://[^)]+")
+        # which cut URLs off at their first ")" and skipped bare URLs and reference-style links.
+        return extract_links(theString)
 
     except:
         error = capture_exception()
         Logfile.error(error)
-        return retList
+        return []
+
+
+def NewInvalidEntry(status, svc_cls, svcCategory, lnkName, lnk):
+    """
+    # Builds an InvalidEntry (see ResultStore.py) for the URL found in the given service and category.
+    """
+    return InvalidEntry(status, svc_cls.Regions[0]['Name'], svc_cls.ServiceAreas[0]['Name'],
+                        svc_cls.Title.replace(",", " "), svc_cls.ID, svcCategory, lnkName.replace(",", " "), lnk)
+
+
+def ServiceFieldsHash(svc_cls):
+    """
+    # Returns a hash of the Data, Tools, News, and Training Materials fields of the service - it changes whenever
+    # any of the links in the service is edited.
+    """
+    fields = [LINK_EXTRACTION_VERSION] + [getattr(svc_cls, fieldName) for svcCategory, fieldName in Service_Categories]
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()
 
 
-def ProcessURLs(svc_cls, svcCategory, URLs, Dict_AlreadyChecked, List_ErrURLs, List_ErrCatalogs):
+def CollectURLs(Services, links_cache=None, staleness_window=None, tracer=None):
     """
-    # Loops through the list of URLs passed in and calls a function to verify the site is valid.
-    # It first checks to see if each URL has already been processed (via the dictionary passed in).
-    # If the URL(key) already exists in the dictionary, the status(value) of either "up" or "down" is used to report.
-    # If the URL is not in the dictionary, get_site_status() is called and the dictionary is updated respectively.
+    # Parses the Data, Tools, News, and Training Materials fields of each service passed in and returns a single
+    # list of all URLs found - in catalog order - as [svc_cls, svcCategory, lnkName, lnk] entries.
+    #
+    # Services can be any iterable (e.g. a generator of services as they are read from the API).  The entries
+    # refer to a copy of each service without its (large) category fields, so the fields of a service can be
+    # freed as soon as its links have been extracted.  Also returns the list of those service copies.
+    #
+    # For incremental runs, links_cache is the ServiceLinkCache.  A service whose fields hash still matches the
+    # cached one, and that was checked less than staleness_window seconds ago, is not parsed again - its stored links
+    # are used instead.  Also returns the set of IDs of those unchanged services and a list of
+    # (service ID, fields hash, links) entries for every other service, to be saved in the cache.
+    #
+    # The link extraction of each service is a span of the Tracer passed in, if any (see Tracing.py).
+    """
+    Services_List = []
+    URL_Occurrences = []
+    Unchanged_IDs = set()
+    Changed_Services = []
+    now = time.time()
+    for batch in Batches(Services, SERVICE_BATCH_SIZE):
+        Dict_KnownServices = None
+        if links_cache is not None:
+            try:
+                Dict_KnownServices = links_cache.lookup(svc.ID for svc in batch)
+            except (sqlite3.Error, OSError, ValueError):
+                # Parse the whole batch again instead...
+                error = capture_exception()
+                Logfile.error(error)
+                Dict_KnownServices = {}
+
+        for svc in batch:
+            Logfile.info("Service: {0}".format(svc.Title))
+            svcInfo = Service(svc.ID, svc.Title, svc.Regions, svc.ServiceAreas)
+            Services_List.append(svcInfo)
+
+            if Dict_KnownServices is not None:
+                fieldsHash = ServiceFieldsHash(svc)
+                known = Dict_KnownServices.get(svc.ID)
+                if known is not None and known[0] == fieldsHash and now - known[2] <= staleness_window:
+                    Logfile.debug("\t\t(unchanged since the last check)")
+                    Unchanged_IDs.add(svc.ID)
+                    for svcCategory, lnkName, lnk in known[1]:
+                        URL_Occurrences.append([svcInfo, svcCategory, lnkName, lnk])
+                    continue
+
+            # All four category fields are scanned in a single pass.
+            try:
+                with span(tracer, "Extract links", "service", id=svc.ID, title=svc.Title):
+                    links = extract_service_links([(svcCategory, getattr(svc, fieldName))
+                                                   for svcCategory, fieldName in Service_Categories])
+            except:
+                error = capture_exception()
+                Logfile.error(error)
+                links = []
+            Logfile.debug("\t\t({0} links total)".format(len(links)))
+            for svcCategory, lnkName, lnk in links:
+                URL_Occurrences.append([svcInfo, svcCategory, lnkName, lnk])
+
+            if Dict_KnownServices is not None:
+                Changed_Services.append((svc.ID, fieldsHash, links))
+
+    return Services_List, URL_Occurrences, Unchanged_IDs, Changed_Services
+
+
+def NewCheckEngine(settings, budget=None, deadline=None, pool=None, preflight=None):
+    """
+    # Returns the URL check engine for the backend in the CheckSettings passed in ("threads" or "asyncio").
+    # MaxWorkers is the number of threads for the "threads" backend or the number of checks in flight for the
+    # "asyncio" backend.  The probe mode, timeouts, ByteBudget and HostConnectionPool are passed on to the checker
+    # (see get_site_status()) - and so is the run's HostPreflight, whose cached host addresses the "asyncio" checks
+    # connect to (the pool does the same for the "threads" backend).  URLs whose check has not started by the
+    # deadline (a time.time() value) are not checked at all.  Either way, the checks are spread across hosts by a
+    # HostScheduler that keeps each host's rate limit, concurrency cap and Retry-After pauses, and retries transient
+    # errors and gives up on unreachable hosts (see HostScheduler.py).  The engine's Metrics record the latency,
+    # result, bytes read and retries of every check (see Metrics.py and ReportRunMetrics()).
+    """
+    scheduler = HostScheduler(settings.HostRate, settings.HostBurst, settings.MaxPerHost, settings.Retries,
+                              settings.BreakerThreshold)
+    metrics = RunMetrics()
+    if settings.Backend == CHECK_BACKEND_ASYNCIO:
+        checker = partial(get_site_status_async, probe=settings.Probe, connect_timeout=settings.ConnectTimeout,
+                          read_timeout=settings.ReadTimeout, raise_busy=True, resolver=preflight)
+        return AsyncURLCheckEngine(checker, settings.MaxWorkers or DEFAULT_MAX_IN_FLIGHT, deadline, scheduler,
+                                   metrics)
+    elif settings.Backend == CHECK_BACKEND_THREADS:
+        checker = partial(get_site_status, probe=settings.Probe, budget=budget, pool=pool, raise_busy=True,
+                          metrics=metrics)
+        return URLCheckEngine(checker, settings.MaxWorkers or DEFAULT_MAX_WORKERS, deadline, scheduler, metrics)
+    else:
+        raise ValueError("Unknown URL check backend: {0}".format(settings.Backend))
+
+
+def LogSchedulerTotals(scheduler):
+    # Logs what the HostScheduler of a run had to do: back off, try again, or give up on hosts.
+    Logfile.info("{0} times a host asked us to back off (Retry-After).".format(scheduler.Paused))
+    Logfile.info("{0} checks tried again after a transient error.".format(scheduler.Retried))
+    unreachable = scheduler.unreachable_hosts()
+    if unreachable:
+        Logfile.info("{0} hosts unreachable (circuit breaker open): {1}".format(len(unreachable),
+                                                                              ", ".join(unreachable)))
+
+
+def ReportRunMetrics(metrics, progress=None, metrics_path=MetricsStore_Path):
+    # Logs the summary table of the hosts that took the most time in the run (also passed to the RunProgress, if any),
+    # and adds the run's metrics to the app's totals in metrics_path, served by the metrics endpoint (see
+    # MetricsStore.py).
+    lines = metrics.summary_lines()
+    if lines:
+        Logfile.info("=== HOSTS THAT TOOK THE MOST TIME ===")
+        for line in lines:
+            Logfile.info(line)
+    if progress is not None:
+        progress.hosts_done(metrics.host_summary())
+    add_run_metrics(metrics, metrics_path)
+
+
+def ReportURL(lnk, status, stat_code, URL_Occurrences, indexes, Dict_AlreadyChecked, Indexed_ErrURLs):
+    """
+    # Records the result of the check of one (canonical) URL for every place (indexes into URL_Occurrences) the URL
+    # was found.  The invalid entries show the URL as it was written in each place.
+    # A "down" URL is reported with its status code at its first occurrence, and as a "DUPLICATE" everywhere else.
+    # A URL that was not checked before the run's deadline is reported as not checked everywhere it was found.
+    # The invalid entries are added to Indexed_ErrURLs along with their index.
+    """
+    if status == "up":
+        Logfile.debug("\t\t\t{0}".format(lnk))
+        #  Capture the status of the URL in a dictionary
+        Dict_AlreadyChecked[lnk] = "up"
+        return
+
+    #  Capture the status of the URL in a dictionary
+    Dict_AlreadyChecked[lnk] = status
+    for idx in indexes:
+        svc, svcCategory, lnkName, rawLnk = URL_Occurrences[idx]
+        if status == STATUS_NOT_CHECKED or idx == indexes[0]:
+            errEntry = NewInvalidEntry(str(stat_code).replace(",", " "), svc, svcCategory, lnkName, rawLnk)
+            if status != STATUS_NOT_CHECKED:
+                Logfile.error("### Oops! ### Code {0} ===> ({1}) {2} is down!".format(errEntry.Status,
+                                                                                      errEntry.Section,
+                                                                                      errEntry.URL))
+        else:
+            # Every later occurrence of the same URL is a DUPLICATE.
+            errEntry = NewInvalidEntry("DUPLICATE", svc, svcCategory, lnkName, rawLnk)
+            Logfile.error("### DUPLICATE! ### ===> ({0}) {1}\tpreviously verified as down!".format(errEntry.Section,
+                                                                                                errEntry.URL))
+        Indexed_ErrURLs.append((idx, errEntry))
+
+
+def ServicesPayload(region_id):
+    """
+    # Returns the searchServices API query for the Region passed in (all services if region_id is empty).
+    """
+    # Lets build the API query in parts so that we can insert the region passed in, if specified.
+    # Build the Query portion of the API call using the Region passed in.
+    firstPart = "{   services: searchServices(regions: ["
+    if len(region_id) > 0:
+        middlePart = "\"" + region_id + "\""
+    else:
+        middlePart = ""
+    lastPart = "], countries: [], serviceAreas: [], status: [], dataSources: [], freeText: \"\") {" \
+               "       _id" \
+               "       Title" \
+               "       regions {" \
+               "           _id" \
+               "           Name" \
+               "       }" \
+               "       serviceareas {" \
+               "           _id" \
+               "           Name" \
+               "       }" \
+               "       Data" \
+               "       Tools" \
+               "       News" \
+               "       TrainingMaterials" \
+               "   }" \
+               "}"
+
+    PAYLOAD = {
+        "operationName": "",
+        "variables": {},
+        "query": firstPart + middlePart + lastPart
+    }
+    return PAYLOAD
+
+
+def ProcessURLs(Services, Dict_AlreadyChecked, List_ErrURLs, List_ErrCatalogs, settings=None, deadline=None,
+                progress=None, engine=None, preflight=None, tracer=None):
+    """
+    # Collects the URLs from all services (any iterable of Service objects) and categories passed in and verifies
+    # them concurrently with the check engine picked by the CheckSettings passed in (see NewCheckEngine()).  The URLs
+    # are grouped by their canonical form first (see URLIndex.py), and each unique canonical URL is fetched only once -
+    # its result is reported for every raw URL in the group.  Checks to the same host share keep-alive connections
+    # from one HostConnectionPool.  In probe mode, no more than the settings' byte budget of body bytes are read across
+    # all of the checks (see get_site_status()).
+    # URLs with a fresh result in the persistent status cache are not checked again, and new results are saved to
+    # it (see StatusCache.py).
+    #
+    # In incremental mode (see CheckSettings), services that have not been edited since they were last checked reuse
+    # their stored links, and the cached results of their URLs for up to the staleness window - only the URLs of new
+    # or edited services, and URLs whose results have expired, are checked over the network.
+    #
+    # The results are reported exactly as if the URLs had been checked one at a time in catalog order:
+    # The first occurrence of a "down" URL is reported with its status code and any later occurrences (from other
+    # services or sections) are reported as "DUPLICATE".  URLs already in the dictionary passed in (keyed by canonical
+    # URL) are not checked again - if "down", every occurrence is reported as a "DUPLICATE".
+    #
+    # If a deadline (a time.time() value) is passed in, the function returns by then: every URL whose check has
+    # not finished is reported as "NOT CHECKED (deadline)".
+    #
+    # If a CheckJobs.RunProgress is passed in, it is updated (and handed the new invalid entries) as each unique URL
+    # is reported.
+    #
+    # A check engine (see NewCheckEngine()) can be passed in to share it between several calls running at the same
+    # time (see ProcessRegions()) - a URL submitted by more than one of them is still only fetched once.  The caller
+    # then owns the engine and shuts it down.  The run's HostPreflight is then passed in along with it, if any.
+    #
+    # Before any URL is fetched, the hosts of the URLs to fetch are resolved and probed (see HostPreflight.py) - the
+    # URLs of hosts that do not exist or refuse connections are reported as down without an HTTP request.
+    #
+    # Each stage (collecting the URLs, the cache lookup, the host preflight, the URL checks, storing the results) is a
+    # span of the Tracer passed in, if any (see Tracing.py).
     #
     #  The 1 Dictionary and 2 Lists passed in are also returned back to the calling function as this function may
     #  modify the contents of those objects.
     """
     try:
-        # Loop through the URLs and report on each one.
-        for lnkName, lnk in URLs:
-
-            # First, check to see if the URL has already been checked... there will be duplicates.
-            if lnk in Dict_AlreadyChecked:
-                # The URL has already been checked and reported.
-                # If "down", go ahead and report it again...
-                if Dict_AlreadyChecked[lnk] == "down":
-                    # Init a new errEntry class, populate it, and add it to the List of Err URLs.
-                    errEntry = InvalidEntry()
-
-                    errEntry.Status = "DUPLICATE"
-                    errEntry.Region = svc_cls.Regions[0]['Name']
-                    errEntry.ServiceArea = svc_cls.ServiceAreas[0]['Name']
-                    errEntry.Title = svc_cls.Title.replace(",", " ")
-                    errEntry.ID = svc_cls.ID
-                    errEntry.Section = svcCategory
-                    errEntry.SectionEntry = lnkName.replace(",", " ")
-                    errEntry.URL = lnk
-
-                    List_ErrURLs.append(errEntry)
-                    Logfile.error("### DUPLICATE! ### ===> ({0}) {1}\tpreviously verified as down!".format(errEntry.Section,
-                                                                                                        errEntry.URL))
-                else:
-                    Logfile.debug("\t\t\t{0}\t (previously checked)".format(lnk))
-
-            else:
-                try:
-                    status, stat_code = get_site_status(lnk)
-                except:
-                    # Log the error and keep going!
-                    error = capture_exception()
-                    Logfile.error(error)
-                    status = "down"  # This statement required if get_site_status() errors.
-                    stat_code = "Connection Error"  # This statement required if get_site_status() errors.
-
-                # Careful - This if is not part of the except clause...
-                if status != "up":
-                    # Init a new errEntry class, populate it, and add it to the List of Err URLs.
-                    errEntry = InvalidEntry()
-
-                    errEntry.Status = str(stat_code).replace(",", " ")
-                    errEntry.Region = svc_cls.Regions[0]['Name']
-                    errEntry.ServiceArea = svc_cls.ServiceAreas[0]['Name']
-                    errEntry.Title = svc_cls.Title.replace(",", " ")
-                    errEntry.ID = svc_cls.ID
-                    errEntry.Section = svcCategory
-                    errEntry.SectionEntry = lnkName.replace(",", " ")
-                    errEntry.URL = lnk
-
-                    List_ErrURLs.append(errEntry)
-                    Logfile.error("### Oops! ### Code {0} ===> ({1}) {2} is down!".format(errEntry.Status,
-                                                                                          errEntry.Section,
-                                                                                          errEntry.URL))
-                    #  Capture the status of the URL in a dictionary
-                    Dict_AlreadyChecked[lnk] = "down"
-                else:
-                    Logfile.debug("\t\t\t{0}".format(lnk))
-                    #  Capture the status of the URL in a dictionary
-                    Dict_AlreadyChecked[lnk] = "up"
+        if settings is None:
+            settings = CheckSettings()
+
+        cache = None
+        links_cache = None
+        if settings.UseCache:
+            try:
+                cache = URLStatusCache(settings.CachePath, up_ttl=settings.CacheUpTTL, down_ttl=settings.CacheDownTTL,
+                                       max_entries=settings.CacheMaxEntries)
+                if settings.Incremental:
+                    links_cache = ServiceLinkCache(settings.CachePath)
+            except (sqlite3.Error, OSError):
+                # Keep going without the cache...
+                error = capture_exception()
+                Logfile.error(error)
+                cache = None
+                links_cache = None
+
+        with span(tracer, "Collect URLs"):
+            Services_List, URL_Occurrences, Unchanged_IDs, Changed_Services = CollectURLs(
+                Services, links_cache, settings.StalenessWindow, tracer)
+        Logfile.info("{0} services processed.".format(len(Services_List)))
+        if links_cache is not None:
+            Logfile.info("{0} services unchanged since their last check, {1} new or edited.".format(
+                len(Unchanged_IDs), len(Changed_Services)))
+
+        # Group the occurrences by canonical URL (keeping their catalog order) and start checking every unique URL
+        # right away.  From here on, URLs are the canonical ones - the raw ones are only used in the invalid entries.
+        Dict_Occurrences = index_urls(URL_Occurrences)
+        Set_ChangedURLs = set()  # URLs found in at least one new or edited service.
+        for svc, svcCategory, lnkName, lnk in URL_Occurrences:
+            if svc.ID not in Unchanged_IDs:
+                Set_ChangedURLs.add(canonical_url(lnk))
 
             # LATE ENHANCEMENT - PER REQUEST OF THE SUPPORT TEAM
             # For URLs from the "Data" Service Category section, whether it is 'up' or 'down', check to see if the URL
@@ -396,19 +876,138 @@ def ProcessURLs(svc_cls, svcCategory, URLs, Dict_AlreadyChecked, List_ErrURLs, L
             # Data Catalog.  If not, report it to the Data_SourceReport log file.
             if "DATA" in svcCategory.upper():
                 if "gis1.servirglobal.net" not in lnk.lower():
-                    # Init a new errEntry class, populate it, and add it to the List of Err Catalogs.
-                    errEntry = InvalidEntry()
-
-                    errEntry.Status = "INCORRECT CATALOG"
-                    errEntry.Region = svc_cls.Regions[0]['Name']
-                    errEntry.ServiceArea = svc_cls.ServiceAreas[0]['Name']
-                    errEntry.Title = svc_cls.Title.replace(",", " ")
-                    errEntry.ID = svc_cls.ID
-                    errEntry.Section = svcCategory
-                    errEntry.SectionEntry = lnkName.replace(",", " ")
-                    errEntry.URL = lnk
-
-                    List_ErrCatalogs.append(errEntry)
+                    List_ErrCatalogs.append(NewInvalidEntry("INCORRECT CATALOG", svc, svcCategory, lnkName, lnk))
+
+        Logfile.info("{0} URLs found ({1} unique once canonicalized).".format(len(URL_Occurrences),
+                                                                          len(Dict_Occurrences)))
+        if progress is not None:
+            progress.start_checking(Services_List, URL_Occurrences, List_ErrCatalogs)
+            progress.set_stage("Checking URLs")
+
+        # Look in the persistent status cache first - only the URLs without a fresh result go to the network.
+        # URLs only found in unchanged services keep their results for the whole staleness window.
+        Dict_Cached = {}
+        if cache is not None:
+            try:
+                with span(tracer, "Look up the status cache"):
+                    toLookup = [lnk for lnk in Dict_Occurrences if lnk not in Dict_AlreadyChecked]
+                    Dict_Cached = cache.lookup([lnk for lnk in toLookup if lnk in Set_ChangedURLs])
+                    if Unchanged_IDs:
+                        Dict_Cached.update(cache.lookup([lnk for lnk in toLookup if lnk not in Set_ChangedURLs],
+                                                        max_age=settings.StalenessWindow))
+                Logfile.info("{0} URLs found in the status cache.".format(len(Dict_Cached)))
+            except (sqlite3.Error, OSError):
+                # Keep going without the cache...
+                error = capture_exception()
+                Logfile.error(error)
+                cache = None
+                links_cache = None
+
+        # Invalid entries are collected with their catalog position so the final list keeps the sequential order.
+        Indexed_ErrURLs = []
+        progressSent = 0  # Entries of Indexed_ErrURLs already handed to the progress.
+        New_Results = []  # (URL, status, code, latency) of each URL checked over the network.
+        ownEngine = engine is None
+        if ownEngine:
+            budget = ByteBudget(settings.ByteBudget)
+            preflight = HostPreflight() if settings.Preflight else None
+            pool = HostConnectionPool(settings.MaxPerHost, settings.ConnectTimeout, settings.ReadTimeout, preflight)
+            engine = NewCheckEngine(settings, budget, deadline, pool, preflight)
+        deadlineHit = False
+        try:
+            if preflight is not None:
+                if progress is not None:
+                    progress.set_stage("Checking hosts")
+                with span(tracer, "Check hosts (preflight)"):
+                    preflight.run([URL_Occurrences[indexes[0]][3].strip() for lnk, indexes in Dict_Occurrences.items()
+                                   if lnk not in Dict_AlreadyChecked and lnk not in Dict_Cached], deadline)
+                if progress is not None:
+                    progress.set_stage("Checking URLs")
+
+            checkStart = time.perf_counter()
+            Dict_Futures = {}
+            for lnk, indexes in Dict_Occurrences.items():
+                if lnk in Dict_AlreadyChecked:
+                    # The URL has already been checked and reported. If "down", go ahead and report it again...
+                    if Dict_AlreadyChecked[lnk] == "down":
+                        for idx in indexes:
+                            svc, svcCategory, lnkName, rawLnk = URL_Occurrences[idx]
+                            Indexed_ErrURLs.append((idx, NewInvalidEntry("DUPLICATE", svc, svcCategory, lnkName,
+                                                                         rawLnk)))
+                    else:
+                        Logfile.debug("\t\t\t{0}\t (previously checked)".format(lnk))
+                elif lnk in Dict_Cached:
+                    status, stat_code, checked_at, latency = Dict_Cached[lnk]
+                    ReportURL(lnk, status, stat_code, URL_Occurrences, indexes, Dict_AlreadyChecked, Indexed_ErrURLs)
+                else:
+                    # Fetch the group's first raw URL as it was written (less the surrounding whitespace) - the
+                    # canonical form is only a key, e.g. a server may answer differently without the trailing slash.
+                    fetchURL = URL_Occurrences[indexes[0]][3].strip()
+                    failure = preflight.failure(fetchURL) if preflight is not None else None
+                    if failure is None:
+                        Dict_Futures[engine.submit(fetchURL)] = (lnk, fetchURL)
+                        continue
+                    # The host does not exist or refuses connections (see HostPreflight.py).
+                    ReportURL(lnk, "down", failure, URL_Occurrences, indexes, Dict_AlreadyChecked, Indexed_ErrURLs)
+                    New_Results.append((lnk, "down", failure, None))
+                if progress is not None:
+                    progress.url_reported(lnk, Indexed_ErrURLs[progressSent:])
+                    progressSent = len(Indexed_ErrURLs)
+
+            # Report each URL as soon as its check finishes.
+            try:
+                for future in as_completed(Dict_Futures, timeout=seconds_until(deadline)):
+                    lnk, fetchURL = Dict_Futures.pop(future)
+                    if future.cancelled():
+                        # A shared check cancelled at the deadline by another caller.
+                        status, stat_code = STATUS_NOT_CHECKED, DEADLINE_CODE
+                    else:
+                        status, stat_code = future.result()
+                    ReportURL(lnk, status, stat_code, URL_Occurrences, Dict_Occurrences[lnk],
+                              Dict_AlreadyChecked, Indexed_ErrURLs)
+                    if status != STATUS_NOT_CHECKED and stat_code != HOST_UNREACHABLE_CODE:
+                        # (URLs of an unreachable host were never actually tried, so they are not cached.)
+                        New_Results.append((lnk, status, stat_code, engine.Latencies.get(fetchURL)))
+                    if progress is not None:
+                        progress.url_reported(lnk, Indexed_ErrURLs[progressSent:])
+                        progressSent = len(Indexed_ErrURLs)
+            except FuturesTimeoutError:
+                # Out of time - whatever has not finished yet is reported as not checked.
+                deadlineHit = True
+                Logfile.error("### DEADLINE ### {0} URLs were not checked in time.".format(len(Dict_Futures)))
+                for future, (lnk, fetchURL) in Dict_Futures.items():
+                    future.cancel()
+                    ReportURL(lnk, STATUS_NOT_CHECKED, DEADLINE_CODE, URL_Occurrences, Dict_Occurrences[lnk],
+                              Dict_AlreadyChecked, Indexed_ErrURLs)
+                    if progress is not None:
+                        progress.url_reported(lnk, Indexed_ErrURLs[progressSent:])
+                        progressSent = len(Indexed_ErrURLs)
+            end_span(tracer, "Check URLs", checkStart, urls=len(Dict_Occurrences))
+        finally:
+            if ownEngine:
+                # Checks still running after the deadline are left to finish (within their timeouts) in the background.
+                engine.shutdown(wait=not deadlineHit)
+                pool.close()
+
+        if ownEngine:
+            Logfile.info("{0} bytes of response bodies read while checking URLs.".format(budget.Used))
+            Logfile.info("{0} connections opened, {1} reused.".format(pool.ConnectionsOpened, pool.ConnectionsReused))
+            LogSchedulerTotals(engine.Scheduler)
+            ReportRunMetrics(engine.Metrics, progress, settings.MetricsPath)
+
+        if cache is not None:
+            try:
+                with span(tracer, "Store the results in the status cache"):
+                    cache.store(New_Results)
+                    cache.evict(settings.StalenessWindow if links_cache is not None else None)
+                    if links_cache is not None:
+                        links_cache.store(Changed_Services)
+            except (sqlite3.Error, OSError):
+                error = capture_exception()
+                Logfile.error(error)
+
+        Indexed_ErrURLs.sort(key=lambda item: item[0])
+        List_ErrURLs.extend(errEntry for idx, errEntry in Indexed_ErrURLs)
 
         return Dict_AlreadyChecked, List_ErrURLs, List_ErrCatalogs
 
@@ -417,14 +1016,159 @@ def ProcessURLs(svc_cls, svcCategory, URLs, Dict_AlreadyChecked, List_ErrURLs, L
         Logfile.error(error)
 
 
-def QueryServiceCatalog(region_id):
+def OwnerRegion(svc_cls, regionIDs):
+    # Returns the ID of the first of the service's regions that is in regionIDs - the one region (of a fan-out run)
+    # that checks the service, so services in more than one region are only checked and reported once.
+    for region in svc_cls.Regions:
+        if region['_id'] in regionIDs:
+            return region['_id']
+    return None
+
+
+def ProcessRegion(regionName, regionID, regionIDs, settings, deadline, progress, engine, api_timeout, preflight=None,
+                  tracer=None):
+    """
+    # Queries the services of one region (streamed, see IterServices()) and checks their URLs with the shared check
+    # engine passed in (see ProcessURLs()).  Only the services owned by the region are checked (see OwnerRegion()).
+    # Returns the dictionary of checked URLs, the 2 lists of invalid entries, and a dictionary of the region's
+    # totals and timing.
+    """
+    timeStart = time.time()
+    traceStart = time.perf_counter()
+    Counts = {"services": 0}
+
+    with span(tracer, "Query the Service Catalog", "network", region=regionName):
+        r = requests.post(ServiceCatalogAPI_URL, json=ServicesPayload(regionID),
+                          timeout=(settings.ConnectTimeout, api_timeout), stream=True)
+    try:
+        queryTime = time.time() - timeStart
+
+        def OwnedServices():
+            for service in IterServices(r, tracer=tracer):
+                svc = NewService(service)
+                if OwnerRegion(svc, regionIDs) == regionID:
+                    Counts["services"] += 1
+                    yield svc
+
+        result = ProcessURLs(OwnedServices(), {}, [], [], settings, deadline, progress, engine, preflight, tracer)
+    finally:
+        r.close()
+        end_span(tracer, "Region", traceStart, region=regionName)
+
+    if result is None:
+        # ProcessURLs() has already logged the error.
+        raise RuntimeError("The URLs of region {0} could not be checked.".format(regionName))
+
+    URL_Dict, ErrURLs_List, ErrCatalogs_List = result
+    stats = {
+        "services": Counts["services"],
+        "urls": len(URL_Dict),
+        "down": sum(value == "down" for value in URL_Dict.values()),
+        "invalid_entries": len(ErrURLs_List),
+        "incorrect_catalogs": len(ErrCatalogs_List),
+        "query_seconds": round(queryTime, 2),
+        "seconds": round(time.time() - timeStart, 2),
+    }
+    return URL_Dict, ErrURLs_List, ErrCatalogs_List, stats
+
+
+def MergeRegionResults(Region_Results):
+    """
+    # Merges the results of the regions of a fan-out run (a list of (URL dictionary, ErrURLs, ErrCatalogs) in region
+    # order) into a single report.  A "down" URL that was already reported by an earlier region (in the same or
+    # another raw form - see URLIndex.py) is reported as a "DUPLICATE", just like it would be within a single run.
+    """
+    URL_Dict = {}
+    ErrURLs_List = ResultList()
+    ErrCatalogs_List = ResultList()
+    Reported_Down = set()
+    for Region_URLs, Region_ErrURLs, Region_ErrCatalogs in Region_Results:
+        for lnk, status in Region_URLs.items():
+            URL_Dict.setdefault(lnk, status)
+        for errEntry in Region_ErrURLs:
+            if errEntry.Status not in ("DUPLICATE", DEADLINE_CODE):
+                if canonical_url(errEntry.URL) in Reported_Down:
+                    errEntry.Status = "DUPLICATE"
+                else:
+                    Reported_Down.add(canonical_url(errEntry.URL))
+            ErrURLs_List.append(errEntry)
+        ErrCatalogs_List.extend(Region_ErrCatalogs)
+    return URL_Dict, ErrURLs_List, ErrCatalogs_List
+
+
+def ProcessRegions(Dict_Regions, settings, deadline=None, progress=None, api_timeout=API_READ_TIMEOUT, tracer=None):
+    """
+    # Fan-out version of an "All" run: sends one searchServices query per region (Dict_Regions is the
+    # {name: ID} dictionary from GetAllRegions()) at the same time, and checks each region's URLs in parallel.
+    # All regions share one check engine, connection pool and byte budget, so a URL found in several regions is still
+    # only fetched once.  The results are merged into one report (see MergeRegionResults()), and the totals and
+    # timing of each region are logged (and passed to the RunProgress, if any).
+    #
+    # Returns the same dictionary and 2 lists as ProcessURLs().
+    """
+    regionIDs = set(Dict_Regions.values())
+    Logfile.info("Checking {0} regions in parallel.".format(len(Dict_Regions)))
+
+    budget = ByteBudget(settings.ByteBudget)
+    preflight = HostPreflight() if settings.Preflight else None
+    pool = HostConnectionPool(settings.MaxPerHost, settings.ConnectTimeout, settings.ReadTimeout, preflight)
+    engine = NewCheckEngine(settings, budget, deadline, pool, preflight)
+    Region_Results = []
+    try:
+        with ThreadPoolExecutor(max_workers=len(Dict_Regions)) as executor:
+            Dict_Futures = {}
+            for regionName, regionID in Dict_Regions.items():
+                Dict_Futures[regionName] = executor.submit(ProcessRegion, regionName, regionID, regionIDs, settings,
+                                                           deadline, progress, engine, api_timeout, preflight, tracer)
+
+            # Merge in region order (the dictionary is sorted by name), whatever order the regions finish in.
+            for regionName, future in Dict_Futures.items():
+                try:
+                    URL_Dict, ErrURLs_List, ErrCatalogs_List, stats = future.result()
+                except:
+                    error = capture_exception()
+                    Logfile.error(error)
+                    continue
+                Logfile.info("=== REGION {0} ===>: {1} services, {2} URLs, {3} down, {4} invalid entries, "
+                             "{5} seconds".format(regionName, stats["services"], stats["urls"], stats["down"],
+                                                  stats["invalid_entries"], stats["seconds"]))
+                if progress is not None:
+                    progress.region_done(regionName, stats)
+                Region_Results.append((URL_Dict, ErrURLs_List, ErrCatalogs_List))
+    finally:
+        # Checks still running after the deadline are left to finish (within their timeouts) in the background.
+        engine.shutdown(wait=not deadline_passed(deadline))
+        pool.close()
+
+    Logfile.info("{0} bytes of response bodies read while checking URLs.".format(budget.Used))
+    Logfile.info("{0} connections opened, {1} reused.".format(pool.ConnectionsOpened, pool.ConnectionsReused))
+    LogSchedulerTotals(engine.Scheduler)
+    ReportRunMetrics(engine.Metrics, progress, settings.MetricsPath)
+
+    with span(tracer, "Merge the region results"):
+        return MergeRegionResults(Region_Results)
+
+
+def QueryServiceCatalog(region_id, settings=None, run_deadline=None, progress=None, tracer=None):
     """
     #  Entry point from Django - ServiceCatalogURLs.CheckURLs.views.py
     #  Calls the Service Catalog API with the Region passed in to retrieve all related Services and associated
     #  Tools, Data, News, and Training Materials links. It then checks each URL and returns a List of ErrURLs to
     #  the calling function. It also checks "Data" URLs to see if they contain "gis1.servirglobal.net". If not,
     #  those entries are added to the List of ErrCatalogs, which is also returned.
+    #  settings is a CheckSettings object picking the URL checker backend, concurrency, probe mode, byte budget,
+    #  timeouts and connections per host (the defaults are used if not passed in).  run_deadline is the most seconds
+    #  the whole run may take - any URLs not checked by then are reported as "NOT CHECKED (deadline)".
+    #  progress is an optional CheckJobs.RunProgress that is kept up to date as the run goes.
+    #  "All" runs (an empty region_id) query and check each region in parallel, unless fan_out is turned off in the
+    #  settings (see ProcessRegions()).
+    #  Raises NoConnectivityError if the internet can not be reached (see is_internet_reachable()).  Any other error
+    #  is logged, and nothing is returned.
+    #  tracer is an optional Tracing.Tracer that records the time each stage of the run takes (see Tracing.py).
     """
+    if settings is None:
+        settings = CheckSettings()
+    traceStart = time.perf_counter()
     try:
         # Setup the logging.  args.logging will either be passed in as an optinal argument by the user,
         # or will assume the default as specified in setupArgs().
@@ -432,12 +1176,21 @@ def QueryServiceCatalog(region_id):
 
         # Get a start time for the entire script run process.
         time_TotalScriptRun = get_NewStart_Time()
+        deadline = None
+        if run_deadline:
+            deadline = time_TotalScriptRun + run_deadline
+            Logfile.info("Run deadline: {0} seconds.".format(run_deadline))
 
         # Make sure we can see the internet!
-        if not is_internet_reachable():
+        if progress is not None:
+            progress.set_stage("Querying the Service Catalog")
+        with span(tracer, "Check connectivity", "network"):
+            reachable = is_internet_reachable()
+        if not reachable:
             Logfile.error("Internet is not accessible.")
             Logfile.info('------------------------- Processing Halted -------------------------')
-            sys.exit()
+            raise NoConnectivityError("The internet could not be reached from the server (none of {0} answered) - "
+                                      "please try again later.".format(", ".join(Connectivity_Endpoints)))
 
         # Sample query to use in the API call for All Services!
         # PAYLOAD = {
@@ -463,36 +1216,8 @@ def QueryServiceCatalog(region_id):
         #     "}"
         # }
 
-        # Lets build the API query in parts so that we can insert the region passed in, if specified.
-        # Build the Query portion of the API call using the Region passed in.
-        firstPart = "{   services: searchServices(regions: ["
-        if len(region_id) > 0:
-            middlePart = "\"" + region_id + "\""
-        else:
-            middlePart = ""
-        lastPart = "], countries: [], serviceAreas: [], status: [], dataSources: [], freeText: \"\") {" \
-                   "       _id" \
-                   "       Title" \
-                   "       regions {" \
-                   "           _id" \
-                   "           Name" \
-                   "       }" \
-                   "       serviceareas {" \
-                   "           _id" \
-                   "           Name" \
-                   "       }" \
-                   "       Data" \
-                   "       Tools" \
-                   "       News" \
-                   "       TrainingMaterials" \
-                   "   }" \
-                   "}"
-
-        PAYLOAD = {
-            "operationName": "",
-            "variables": {},
-            "query": firstPart + middlePart + lastPart
-        }
+        # Build the API query using the Region passed in (see ServicesPayload()).
+        PAYLOAD = ServicesPayload(region_id)
         # Debug!!!
         # print(" --- ")
         # print(firstPart + middlePart + lastPart)
@@ -529,67 +1254,43 @@ def QueryServiceCatalog(region_id):
         # Send the API request and get the result.
         # args.api will either contain the URL passed in as an optional argument, or if not specified, it will contain
         # the default value as specified in setupArgs().
-        r = requests.post(ServiceCatalogAPI_URL, json=PAYLOAD)
-        json_data = r.json()
-
-        Logfile.info("{0} services retrieved from Service Catalog API.".format(len(json_data['data']['services'])))
-
-        # Not great to loop through services twice, but wanted to grab each service into a class and build
-        # a list of class objects so that I know what I'm working with later...
-        Services_List = []
-        for service in json_data['data']['services']:
-            svc = Service()
-            svc.ID = service['_id']
-            svc.Title = service['Title']
-            svc.Regions = service['regions']
-            svc.ServiceAreas = service['serviceareas']
-            svc.Data = service['Data']
-            svc.Tools = service['Tools']
-            svc.News = service['News']
-            svc.TrainingMaterials = service['TrainingMaterials']
-            # Add the class to the list of services.
-            Services_List.append(svc)
-
-        # Process each Service
-        # #######################
-        URL_Dict = {}
-        ErrURLs_List = []
-        ErrCatalogs_List = []
-        for svc in Services_List:
-            Logfile.info("Service: {0}".format(svc.Title))
-
-            # Process Data
-            # #######################
-            DataURLs = GetURLs_FromString(svc.Data)
-            Logfile.debug("\t\tData:\t({0} total)".format(len(DataURLs)))
-            URL_Dict, ErrURLs_List, ErrCatalogs_List = ProcessURLs(svc, "DATA", DataURLs,
-                                                                   URL_Dict, ErrURLs_List, ErrCatalogs_List)
-
-            # Process Tools
-            # #######################
-            ToolsURLs = GetURLs_FromString(svc.Tools)
-            Logfile.debug("\t\tTools:\t({0} total)".format(len(ToolsURLs)))
-            URL_Dict, ErrURLs_List, ErrCatalogs_List = ProcessURLs(svc, "TOOLS", ToolsURLs,
-                                                                   URL_Dict, ErrURLs_List, ErrCatalogs_List)
-
-            # Process News
-            # #######################
-            NewsURLs = GetURLs_FromString(svc.News)
-            Logfile.debug("\t\tNews:\t({0} total)".format(len(NewsURLs)))
-            URL_Dict, ErrURLs_List, ErrCatalogs_List = ProcessURLs(svc, "NEWS", NewsURLs,
-                                                                   URL_Dict, ErrURLs_List, ErrCatalogs_List)
-
-            # Process Training Materials
-            # #######################
-            TrainingMaterialsURLs = GetURLs_FromString(svc.TrainingMaterials)
-            Logfile.debug("\t\tTraining Materials:\t({0} total)".format(len(TrainingMaterialsURLs)))
-            URL_Dict, ErrURLs_List, ErrCatalogs_List = ProcessURLs(svc, "TRAINING MATERIALS", TrainingMaterialsURLs,
-                                                                   URL_Dict, ErrURLs_List, ErrCatalogs_List)
+        apiTimeout = API_READ_TIMEOUT if deadline is None else max(1, min(API_READ_TIMEOUT, seconds_until(deadline)))
+
+        # "All" runs are split up by region: every region is queried and checked at the same time.
+        Dict_Regions = None
+        if len(region_id) == 0 and settings.FanOut:
+            with span(tracer, "Query the regions", "network"):
+                Dict_Regions = GetAllRegions()
+            if not Dict_Regions:
+                Logfile.error("Could not retrieve the regions - checking all services in a single query instead.")
+
+        if Dict_Regions:
+            URL_Dict, ErrURLs_List, ErrCatalogs_List = ProcessRegions(Dict_Regions, settings, deadline, progress,
+                                                                      apiTimeout, tracer)
+        else:
+            # The response is streamed: each service record is turned into a Service and has its links extracted as
+            # soon as it has been read, instead of holding the whole response, the decoded JSON and a list of every
+            # Service in memory at once.
+            with span(tracer, "Query the Service Catalog", "network"):
+                r = requests.post(ServiceCatalogAPI_URL, json=PAYLOAD, timeout=(settings.ConnectTimeout, apiTimeout),
+                                  stream=True)
+            try:
+                Services = (NewService(service) for service in IterServices(r, tracer=tracer))
+
+                # Process each Service
+                # #######################
+                URL_Dict = {}
+                ErrURLs_List = ResultList()
+                ErrCatalogs_List = ResultList()
+                URL_Dict, ErrURLs_List, ErrCatalogs_List = ProcessURLs(Services, URL_Dict, ErrURLs_List,
+                                                                       ErrCatalogs_List, settings, deadline, progress,
+                                                                       tracer=tracer)
+            finally:
+                r.close()
 
         # In case there were no error URLs or Invalid Catalog entries found, insert a dummy placeholder entry.
         # This should be done in the calling function, but for now...
-        dummyEntry = InvalidEntry()
-        dummyEntry.Status = "No Data to Report"
+        dummyEntry = InvalidEntry(NO_DATA_STATUS)
         if len(ErrURLs_List) < 1:
             ErrURLs_List.append(dummyEntry)
         if len(ErrCatalogs_List) < 1:
@@ -599,18 +1300,27 @@ def QueryServiceCatalog(region_id):
         Logfile.info("=== TOTAL URLs CHECKED ===>: {0}".format(len(URL_Dict)))
         numDown = sum(value == "down" for value in URL_Dict.values())
         Logfile.info("=== NUMBER OF THOSE URLs 'DOWN' ===>: {0}  (not including DUPLICATES)".format(numDown))
+        numNotChecked = sum(value == STATUS_NOT_CHECKED for value in URL_Dict.values())
+        if numNotChecked > 0:
+            Logfile.info("=== NUMBER OF URLs NOT CHECKED BEFORE THE DEADLINE ===>: {0}".format(numNotChecked))
+        if progress is not None:
+            progress.finish(len(URL_Dict), numDown, numNotChecked)
 
         #  Cleanup objects when done...
         del URL_Dict
-        del Services_List
 
         return ErrURLs_List, ErrCatalogs_List
 
+    except NoConnectivityError:
+        # Passed on to the caller, which shows the message to the user (see CheckJobs.CheckJob.run()).
+        raise
+
     except:
         err = capture_exception()
         Logfile.error(err)
 
     finally:
+        end_span(tracer, "Check run", traceStart, "run", region=region_id or "All")
         Logfile.info("=== TOTAL RUN TIME ===>: " +
                          get_Elapsed_Time_As_String(time_TotalScriptRun))
         Logfile.info('------------------------- Processing Complete -------------------------')
@@ -625,7 +1335,7 @@ def QueryServiceCatalog_DummyTestReturn(region_id):
 
     Logfile.info('------------------------- Processing Starting -------------------------')
     # ##### INVALID URL ENTRIES #####
-    tstURLs_List = []
+    tstURLs_List = ResultList()
 
     tstEntry1 = InvalidEntry()
     tstEntry1.Status = "403"
@@ -679,7 +1389,7 @@ def QueryServiceCatalog_DummyTestReturn(region_id):
     tstURLs_List.append(tstEntry4)
 
     # ##### ERRANT CATALOG ENTRIES #####
-    tstCatalogs_List = []
+    tstCatalogs_List = ResultList()
 
     catalogEntry1 = InvalidEntry()
     catalogEntry1.Status = "INCORRECT CATALOG"
@@ -694,8 +1404,7 @@ def QueryServiceCatalog_DummyTestReturn(region_id):
     tstCatalogs_List.append(catalogEntry1)
 
     # In case there were no error URLs or Invalid Catalog entries found, insert a dummy placeholder entry.
-    dummyEntry = InvalidEntry()
-    dummyEntry.Status = "No Data to Report"
+    dummyEntry = InvalidEntry(NO_DATA_STATUS)
     if len(tstURLs_List) < 1:
         Logfile.debug("Adding DUMMY entry to: tstURLs_List")
         tstURLs_List.append(dummyEntry)
@@ -710,35 +1419,19 @@ def QueryServiceCatalog_DummyTestReturn(region_id):
 
 # For debugging / running in the PyCharm IDE...
 # Note - This is not called when running in the Django environment.
-if __name__ == "__main__":
-    # "5bb3f96f51ebdcae796832e6" = Eastern/Southern Africa
-    # "5bb3f96951ebdcae796832e5" = West Africa
-    # "5bb3f97b51ebdcae796832e9" = Mekong
-    # "5bb3f97451ebdcae796832e7" = Himalaya
-    InvalidURLs_List, InvalidCatalogs_List = QueryServiceCatalog_DummyTestReturn("5bb3f96951ebdcae796832e5")
-    # InvalidURLs_List, InvalidCatalogs_List = QueryServiceCatalog("5bb3f96951ebdcae796832e5")
-
-    for item in InvalidURLs_List:
-        Logfile.info("------------ Invalid URL ----------------------")
-        Logfile.info("{0}".format(item.Status))
-        Logfile.info("{0}".format(item.Region))
-        Logfile.info("{0}".format(item.ServiceArea))
-        Logfile.info("{0}".format(item.Title))
-        Logfile.info("{0}".format(item.ID))
-        Logfile.info("{0}".format(item.Section))
-        Logfile.info("{0}".format(item.SectionEntry))
-        Logfile.info("{0}".format(item.URL))
-
-    for entry in InvalidCatalogs_List:
-        Logfile.info("------------ Invalid Catalog ----------------------")
-        Logfile.info("{0}".format(entry.Status))
-        Logfile.info("{0}".format(entry.Region))
-        Logfile.info("{0}".format(entry.ServiceArea))
-        Logfile.info("{0}".format(entry.Title))
-        Logfile.info("{0}".format(entry.ID))
-        Logfile.info("{0}".format(entry.Section))
-        Logfile.info("{0}".format(entry.SectionEntry))
-        Logfile.info("{0}".format(entry.URL))
+# The headless check runs that used to be started from here (see the old __main__ block below) are now done by the
+# crawler, which saves their results as snapshots for the queryresult page:
+#     python -m tethysapp.servicecatalogurls.Crawler --help
+# (This module uses relative imports, so it can not be run as a script itself.)
+#
+# if __name__ == "__main__":
+#     # "5bb3f96f51ebdcae796832e6" = Eastern/Southern Africa
+#     # "5bb3f96951ebdcae796832e5" = West Africa
+#     # "5bb3f97b51ebdcae796832e9" = Mekong
+#     # "5bb3f97451ebdcae796832e7" = Himalaya
+#     InvalidURLs_List, InvalidCatalogs_List = QueryServiceCatalog_DummyTestReturn("5bb3f96951ebdcae796832e5")
+#     # InvalidURLs_List, InvalidCatalogs_List = QueryServiceCatalog("5bb3f96951ebdcae796832e5")
+#     ...  (every field of every entry was logged - see Crawler.log_entries())
 
 
 # if __name__ == "__main__":
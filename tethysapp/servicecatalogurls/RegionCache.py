@@ -0,0 +1,135 @@
+"""
+# Initial Creation:
+#   Cached list of the SERVIR regions shown on the home page.
+# General Description:
+#   QueryCatalog.GetAllRegions() calls the Service Catalog API, so every home page load used to wait on (and break
+#   with) the remote server.  RegionListCache keeps the last good region list in memory and in a JSON file in the app
+#   workspace (so it survives restarts and is shared by the worker processes).  Once the list is older than its time
+#   to live, the old copy is still handed out right away while a background thread fetches a new one
+#   (stale-while-revalidate).  If the API call fails, the last good copy simply stays in use.  The API is only waited
+#   on when there is no copy at all yet.
+"""
+import json
+import os
+import threading
+import time
+
+from .CheckEngine import APP_WORKSPACE_PATH
+from .QueryCatalog import GetAllRegions, capture_exception
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+RegionCache_Path = os.path.join(APP_WORKSPACE_PATH, "regions.json")
+
+# Seconds the region list is used before it is refreshed in the background.
+REGION_CACHE_TTL = 60 * 60
+
+# Seconds to wait before trying the API again after a failed refresh.
+REGION_RETRY_SECONDS = 60
+
+
+class RegionListCache(object):
+    """
+    # In memory and on disk cache of the {region name: region ID} dictionary returned by GetAllRegions().
+    """
+
+    def __init__(self, path=RegionCache_Path, ttl=REGION_CACHE_TTL, fetch=GetAllRegions):
+        self.Path = path
+        self.TTL = ttl
+        self.Fetch = fetch
+        self.Regions = None
+        self.FetchedAt = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._nextTry = 0  # No background refresh is started before this time (after a failed one).
+
+    def _load(self):
+        # Reads the last good copy from disk, if there is one.
+        try:
+            with open(self.Path) as f:
+                saved = json.load(f)
+            self.Regions = saved["regions"]
+            self.FetchedAt = saved["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self, regions, fetched_at):
+        # Writes to a temporary file first so another process never reads a half-written file.
+        try:
+            folder = os.path.dirname(self.Path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            tmpPath = "{0}.{1}.tmp".format(self.Path, os.getpid())
+            with open(tmpPath, "w") as f:
+                json.dump({"regions": regions, "fetched_at": fetched_at}, f)
+            os.replace(tmpPath, self.Path)
+        except OSError:
+            error = capture_exception()
+            Logfile.error(error)
+
+    def refresh(self):
+        """
+        # Calls the API for a new region list.  Keeps (and returns) the last good copy if the call fails.
+        """
+        try:
+            regions = self.Fetch()
+            if regions:
+                fetchedAt = time.time()
+                with self._lock:
+                    self.Regions = regions
+                    self.FetchedAt = fetchedAt
+                self._save(regions, fetchedAt)
+                return regions
+            Logfile.error("Could not retrieve the regions - using the last good copy.")
+        except:
+            error = capture_exception()
+            Logfile.error(error)
+        finally:
+            with self._lock:
+                self._refreshing = False
+        self._nextTry = time.time() + REGION_RETRY_SECONDS
+        return self.Regions
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or time.time() < self._nextTry:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="RegionListCache", daemon=True).start()
+
+    def get(self):
+        """
+        # Returns the region dictionary right away (an empty one if it has never been retrieved successfully).
+        # A copy older than the time to live is still returned, and a new one is fetched in the background.
+        """
+        with self._lock:
+            if self.Regions is None:
+                self._load()
+            regions = self.Regions
+            stale = time.time() - self.FetchedAt > self.TTL
+            if regions is not None and stale and not self._refreshing:
+                # Another process may have refreshed the file in the meantime.
+                self._load()
+                regions = self.Regions
+                stale = time.time() - self.FetchedAt > self.TTL
+
+        if regions is None:
+            # Nothing cached at all yet - this is the only time the API is waited on.
+            with self._lock:
+                self._refreshing = True
+            return self.refresh() or {}
+
+        if stale:
+            self._refresh_in_background()
+        return regions
+
+
+_Region_Cache = RegionListCache()
+
+
+def GetCachedRegions():
+    """
+    #  Entry point from Django - the home page.  Returns the (cached) {region name: region ID} dictionary.
+    """
+    return _Region_Cache.get()
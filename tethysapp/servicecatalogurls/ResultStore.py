@@ -0,0 +1,101 @@
+"""
+# Initial Creation:
+#   Compact store of the invalid entries (bad URLs and "INCORRECT CATALOG" entries) found by a check run.
+# General Description:
+#   A run can report tens of thousands of invalid entries, and every one of them used to be a full Python object with
+#   its own attribute dictionary and its own copy of the Region, ServiceArea, Title and ID strings of its service.
+#   InvalidEntry records now have fixed slots (no dictionary per entry), and the strings that repeat from entry to
+#   entry - status, region, service area, title, ID and section - are interned, so every entry of a service shares
+#   one copy of each.
+#
+#   ResultList is the list the runs return the entries in.  It is a plain list (so it is appended to in bulk with
+#   extend(), and the templates loop over it as before) that can also filter itself and be turned into (and back
+#   from) plain dictionaries for JSON responses and files.
+"""
+import sys
+
+# Status of the placeholder entry QueryServiceCatalog() adds to an empty list.
+NO_DATA_STATUS = "No Data to Report"
+
+# Fields of an entry, in the order they are serialized, and the keys they are serialized as.
+ENTRY_FIELDS = (("Status", "status"), ("Region", "region"), ("ServiceArea", "servicearea"), ("Title", "title"),
+                ("ID", "id"), ("Section", "section"), ("SectionEntry", "sectionentry"), ("URL", "url"))
+
+
+def _intern(value):
+    # Interns strings (the ones shared by many entries) - anything else is passed back as it is.
+    return sys.intern(value) if type(value) is str else value
+
+
+class InvalidEntry(object):
+    """
+    # One invalid entry: the status (code) of the URL, where the URL was found (region, service area, service title
+    # and ID, section and section entry name) and the URL itself.
+    """
+
+    __slots__ = [attribute for attribute, key in ENTRY_FIELDS]
+
+    def __init__(self, status="", region="", servicearea="", title="", identifier="", section="", sectionentry="",
+                 url=""):
+        self.Status = _intern(status)
+        self.Region = _intern(region)
+        self.ServiceArea = _intern(servicearea)
+        self.Title = _intern(title)
+        self.ID = _intern(identifier)
+        self.Section = _intern(section)
+        self.SectionEntry = sectionentry
+        self.URL = url
+
+    def __getitem__(self, name):
+        # Django templates try item["Status"] before item.Status - answering it directly saves an exception (and its
+        # handling) for every cell of a results table.
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __repr__(self):
+        return "InvalidEntry({0!r}, {1!r})".format(self.Status, self.URL)
+
+    def as_dict(self):
+        # Returns the fields of the entry as a dictionary (e.g. for a JSON response).
+        return dict((key, getattr(self, attribute)) for attribute, key in ENTRY_FIELDS)
+
+    @classmethod
+    def from_dict(cls, entry):
+        # Builds an entry back from a dictionary made by as_dict().
+        return cls(*[entry.get(key, "") for attribute, key in ENTRY_FIELDS])
+
+
+class ResultList(list):
+    """
+    # List of InvalidEntry records returned by a check run (see above).
+    """
+
+    def __getitem__(self, index):
+        # A slice (e.g. a page of the results) is a ResultList as well.
+        if isinstance(index, slice):
+            return ResultList(list.__getitem__(self, index))
+        return list.__getitem__(self, index)
+
+    def filter(self, region=None, section=None, status=None):
+        """
+        # Returns a ResultList of the entries matching every filter passed in (region name and section are not case
+        # sensitive).  The placeholder entry is never included.
+        """
+        region = region.lower() if region else None
+        section = section.upper() if section else None
+        return ResultList(entry for entry in self
+                          if entry.Status != NO_DATA_STATUS
+                          and (region is None or str(entry.Region).lower() == region)
+                          and (section is None or entry.Section == section)
+                          and (status is None or str(entry.Status) == status))
+
+    def as_dicts(self):
+        # Returns the entries as a list of dictionaries (see InvalidEntry.as_dict()).
+        return [entry.as_dict() for entry in self]
+
+    @classmethod
+    def from_dicts(cls, entries):
+        # Builds a ResultList back from the list of dictionaries made by as_dicts().
+        return cls(InvalidEntry.from_dict(entry) for entry in entries)
@@ -0,0 +1,170 @@
+"""
+# Initial Creation:
+#   Result snapshots of the scheduled check runs, served by the queryresult page.
+# General Description:
+#   A full check of the catalog takes minutes, and every visit to the results page used to start (and wait on) a new
+#   one.  The headless crawler (see Crawler.py) now checks the catalog on a schedule and saves the results of each run
+#   as a timestamped JSON snapshot in the app workspace (SNAPSHOT_PATH).  controllers.queryresult shows the latest
+#   snapshot right away, and only starts a live run when asked to (or when there is no snapshot yet).
+#
+#   A snapshot holds the two lists of invalid entries (see ResultStore.py) and the run's summary (totals, region and
+#   host breakdowns).  A region with no snapshot of its own is served from the latest "All" snapshot, filtered down
+#   to the region (a service listed in several regions shows up under the first one, as in every "All" run).  The
+#   newest MAX_SNAPSHOTS snapshots of each region are kept, and the latest one is kept in memory once read, so it is
+#   only parsed again when a newer one is saved (by this or another process).  A snapshot older than
+#   MAX_SNAPSHOT_AGE (e.g. the crawler has stopped) is not served at all - the page runs a live check instead.
+"""
+import json
+import os
+import threading
+import time
+
+from .CheckEngine import APP_WORKSPACE_PATH
+from .ResultStore import InvalidEntry, ResultList, NO_DATA_STATUS
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.path.join(APP_WORKSPACE_PATH, "snapshots")
+
+# Snapshots kept for each region (the older ones are deleted as new ones are saved).
+MAX_SNAPSHOTS = 10
+
+# Seconds a snapshot is served for after it was taken.
+MAX_SNAPSHOT_AGE = 24 * 60 * 60
+
+# Key of the "All" runs in the snapshot file names.
+ALL_REGIONS_KEY = "all"
+
+_Snapshot_Lock = threading.Lock()
+_Latest = {}  # Region key -> (path, Snapshot) of the latest snapshot of the region read so far.
+
+
+def region_key(region_id):
+    return region_id or ALL_REGIONS_KEY
+
+
+class Snapshot(object):
+    """
+    # The results of one check run, as saved by save_snapshot().
+    """
+
+    def __init__(self, region_id, created, run_time, summary, err_urls, err_catalogs, path=None):
+        self.RegionID = region_id
+        self.Created = created
+        self.RunTime = run_time
+        self.Summary = summary
+        self.ErrURLs = err_urls
+        self.ErrCatalogs = err_catalogs
+        self.Path = path
+
+    def age(self):
+        # Seconds since the snapshot was taken.
+        return max(0, time.time() - self.Created)
+
+    def as_dict(self):
+        return {
+            "region_id": self.RegionID,
+            "created": self.Created,
+            "run_time": self.RunTime,
+            "summary": self.Summary,
+            "errors": self.ErrURLs.as_dicts(),
+            "catalogs": self.ErrCatalogs.as_dicts(),
+        }
+
+    @classmethod
+    def from_dict(cls, saved, path=None):
+        return cls(saved["region_id"], saved["created"], saved.get("run_time"), saved.get("summary") or {},
+                   ResultList.from_dicts(saved["errors"]), ResultList.from_dicts(saved["catalogs"]), path)
+
+    def for_region(self, region_name, region_id):
+        """
+        # Returns a Snapshot of the entries of one region only (an "All" snapshot filtered by the region's name).
+        """
+        regions = self.Summary.get("regions") or {}
+        summary = {"regions": {region_name: regions[region_name]}} if region_name in regions else {}
+        return Snapshot(region_id, self.Created, self.RunTime, summary,
+                        with_placeholder(self.ErrURLs.filter(region=region_name)),
+                        with_placeholder(self.ErrCatalogs.filter(region=region_name)), self.Path)
+
+
+def with_placeholder(entries):
+    # Adds the placeholder entry QueryServiceCatalog() puts in an empty list.
+    if len(entries) < 1:
+        entries.append(InvalidEntry(NO_DATA_STATUS))
+    return entries
+
+
+def snapshot_files(region_id, folder=SNAPSHOT_PATH):
+    # Paths of the region's snapshots, oldest first (the file names sort by time).
+    prefix = "snapshot_{0}_".format(region_key(region_id))
+    try:
+        names = sorted(name for name in os.listdir(folder) if name.startswith(prefix) and name.endswith(".json"))
+    except OSError:
+        return []
+    return [os.path.join(folder, name) for name in names]
+
+
+def save_snapshot(job, folder=SNAPSHOT_PATH):
+    """
+    # Saves the results of a finished CheckJob (see CheckJobs.py) as the newest snapshot of its region, and returns
+    # its path.  The file is written under a temporary name first, so no process ever reads a half-written snapshot.
+    """
+    created = job.Finished or time.time()
+    summary = job.summary()
+    snapshot = Snapshot(job.RegionID, created, summary.get("run_time"), summary, job.ErrURLs, job.ErrCatalogs)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, "snapshot_{0}_{1}.json".format(region_key(job.RegionID),
+                                                                 time.strftime("%Y%m%d-%H%M%S",
+                                                                               time.localtime(created))))
+    tmpPath = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmpPath, "w") as f:
+        json.dump(snapshot.as_dict(), f)
+    os.replace(tmpPath, path)
+    Logfile.info("Snapshot saved to {0}".format(path))
+
+    for oldPath in snapshot_files(job.RegionID, folder)[:-MAX_SNAPSHOTS]:
+        try:
+            os.remove(oldPath)
+        except OSError:
+            pass
+    return path
+
+
+def load_snapshot(region_id, path):
+    # Returns the region's Snapshot saved in the file - only read from disk if it is not the one already in memory.
+    key = region_key(region_id)
+    with _Snapshot_Lock:
+        latest = _Latest.get(key)
+    if latest is not None and latest[0] == path:
+        return latest[1]
+    with open(path) as f:
+        snapshot = Snapshot.from_dict(json.load(f), path)
+    with _Snapshot_Lock:
+        _Latest[key] = (path, snapshot)
+    return snapshot
+
+
+def latest_snapshot(region_id, region_name=None, folder=SNAPSHOT_PATH, max_age=MAX_SNAPSHOT_AGE):
+    """
+    # Returns the latest Snapshot of the region (region_id "" for "All") - or, for a region without a recent one of
+    # its own, the latest "All" snapshot filtered to the region's name.  Returns None if there is no snapshot taken in
+    # the last max_age seconds (None for any age) to serve.
+    """
+    keys = [region_id] if not region_id or not region_name else [region_id, ""]
+    for key in keys:
+        for path in reversed(snapshot_files(key, folder)):
+            try:
+                snapshot = load_snapshot(key, path)
+            except (OSError, ValueError, KeyError, TypeError):
+                # Half-deleted or broken - try the one before.
+                Logfile.error("Could not read the snapshot {0}".format(path))
+                continue
+            if max_age is not None and snapshot.age() > max_age:
+                Logfile.info("The latest snapshot {0} is too old to be served.".format(path))
+                break
+            if key != region_id:
+                snapshot = snapshot.for_region(region_name, region_id)
+            return snapshot
+    return None
@@ -0,0 +1,208 @@
+"""
+# Initial Creation:
+#   Persistent URL status cache shared by every run and every worker process.
+# General Description:
+#   The dictionary of already checked URLs in QueryCatalog.ProcessURLs() only lives for one run, so every run starts
+#   cold and each web server worker process has its own copy.  URLStatusCache keeps the result of each URL check
+#   (status, code, check time and latency) in a SQLite database in the app workspace, which all worker processes can
+#   share.  Results expire after a configurable time to live (shorter for "down" URLs, so fixed links show up quickly)
+#   and the least recently used entries are evicted once the cache grows past its size limit.
+#
+#   ServiceLinkCache keeps a hash of each service's category fields along with the links extracted from them, so an
+#   incremental run can reuse the links (and the cached results) of services that have not been edited.
+"""
+import json
+import os
+import sqlite3
+import time
+
+from .CheckEngine import APP_WORKSPACE_PATH
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+StatusCache_Path = os.path.join(APP_WORKSPACE_PATH, "url_status_cache.sqlite3")
+
+# Default times to live (in seconds) of cached results, and the most URLs kept in the cache.
+CACHE_UP_TTL = 6 * 60 * 60
+CACHE_DOWN_TTL = 15 * 60
+CACHE_MAX_ENTRIES = 50000
+
+# Default staleness window (in seconds) of incremental runs: how long the links and results of a service that has not
+# been edited are reused before they are checked again.
+INCREMENTAL_STALENESS = 24 * 60 * 60
+
+# Seconds to wait for another worker process to finish writing before giving up.
+SQLITE_BUSY_TIMEOUT = 30
+
+# Most parameters in a single "... IN (?, ?, ...)" query (SQLite's default limit is 999).
+SQLITE_MAX_PARAMS = 900
+
+
+def connect(path):
+    """
+    # Opens the SQLite database at path (creating its folder if needed).  WAL mode lets the worker processes read
+    # the cache while another one is writing to it.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def chunks(items, size=SQLITE_MAX_PARAMS):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class URLStatusCache(object):
+    """
+    # SQLite backed cache of URL check results.  "up" results are good for up_ttl seconds, anything else for
+    # down_ttl seconds.  No more than max_entries URLs are kept - the least recently used ones are evicted first.
+    """
+
+    def __init__(self, path=StatusCache_Path, up_ttl=CACHE_UP_TTL, down_ttl=CACHE_DOWN_TTL,
+                 max_entries=CACHE_MAX_ENTRIES):
+        self.Path = path
+        self.UpTTL = up_ttl
+        self.DownTTL = down_ttl
+        self.MaxEntries = max_entries
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS url_status ("
+                             "  url TEXT PRIMARY KEY,"
+                             "  status TEXT NOT NULL,"
+                             "  code TEXT,"
+                             "  checked_at REAL NOT NULL,"
+                             "  latency REAL,"
+                             "  last_access REAL NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS url_status_last_access ON url_status (last_access)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return connect(self.Path)
+
+    def lookup(self, urls, max_age=None):
+        """
+        # Returns a dictionary of URL -> (status, code, checked_at, latency) for the URLs passed in that have a
+        # result in the cache that has not expired yet.  max_age (in seconds) overrides both times to live.
+        # The URLs found are marked as just used, so they are the last to be evicted.
+        """
+        now = time.time()
+        found = {}
+        urls = list(urls)
+        conn = self._connect()
+        try:
+            with conn:
+                for batch in chunks(urls):
+                    rows = conn.execute("SELECT url, status, code, checked_at, latency FROM url_status "
+                                        "WHERE url IN ({0})".format(",".join("?" * len(batch))), batch)
+                    for url, status, code, checked_at, latency in rows:
+                        ttl = max_age if max_age is not None else (self.UpTTL if status == "up" else self.DownTTL)
+                        if now - checked_at <= ttl:
+                            found[url] = (status, code, checked_at, latency)
+
+                hits = list(found)
+                for batch in chunks(hits):
+                    conn.execute("UPDATE url_status SET last_access = ? WHERE url IN ({0})".format(
+                        ",".join("?" * len(batch))), [now] + batch)
+        finally:
+            conn.close()
+        return found
+
+    def store(self, results):
+        """
+        # Saves a list of (url, status, code, latency) check results, stamped with the current time.
+        """
+        now = time.time()
+        rows = [(url, status, None if code is None else str(code), now, latency, now)
+                for url, status, code, latency in results]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO url_status "
+                                 "(url, status, code, checked_at, latency, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                                 rows)
+        finally:
+            conn.close()
+
+    def evict(self, keep_for=None):
+        """
+        # Removes the expired results, then the least recently used ones until no more than max_entries are left.
+        # keep_for (in seconds) keeps results around longer than the times to live (e.g. for incremental runs).
+        # Returns the number of URLs removed.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                removed = conn.execute("DELETE FROM url_status WHERE checked_at < ?",
+                                       (now - max(self.UpTTL, self.DownTTL, keep_for or 0),)).rowcount
+                removed += conn.execute("DELETE FROM url_status WHERE url IN ("
+                                        "  SELECT url FROM url_status ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                                        (self.MaxEntries,)).rowcount
+        finally:
+            conn.close()
+        if removed > 0:
+            Logfile.debug("{0} URLs evicted from the status cache.".format(removed))
+        return removed
+
+
+class ServiceLinkCache(object):
+    """
+    # Remembers, for each service, a hash of its Data, Tools, News and Training Materials fields along with the links
+    # extracted from them and when they were last checked.  Lets an incremental run skip re-parsing (and re-checking)
+    # the services that have not been edited since.  Kept in the same SQLite database as the URL status cache.
+    """
+
+    def __init__(self, path=StatusCache_Path):
+        self.Path = path
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS service_links ("
+                             "  service_id TEXT PRIMARY KEY,"
+                             "  fields_hash TEXT NOT NULL,"
+                             "  links TEXT NOT NULL,"
+                             "  checked_at REAL NOT NULL)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return connect(self.Path)
+
+    def lookup(self, service_ids):
+        """
+        # Returns a dictionary of service ID -> (fields_hash, links, checked_at) for the services passed in that are
+        # in the cache.  links is the list of [svcCategory, lnkName, lnk] entries extracted from the service.
+        """
+        found = {}
+        service_ids = list(service_ids)
+        conn = self._connect()
+        try:
+            for batch in chunks(service_ids):
+                rows = conn.execute("SELECT service_id, fields_hash, links, checked_at FROM service_links "
+                                    "WHERE service_id IN ({0})".format(",".join("?" * len(batch))), batch)
+                for service_id, fields_hash, links, checked_at in rows:
+                    found[service_id] = (fields_hash, json.loads(links), checked_at)
+        finally:
+            conn.close()
+        return found
+
+    def store(self, services):
+        """
+        # Saves a list of (service_id, fields_hash, links) entries, stamped with the current time.
+        """
+        now = time.time()
+        rows = [(service_id, fields_hash, json.dumps(links), now) for service_id, fields_hash, links in services]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO service_links (service_id, fields_hash, links, checked_at) "
+                                 "VALUES (?, ?, ?, ?)", rows)
+        finally:
+            conn.close()
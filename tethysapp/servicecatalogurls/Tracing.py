@@ -0,0 +1,248 @@
+"""
+# Initial Creation:
+#   Stage-level tracing (and optional profiling) of a check run.
+# General Description:
+#   A slow run can be slow anywhere: the Service Catalog API query, decoding its JSON, extracting the links, the URL
+#   checks, or rendering the results page.  A Tracer records nestable timed spans - one for each stage of the run
+#   (see QueryCatalog.QueryServiceCatalog() and the functions it calls), one for each service whose links are
+#   extracted, and one for each service record decoded and each chunk of the API response read - with the thread each
+#   ran on.  The trace is saved in the app workspace (TRACE_PATH) in the Chrome trace event format, which Chrome's
+#   about://tracing, Perfetto (ui.perfetto.dev) and speedscope (flame graphs) all load.
+#
+#   Tracing is off unless a run asks for it (see controllers.queryresult, ?trace=...) - without a Tracer, span() costs
+#   next to nothing.  A traced run can also be profiled, with one of
+#       PROFILE_CPROFILE    cProfile of the thread running the run (not the URL check threads) - saved as a .prof
+#                           file for pstats, snakeviz or flameprof
+#       PROFILE_SAMPLE      samples the stacks of every thread every SAMPLE_INTERVAL seconds - saved as a .folded
+#                           file of collapsed stacks for flamegraph.pl or speedscope
+"""
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from .CheckEngine import APP_WORKSPACE_PATH
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+# Folder the traces (and profiles) are saved in, and how many of the newest traced runs are kept there.
+TRACE_PATH = os.path.join(APP_WORKSPACE_PATH, "traces")
+MAX_TRACED_RUNS = 20
+
+# Tracing modes of a run: spans only, or spans and one of the profiling modes (see above).
+TRACE_SPANS = "spans"
+PROFILE_CPROFILE = "cprofile"
+PROFILE_SAMPLE = "sample"
+PROFILE_MODES = (PROFILE_CPROFILE, PROFILE_SAMPLE)
+
+# Seconds between two stack samples (PROFILE_SAMPLE).
+SAMPLE_INTERVAL = 0.005
+
+
+class Tracer(object):
+    """
+    # Thread safe recorder of the timed spans of one run, saved as a Chrome trace (see above).  Spans nest by time
+    # within each thread, so a span started inside another one (on the same thread) shows up beneath it.
+    """
+
+    def __init__(self, name):
+        self.Name = name
+        self.Started = time.time()
+        self.Path = None  # Path of the saved trace, once saved.
+        self.ProfilePath = None  # Path of the saved profile, if the run was profiled.
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = set()  # IDs of the threads named in the trace so far.
+
+    def _microseconds(self, counter):
+        return round((counter - self._origin) * 1e6, 1)
+
+    def add_span(self, name, category, start, end, args=None):
+        """
+        # Records a span that ran from start to end (time.perf_counter() values) on the current thread.
+        """
+        thread = threading.current_thread()
+        event = {"name": name, "cat": category, "ph": "X", "pid": self._pid, "tid": thread.ident,
+                 "ts": self._microseconds(start), "dur": round((end - start) * 1e6, 1)}
+        if args:
+            event["args"] = args
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self._events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": thread.ident,
+                                     "args": {"name": thread.name}})
+            self._events.append(event)
+
+    @contextmanager
+    def span(self, name, category="stage", **args):
+        # Records the time the with block takes as a span (the keyword arguments are shown with it).
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.perf_counter(), args)
+
+    def chrome_trace(self):
+        # Returns the trace as a Chrome trace event format dictionary.
+        with self._lock:
+            events = list(self._events)
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"run": self.Name, "started": time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                      time.localtime(self.Started)),
+                          "profile": os.path.basename(self.ProfilePath) if self.ProfilePath else None},
+        }
+
+    def save(self, folder=TRACE_PATH):
+        """
+        # Saves the trace to a JSON file in the folder (again over the same file, if it was saved before) and returns
+        # its path.  Only the newest MAX_TRACED_RUNS traced runs are kept in the folder.
+        """
+        if self.Path is None:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.Path = os.path.join(folder, "{0}.trace.json".format(self.Name))
+            prune_traces(folder)
+        tmpPath = self.Path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.chrome_trace(), f)
+        os.replace(tmpPath, self.Path)
+        return self.Path
+
+
+def span(tracer, name, category="stage", **args):
+    """
+    # tracer.span(...) for the Tracer passed in - or a with block that records nothing, if it is None.
+    """
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, category, **args)
+
+
+def end_span(tracer, name, start, category="stage", **args):
+    """
+    # Records a span that started at start (a time.perf_counter() value) and ends now, for blocks too large to wrap in
+    # a with block - nothing is recorded if the tracer is None.
+    """
+    if tracer is not None:
+        tracer.add_span(name, category, start, time.perf_counter(), args)
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def trace_mode(value):
+    """
+    # The tracing mode asked for by a query parameter value: TRACE_SPANS for "1", "true", "yes" or "spans", one of the
+    # PROFILE_MODES by its name, otherwise None (no tracing).
+    """
+    value = (value or "").strip().lower()
+    if value in PROFILE_MODES:
+        return value
+    if value in ("1", "true", "yes", TRACE_SPANS):
+        return TRACE_SPANS
+    return None
+
+
+def trace_name(job_id):
+    # Name of the trace (and profile) files of a run: its start time and job ID.
+    return "run_{0}_{1}".format(time.strftime("%Y%m%d-%H%M%S"), job_id[:8])
+
+
+def prune_traces(folder, keep=MAX_TRACED_RUNS):
+    # Deletes the files of all but the newest keep traced runs (keep - 1, to make room for a new one).
+    names = sorted(set(name.split(".", 1)[0] for name in os.listdir(folder) if name.startswith("run_")))
+    for name in names[:max(0, len(names) - keep + 1)]:
+        for fileName in os.listdir(folder):
+            if fileName.split(".", 1)[0] == name:
+                try:
+                    os.remove(os.path.join(folder, fileName))
+                except OSError:
+                    pass
+
+
+class RunProfiler(object):
+    """
+    # Profiles a run with one of the PROFILE_MODES (see above), from start() to stop(), and saves the result next to
+    # the run's trace.  start() and stop() must be called from the thread running the run.
+    """
+
+    def __init__(self, mode):
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profiling mode: {0}".format(mode))
+        self.Mode = mode
+        self.Samples = 0
+        self.Started = False  # True once start() has succeeded.
+        self._profile = None
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        if self.Mode == PROFILE_CPROFILE:
+            profile = cProfile.Profile()
+            profile.enable()
+            self._profile = profile
+        else:
+            self._sampler = threading.Thread(target=self._sample, name="RunProfiler", daemon=True)
+            self._sampler.start()
+        self.Started = True
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+
+    def _sample(self):
+        # Sampler thread: counts the stack of every other thread, by thread name, every SAMPLE_INTERVAL seconds.
+        own = threading.get_ident()
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename),
+                                                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread {0}".format(ident)))
+                self._stacks[";".join(reversed(stack))] += 1
+            self.Samples += 1
+
+    def save(self, tracer, folder=TRACE_PATH):
+        """
+        # Saves the profile next to the tracer's trace (see Tracer.save()) and returns its path.
+        """
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        if self.Mode == PROFILE_CPROFILE:
+            path = os.path.join(folder, "{0}.prof".format(tracer.Name))
+            self._profile.dump_stats(path)
+        else:
+            path = os.path.join(folder, "{0}.folded".format(tracer.Name))
+            with open(path, "w") as f:
+                for stack, count in self._stacks.most_common():
+                    f.write("{0} {1}\n".format(stack, count))
+        tracer.ProfilePath = path
+        Logfile.info("Profile ({0}) saved to {1}".format(self.Mode, path))
+        return path
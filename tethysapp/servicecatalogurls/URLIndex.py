@@ -0,0 +1,83 @@
+"""
+# Initial Creation:
+#   Canonical form of the URLs found in the Service Catalog.
+# General Description:
+#   The same page is often linked in slightly different ways from different services - "http://x.org/a",
+#   "http://X.ORG:80/a/", "http://x.org/a#section", "http://x.org/%7Ea" vs "http://x.org/~a", or a copy with a
+#   space at the end.  index_urls() groups the URLs found by their canonical_url() before any of them is checked, so
+#   QueryCatalog.ProcessURLs() checks every group once and reports its result for each place (service, section, entry
+#   name) one of its URLs was found.
+#
+#   The canonical form (RFC 3986, section 6.2.2):
+#       - surrounding whitespace removed
+#       - scheme and host in lower case, without a trailing dot on the host, and without the scheme's default port
+#       - percent-encoding normalized: unreserved characters decoded, other escapes in upper case, and characters
+#         that are not allowed in a URL (e.g. a space) encoded
+#       - no trailing slash on the path, and no fragment (the part after "#" is never sent to the server)
+#   The scheme itself is kept: http:// and https:// are served by different ports (often different servers), so one
+#   can be up while the other is down.
+"""
+import re
+from functools import lru_cache
+from urllib.parse import quote, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Characters that never need to be percent-encoded (RFC 3986, section 2.3).
+_UNRESERVED = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+
+# Characters left as they are (along with "%") when the illegal ones are encoded - the reserved characters.
+_SAFE = "!$&'()*+,/:;=?@[]~%"
+
+_ESCAPE_REGEX = re.compile(r"%([0-9A-Fa-f]{2})")
+
+# Most canonical forms kept in memory - the same raw URLs come back run after run.
+CANONICAL_CACHE_SIZE = 64 * 1024
+
+
+def _normalize_escapes(part):
+    # Decodes the escaped unreserved characters, upper-cases every other escape, and encodes illegal characters.
+    def unescape(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in _UNRESERVED else "%" + match.group(1).upper()
+    return quote(_ESCAPE_REGEX.sub(unescape, part), safe=_SAFE)
+
+
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def canonical_url(url):
+    """
+    # Returns the canonical form of the URL passed in (see above).  A string that can not be parsed as a URL is only
+    # stripped of its surrounding whitespace.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").rstrip(".")
+        port = parts.port
+    except ValueError:
+        # e.g. a port that is not a number
+        return url
+
+    netloc = host
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = "{0}:{1}".format(host, port)
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else "{0}:{1}".format(parts.username, parts.password)
+        netloc = "{0}@{1}".format(userinfo, netloc)
+
+    path = _normalize_escapes(parts.path).rstrip("/")
+    query = _normalize_escapes(parts.query)
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def index_urls(URL_Occurrences):
+    """
+    # Returns the canonical URL index of the [svc_cls, svcCategory, lnkName, lnk] entries passed in (see
+    # QueryCatalog.CollectURLs()): a dictionary of each canonical URL -> the indexes of all of its raw occurrences,
+    # in catalog order.  The dictionary itself is in the order the canonical URLs were first found.
+    """
+    Dict_Occurrences = {}
+    for idx, (svc, svcCategory, lnkName, lnk) in enumerate(URL_Occurrences):
+        Dict_Occurrences.setdefault(canonical_url(lnk), []).append(idx)
+    return Dict_Occurrences
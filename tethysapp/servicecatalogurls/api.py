@@ -1,19 +1,156 @@
 # Define your REST API endpoints here.
-# In the comments below is an example.
 # For more information, see:
 # http://docs.tethysplatform.org/en/dev/tethys_sdk/rest_api.html
-"""
+#
+# Every endpoint needs a Tethys API token, sent as the header:  "Authorization: Token <your token>"
+# (the token is shown on the user's Tethys settings page).
+#
+# A run is saved to the job store (see CheckJobs.JobStore) as it goes, so its status and results can be asked for from
+# any of the app's worker processes, not just the one that started it - for JOB_KEEP_SECONDS after it has finished.
+# A run whose worker process stopped before it finished is reported as failed.
+#
+#   POST servicecatalogurls/api/runs            - starts a check run.  region = region ID (blank/missing = "All"),
+#                                                 deadline = most seconds the run may take (optional).
+#   GET  servicecatalogurls/api/runs/status     - job = run ID.  Progress and state of the run.
+#   GET  servicecatalogurls/api/runs/results    - job = run ID.  Paginated results of a finished run.
+#                                                 kind = "errors" (invalid URLs, the default) or "catalogs"
+#                                                 ("INCORRECT CATALOG" entries).  Optional filters: region (name),
+#                                                 section (DATA, TOOLS, NEWS, TRAINING MATERIALS), status (e.g. 404,
+#                                                 DUPLICATE).  page (from 1) and page_size (up to MAX_PAGE_SIZE).
+#   GET  servicecatalogurls/api/runs/changes    - region = region ID (blank/missing = "All").  What changed in the
+#                                                 region's latest recorded run (see model.py) since the run before it:
+#                                                 the URLs newly broken and fixed, and the URLs down in each of the
+#                                                 last N runs (runs = N, default DEFAULT_STREAK_RUNS).  Optional: run (a
+#                                                 history_run ID from the run's status - the changes in that run, and
+#                                                 the N runs up to it), region_name (only the findings of that
+#                                                 region, e.g. of an "All" run).
 from django.http import JsonResponse
+from django.urls import reverse
 from rest_framework.authentication import TokenAuthentication
-from rest_framework.decorators import api_view, authentication_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import IsAuthenticated
+
+from .CheckJobs import start_job, get_job, JOB_FINISHED
+from .model import RunHistory
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+RESULT_KINDS = ("errors", "catalogs")
+
+# Default (and most) runs in a row a URL must have been down in to be listed by run_changes.
+DEFAULT_STREAK_RUNS = 3
+MAX_STREAK_RUNS = 100
+
+
+def error_response(message, status):
+    return JsonResponse({"error": message}, status=status)
+
+
+def positive_int(value, default):
+    return int(value) if value is not None and value.isdigit() and int(value) > 0 else default
+
+
+@api_view(['POST'])
+@authentication_classes((TokenAuthentication,))
+@permission_classes((IsAuthenticated,))
+def start_run(request):
+    '''
+    API Controller starting a check run for a region (see CheckJobs.start_job())
+    '''
+    regionID = request.data.get('region', '') or ''
+    runDeadline = str(request.data.get('deadline', '') or '')
+    runDeadline = int(runDeadline) if runDeadline.isdigit() else None
+
+    job = start_job(regionID, run_deadline=runDeadline)
+
+    data = job.status()
+    data["status_url"] = request.build_absolute_uri(
+        "{0}?job={1}".format(reverse('servicecatalogurls:api_run_status'), job.ID))
+    data["results_url"] = request.build_absolute_uri(
+        "{0}?job={1}".format(reverse('servicecatalogurls:api_run_results'), job.ID))
+    return JsonResponse(data, status=202)
+
+
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication,))
+@permission_classes((IsAuthenticated,))
+def run_status(request):
+    '''
+    API Controller for getting the state and progress of a check run
+    '''
+    job = get_job(request.GET.get('job', ''))
+    if job is None:
+        return error_response("No check run found with that ID.", 404)
+
+    return JsonResponse(job.status())
+
+
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication,))
+@permission_classes((IsAuthenticated,))
+def run_results(request):
+    '''
+    API Controller for getting a page of the (filtered) results of a finished check run
+    '''
+    job = get_job(request.GET.get('job', ''))
+    if job is None:
+        return error_response("No check run found with that ID.", 404)
+    if job.State != JOB_FINISHED:
+        message = "The check run is {0}.".format(job.State)
+        if job.Error:
+            message = "{0} {1}".format(message, job.Error)
+        return error_response(message, 409)
+
+    kind = request.GET.get('kind', 'errors')
+    if kind not in RESULT_KINDS:
+        return error_response("kind must be one of: {0}.".format(", ".join(RESULT_KINDS)), 400)
+
+    # The placeholder entry QueryServiceCatalog() adds to an empty list is never returned (see ResultList.filter()).
+    entries = job.ErrURLs if kind == "errors" else job.ErrCatalogs
+    entries = entries.filter(request.GET.get('region'), request.GET.get('section'), request.GET.get('status'))
+
+    pageSize = min(positive_int(request.GET.get('page_size'), DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+    page = positive_int(request.GET.get('page'), 1)
+    start = (page - 1) * pageSize
+
+    data = {
+        "job": job.ID,
+        "kind": kind,
+        "count": len(entries),
+        "page": page,
+        "page_size": pageSize,
+        "pages": (len(entries) + pageSize - 1) // pageSize,
+        "summary": job.summary(),
+        "results": entries[start:start + pageSize].as_dicts(),
+    }
+    return JsonResponse(data)
+
 
 @api_view(['GET'])
 @authentication_classes((TokenAuthentication,))
-def get_data(request):
+@permission_classes((IsAuthenticated,))
+def run_changes(request):
     '''
-    API Controller for getting data
+    API Controller for getting what changed in a region's latest recorded run since the run before it
     '''
-    name = request.GET.get('name')
-    data = {"name": name}
+    regionID = request.GET.get('region', '') or ''
+    regionName = request.GET.get('region_name') or None
+    runID = positive_int(request.GET.get('run'), None)
+    streakRuns = min(positive_int(request.GET.get('runs'), DEFAULT_STREAK_RUNS), MAX_STREAK_RUNS)
+
+    history = RunHistory()
+    run, previous, newlyBroken = history.newly_broken(regionID, runID, regionName)
+    if run is None:
+        return error_response("No recorded run found for that region.", 404)
+    fixed = history.fixed(regionID, run["run"], regionName)[2]
+    streakRunIDs, downStreak = history.down_streak(regionID, streakRuns, regionName, run["run"])
+
+    data = {
+        "run": run,
+        "previous_run": previous,
+        "newly_broken": newlyBroken.as_dicts(),
+        "fixed": fixed.as_dicts(),
+        "down_streak": {"runs": streakRuns, "run_ids": streakRunIDs, "results": downStreak.as_dicts()},
+    }
     return JsonResponse(data)
-"""
@@ -40,6 +40,42 @@ class Servicecatalogurls(TethysAppBase):
                 url='servicecatalogurls/queryresult',
                 controller='servicecatalogurls.controllers.queryresult'
             ),
+            UrlMap(
+                name='queryprogress',
+                url='servicecatalogurls/queryprogress',
+                controller='servicecatalogurls.controllers.queryprogress'
+            ),
+            UrlMap(
+                name='querystream',
+                url='servicecatalogurls/querystream',
+                controller='servicecatalogurls.controllers.querystream'
+            ),
+            UrlMap(
+                name='metrics',
+                url='servicecatalogurls/metrics',
+                controller='servicecatalogurls.controllers.metrics'
+            ),
+            # REST API (see api.py)
+            UrlMap(
+                name='api_start_run',
+                url='servicecatalogurls/api/runs',
+                controller='servicecatalogurls.api.start_run'
+            ),
+            UrlMap(
+                name='api_run_status',
+                url='servicecatalogurls/api/runs/status',
+                controller='servicecatalogurls.api.run_status'
+            ),
+            UrlMap(
+                name='api_run_results',
+                url='servicecatalogurls/api/runs/results',
+                controller='servicecatalogurls.api.run_results'
+            ),
+            UrlMap(
+                name='api_run_changes',
+                url='servicecatalogurls/api/runs/changes',
+                controller='servicecatalogurls.api.run_changes'
+            ),
         )
 
         return url_maps
@@ -56,5 +92,12 @@ class Servicecatalogurls(TethysAppBase):
                 description='Region to process.',
                 required=False
             ),
+            CustomSetting(
+                name='metrics_token',
+                type=CustomSetting.TYPE_STRING,
+                description='Token a Prometheus server sends ("Authorization: Bearer <token>") to scrape the metrics '
+                            'page. Leave blank to only show the metrics to signed-in users.',
+                required=False
+            ),
         )
         return custom_settings
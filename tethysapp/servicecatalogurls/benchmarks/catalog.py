@@ -0,0 +1,107 @@
+"""
+# Initial Creation:
+#   Synthetic Service Catalog for the check run benchmark (see benchmarks/check_run.py).
+# General Description:
+#   Builds service records shaped like the ones the searchServices query returns - ID, title, regions, service areas,
+#   and the Data, Tools, News and Training Materials markup fields - for any number of services (50 to 50,000 and
+#   beyond).  Their links point to the link farm (see benchmarks/servers.py), with a mix of page kinds close to what
+#   a real run meets (mostly fast pages, some slow, redirected, missing, forbidden, reset and hanging ones).  About a
+#   fifth of the links point to a small set of popular pages shared by many services, and a few are written in
+#   another raw form of the same URL, so the checker's de-duplication is exercised as well.
+#
+#   The catalog only depends on the number of services and the seed - the same arguments always give the same
+#   catalog, so runs of the benchmark can be compared.
+"""
+import random
+from collections import Counter
+
+FIELDS = ("Data", "Tools", "News", "TrainingMaterials")
+
+REGIONS = {
+    "5bb3f96f51ebdcae796832e6": "Eastern & Southern Africa",
+    "5bb3f96951ebdcae796832e5": "West Africa",
+    "5bb3f97451ebdcae796832e7": "Hindu Kush Himalaya",
+    "5bb3f97b51ebdcae796832e9": "Mekong",
+}
+
+SERVICE_AREAS = ["Agriculture and Food Security", "Land Use Land Cover", "Water and Water Related Disasters",
+                 "Weather and Climate"]
+
+# Share of the links of each kind of link farm page (see servers.FARM_PAGES).
+PAGE_MIX = (("fast", 0.75), ("slow", 0.08), ("redirect", 0.05), ("404", 0.05), ("403", 0.03), ("reset", 0.03),
+            ("hang", 0.01))
+
+# Share of the links that point to one of the POPULAR_PAGES pages shared by many services.
+POPULAR_SHARE = 0.2
+POPULAR_PAGES = 200
+
+
+def pick_kind(rand):
+    point = rand.random()
+    for kind, share in PAGE_MIX:
+        point -= share
+        if point < 0:
+            return kind
+    return PAGE_MIX[0][0]
+
+
+def synthetic_link(rand, farm_urls, serial):
+    # One link to the farm: (URL as written in the catalog, page kind).
+    if rand.random() < POPULAR_SHARE:
+        page = rand.randrange(POPULAR_PAGES)
+        # Popular pages are always fast or redirected, like the big partner portals.
+        kind = "fast" if page % 10 else "redirect"
+        url = "{0}/{1}/popular{2}".format(farm_urls[page % len(farm_urls)], kind, page)
+        if page % 7 == 0:
+            # Another raw form of the same URL (see URLIndex.py).
+            url = url.replace("http://", "HTTP://") + "/"
+        return url, kind
+    kind = pick_kind(rand)
+    return "{0}/{1}/page{2}".format(rand.choice(farm_urls), kind, serial), kind
+
+
+def synthetic_field(rand, farm_urls, serial, kinds, urls):
+    # One category field: 0 to 4 links, as markup links or bare URLs, in a few lines of text.
+    lines = []
+    for i in range(rand.randint(0, 4)):
+        url, kind = synthetic_link(rand, farm_urls, "{0}_{1}".format(serial, i))
+        kinds[kind] += 1
+        urls.add(url)
+        if rand.random() < 0.8:
+            lines.append("[Resource {0}]({1})".format(i, url))
+        else:
+            lines.append("More information at {0} .".format(url))
+        lines.append("Some words describing the link above, as the service pages usually have.")
+    return "\n".join(lines)
+
+
+def synthetic_catalog(count, farm_urls, seed=2019):
+    """
+    # Returns count service records linking to the link farm base URLs passed in, the {region ID: name} dictionary,
+    # and the catalog's totals: services, links, unique URLs (before canonicalization) and links of each page kind.
+    """
+    rand = random.Random(seed)
+    regionList = [{"_id": regionID, "Name": name} for regionID, name in sorted(REGIONS.items())]
+    areaList = [{"_id": "area{0}".format(i), "Name": name} for i, name in enumerate(SERVICE_AREAS)]
+    kinds = Counter()
+    urls = set()
+    services = []
+    for serial in range(count):
+        regions = [rand.choice(regionList)]
+        if rand.random() < 0.1:
+            # Some services belong to more than one region (see QueryCatalog.OwnerRegion()).
+            other = rand.choice(regionList)
+            if other is not regions[0]:
+                regions.append(other)
+        service = {
+            "_id": "{0:024x}".format(serial + 1),
+            "Title": "Synthetic service {0}, {1}".format(serial, rand.choice(SERVICE_AREAS)),
+            "regions": regions,
+            "serviceareas": [rand.choice(areaList)],
+        }
+        for field in FIELDS:
+            service[field] = synthetic_field(rand, farm_urls, "{0}{1}".format(serial, field[0]), kinds, urls)
+        services.append(service)
+
+    totals = {"services": count, "links": sum(kinds.values()), "unique_urls": len(urls), "kinds": dict(kinds)}
+    return services, dict(REGIONS), totals
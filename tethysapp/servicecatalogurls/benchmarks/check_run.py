@@ -0,0 +1,149 @@
+"""
+# Initial Creation:
+#   Offline benchmark of whole check runs (see QueryCatalog.QueryServiceCatalog()).
+# General Description:
+#   Runs QueryServiceCatalog() end to end - catalog query, link extraction, host preflight, URL checks, result
+#   lists - against local stand-ins for the outside world (see benchmarks/servers.py): a fake Service Catalog API
+#   serving a synthetic catalog (see benchmarks/catalog.py) and a link farm of fast, slow, hanging, redirected,
+#   forbidden, missing and reset pages.  No network access or Tethys install is needed, and the numbers do not depend
+#   on the servers of the real catalog, so they can be compared from one change to the next.
+#
+#   Every catalog size is run in a process of its own (so the peak memory of a run is not hidden by an earlier,
+#   larger one), with the servers in yet another process.  For each size it reports the run time, the URLs checked
+#   per second, the p50 and p99 latency of the URL checks, and the peak resident memory of the run's process.
+#   From the folder holding tethysapp/, run:
+#       python -m tethysapp.servicecatalogurls.benchmarks.check_run [--services 50 500 5000] [--backend asyncio] ...
+#   (python -m tethysapp.servicecatalogurls.benchmarks.check_run --help lists every option.)
+#
+#   The per-host rate limit is off by default (--host-rate 0): the farm is local, and the point is to time the
+#   checker rather than its politeness.  The read timeout is kept short (--read-timeout) so the hanging pages do not
+#   dominate the run time.
+"""
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+
+from .servers import start_servers
+
+try:
+    import resource  # required for the peak memory (not available on Windows)
+except ImportError:
+    resource = None
+
+
+def peak_memory_mb():
+    # Peak resident memory of this process so far, in MB (None where it can not be found out).
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes.
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def run_size(count, options):
+    """
+    # One benchmark run of a catalog of count services - returns its numbers as a dictionary.
+    """
+    # Imported here, so the run's process is the one loading (and measuring) the app's modules.
+    from .. import QueryCatalog
+    from ..Metrics import percentile
+    from ..ResultStore import NO_DATA_STATUS
+
+    process, apiURL, farmURLs, totals = start_servers(count, options.hosts, options.seed)
+    try:
+        QueryCatalog.ServiceCatalogAPI_URL = apiURL
+        QueryCatalog.Connectivity_Endpoints = [apiURL]
+
+        # Every check engine of the run (one per region in a fan-out run), for their latencies.
+        engines = []
+        newCheckEngine = QueryCatalog.NewCheckEngine
+
+        def recording_check_engine(*args, **kwargs):
+            engine = newCheckEngine(*args, **kwargs)
+            engines.append(engine)
+            return engine
+
+        QueryCatalog.NewCheckEngine = recording_check_engine
+
+        settings = QueryCatalog.CheckSettings(backend=options.backend, max_workers=options.workers,
+                                              connect_timeout=options.connect_timeout,
+                                              read_timeout=options.read_timeout, use_cache=False,
+                                              fan_out=options.fan_out, host_rate=options.host_rate or None)
+        timeStart = time.time()
+        result = QueryCatalog.QueryServiceCatalog("", settings)
+        elapsed = time.time() - timeStart
+        if result is None:
+            raise RuntimeError("The check run failed - run again with --verbose to see why.")
+        errURLs, errCatalogs = result
+    finally:
+        process.terminate()
+
+    latencies = sorted(seconds for engine in engines for seconds in engine.Latencies.values())
+    return {
+        "services": count,
+        "links": totals["links"],
+        "urls": len(latencies),
+        "seconds": elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "invalid": sum(entry.Status != NO_DATA_STATUS for entry in errURLs),
+        "memory": peak_memory_mb(),
+    }
+
+
+def run_child(count, options, results):
+    # Body of the process of one catalog size.
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.CRITICAL)
+    try:
+        results.put(run_size(count, options))
+    except Exception as e:
+        results.put({"services": count, "error": str(e)})
+
+
+def format_memory(value):
+    return "{0:8.1f}".format(value) if value is not None else "     n/a"
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="check_run", description="Offline benchmark of whole check runs.")
+    parser.add_argument("--services", type=int, nargs="+", default=[50, 500, 5000],
+                        help="catalog sizes to run, in services (default: 50 500 5000 - up to 50000 and beyond)")
+    parser.add_argument("--backend", choices=("threads", "asyncio"), default="threads",
+                        help="URL checker backend (default: threads)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="threads or checks in flight (default: the app's default for the backend)")
+    parser.add_argument("--hosts", type=int, default=16, help="link farm hosts, 127.0.0.1 and up (default: 16)")
+    parser.add_argument("--host-rate", type=float, default=0,
+                        help="checks per second per host, 0 for no limit (default: 0)")
+    parser.add_argument("--connect-timeout", type=float, default=2, help="connect timeout in seconds (default: 2)")
+    parser.add_argument("--read-timeout", type=float, default=2, help="read timeout in seconds (default: 2)")
+    parser.add_argument("--no-fan-out", dest="fan_out", action="store_false",
+                        help="check all the services in a single query instead of one per region")
+    parser.add_argument("--seed", type=int, default=2019, help="seed of the synthetic catalog (default: 2019)")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the runs")
+    options = parser.parse_args(argv[1:])
+
+    context = multiprocessing.get_context("spawn")
+    print("{0} backend, {1} farm hosts, host rate {2}, read timeout {3} s:".format(
+        options.backend, options.hosts, options.host_rate or "off", options.read_timeout))
+    print("  {0:>8} {1:>8} {2:>8} {3:>9} {4:>8} {5:>8} {6:>8} {7:>8} {8:>8}".format(
+        "services", "links", "URLs", "seconds", "URLs/s", "p50 ms", "p99 ms", "invalid", "peak MB"))
+    for count in options.services:
+        results = context.Queue()
+        child = context.Process(target=run_child, args=(count, options, results))
+        child.start()
+        result = results.get()
+        child.join()
+        if "error" in result:
+            print("  {0:>8} failed: {1}".format(count, result["error"]))
+            continue
+        print("  {0:>8,} {1:>8,} {2:>8,} {3:>9.2f} {4:>8,.0f} {5:>8.1f} {6:>8.1f} {7:>8,} {8}".format(
+            result["services"], result["links"], result["urls"], result["seconds"],
+            result["urls"] / result["seconds"], result["p50"] * 1000, result["p99"] * 1000, result["invalid"],
+            format_memory(result["memory"])))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,90 @@
+"""
+# Initial Creation:
+#   Micro-benchmark of the link extraction (see LinkExtractor.py).
+# General Description:
+#   Builds a synthetic catalog of services (10,000 by default) whose Data, Tools, News, and Training Materials fields
+#   hold a mix of plain markup links, links with parentheses in the URL, bare URLs, and reference-style links, then
+#   times the old GetURLs_FromString() (copied below, one call per field) against extract_service_links().  It then
+#   does the same for a catalog of plain markup links only - the only kind the old function found - which
+#   extract_service_links() handles on its fast path.  No network access or Tethys install is needed.  From the
+#   folder holding tethysapp/, run:
+#       python -m tethysapp.servicecatalogurls.benchmarks.link_extraction [number of services] [repeats]
+"""
+import random
+import re
+import sys
+import time
+
+from ..LinkExtractor import extract_service_links
+
+FIELDS = ("DATA", "TOOLS", "NEWS", "TRAINING MATERIALS")
+
+
+def legacy_GetURLs_FromString(theString):
+    # GetURLs_FromString() as it was before LinkExtractor.py - the regular expression is built on every call.
+    name_regex = "[^]]+"
+    url_regex = "http[s]?://[^)]+"
+    markup_regex = '\\[({0})]\\(\\s*({1})\\s*\\)'.format(name_regex, url_regex)
+    return re.findall(markup_regex, theString)
+
+
+def synthetic_field(rand, plainOnly=False):
+    # One category field: a few paragraphs of text with 0 to 8 links of every kind (or plain markup links only).
+    lines = []
+    refs = []
+    for i in range(rand.randint(0, 8)):
+        site = "https://site{0}.example.org".format(rand.randint(1, 500))
+        kind = 0.0 if plainOnly else rand.random()
+        if kind < 0.55:
+            lines.append("[Report {0}]({1}/docs/report_{0}.pdf)".format(i, site))
+        elif kind < 0.7:
+            lines.append("[Wiki {0}]({1}/wiki/Lake_Victoria_(Africa))".format(i, site))
+        elif kind < 0.85:
+            lines.append("More information at {0}/data/page{1}.html.".format(site, i))
+        else:
+            lines.append("[Portal {0}][ref{0}]".format(i))
+            refs.append("[ref{0}]: {1}/portal/{0}".format(i, site))
+        lines.append("Some words describing the link above, as the service pages usually have.")
+        lines.append("")
+    return "\n".join(lines + refs)
+
+
+def synthetic_catalog(count, seed=2019, plainOnly=False):
+    rand = random.Random(seed)
+    return [[synthetic_field(rand, plainOnly) for field in FIELDS] for i in range(count)]
+
+
+def time_it(func, catalog, repeats):
+    # Returns the best time of the repeats, and the number of links found.
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        found = func(catalog)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, found
+
+
+def run_legacy(catalog):
+    return sum(len(legacy_GetURLs_FromString(text)) for fields in catalog for text in fields)
+
+
+def run_engine(catalog):
+    return sum(len(extract_service_links(list(zip(FIELDS, fields)))) for fields in catalog)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    repeats = int(argv[2]) if len(argv) > 2 else 3
+    print("{0} services, {1} fields each, best of {2}:".format(count, len(FIELDS), repeats))
+    for title, plainOnly in (("Links of every kind", False), ("Plain markup links only (fast path)", True)):
+        catalog = synthetic_catalog(count, plainOnly=plainOnly)
+        print(title)
+        for label, func in (("GetURLs_FromString (old)", run_legacy), ("extract_service_links", run_engine)):
+            elapsed, found = time_it(func, catalog, repeats)
+            print("  {0:<26} {1:8.3f} s  {2:10,.0f} services/s  {3:8,} links found".format(
+                label, elapsed, count / elapsed, found))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,171 @@
+"""
+# Initial Creation:
+#   Local stand-ins for the outside world of a check run, used by benchmarks/check_run.py.
+# General Description:
+#   LinkFarm is a small HTTP server whose paths pick how it answers, so a synthetic catalog can link to every kind of
+#   page a real run meets:
+#       /fast/...       200 right away              /403/...        403 Forbidden
+#       /slow/...       200 after SLOW_SECONDS      /404/...        404 Not Found
+#       /hang/...       never answers (until the client gives up - see HANG_SECONDS)
+#       /redirect/...   301 to the /fast/ page of the same name
+#       /reset/...      the connection is reset without an answer
+#   One farm server is started on each of a number of loopback addresses (127.0.0.1, 127.0.0.2 ...), so the links
+#   are spread over several hosts the way catalog links are - the per-host limits of the checker (see
+#   HostScheduler.py) apply to each of them.
+#
+#   FakeCatalogHandler answers the two GraphQL queries the app sends to the Service Catalog API (allRegions, and
+#   searchServices for one region or all of them) with a synthetic catalog linking to the farm (see
+#   benchmarks/catalog.py), and answers the connectivity check (see QueryCatalog.is_internet_reachable()).
+#
+#   start_servers() runs both in a separate process, so their threads and memory do not show up in the numbers of the
+#   process being measured.
+"""
+import json
+import multiprocessing
+import re
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .catalog import synthetic_catalog
+
+# How long the /slow/ pages take to answer, and how long the /hang/ pages hold the connection without answering.
+SLOW_SECONDS = 0.25
+HANG_SECONDS = 60
+
+# The answer of each kind of link farm page: (status code, seconds to wait first).
+FARM_PAGES = {
+    "fast": (200, 0),
+    "slow": (200, SLOW_SECONDS),
+    "hang": (None, HANG_SECONDS),
+    "redirect": (301, 0),
+    "403": (403, 0),
+    "404": (404, 0),
+    "reset": (None, 0),
+}
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class LinkFarmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self):
+        kind = self.path.strip("/").split("/", 1)[0]
+        code, wait = FARM_PAGES.get(kind, (404, 0))
+        if kind == "reset":
+            # Close with SO_LINGER set to 0 - the client sees "connection reset by peer".
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return
+        if wait:
+            time.sleep(wait)
+        if code is None:
+            self.close_connection = True
+            return
+        self.send_response(code)
+        if code == 301:
+            self.send_header("Location", "/fast/" + self.path.strip("/").split("/", 1)[-1])
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_HEAD = answer
+    do_GET = answer
+
+
+class FakeCatalogHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    Regions = {}  # Region ID -> name
+    Responses = {}  # Region ID ("" for all) -> encoded searchServices response
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+        query = body["query"]
+        if "allRegions" in query:
+            data = json.dumps({"data": {"allRegions": [{"_id": regionID, "Name": name}
+                                                        for regionID, name in self.Regions.items()]}}).encode()
+        else:
+            regionIDs = re.findall(r'"([^"]+)"', re.search(r"regions: \[([^\]]*)\]", query).group(1))
+            data = self.Responses.get(regionIDs[0] if regionIDs else "", b'{"data": {"services": []}}')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        # Answers the connectivity check (see QueryCatalog.is_internet_reachable()).
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def farm_addresses(hosts):
+    # The loopback addresses the farm can listen on (127.0.0.1 only, where the other ones can not be bound).
+    addresses = []
+    for i in range(1, hosts + 1):
+        address = "127.0.0.{0}".format(i)
+        try:
+            with socket.socket() as sock:
+                sock.bind((address, 0))
+            addresses.append(address)
+        except OSError:
+            break
+    return addresses or ["127.0.0.1"]
+
+
+def serve(count, hosts, seed, ready):
+    # Body of the server process: starts the link farm, builds the synthetic catalog of count services linking to it,
+    # starts the fake catalog API, and passes their URLs (and the catalog's totals) back through the ready queue.
+    servers = []
+    farmPort = 0
+    for address in farm_addresses(hosts):
+        # Every farm server on the same port, so the farm hosts only differ by their address.
+        server = QuietServer((address, farmPort), LinkFarmHandler)
+        farmPort = server.server_address[1]
+        servers.append(server)
+    farmURLs = ["http://{0}:{1}".format(*server.server_address) for server in servers]
+
+    services, regions, totals = synthetic_catalog(count, farmURLs, seed)
+    FakeCatalogHandler.Regions = regions
+    byRegion = {"": services}
+    for service in services:
+        for region in service["regions"]:
+            byRegion.setdefault(region["_id"], []).append(service)
+    FakeCatalogHandler.Responses = dict((regionID, json.dumps({"data": {"services": regionServices}}).encode())
+                                        for regionID, regionServices in byRegion.items())
+    del services, byRegion
+
+    api = QuietServer(("127.0.0.1", 0), FakeCatalogHandler)
+    servers.append(api)
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    ready.put(("http://127.0.0.1:{0}/graphql".format(api.server_address[1]), farmURLs, totals))
+    while True:
+        time.sleep(3600)
+
+
+def start_servers(count, hosts, seed):
+    """
+    # Starts the link farm (on up to hosts loopback addresses) and the fake catalog API serving a synthetic catalog
+    # of count services, in a separate process.  Returns the process (terminate() it when done), the API URL, the
+    # link farm base URLs, and the catalog's totals (see catalog.synthetic_catalog()).
+    """
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    process = context.Process(target=serve, args=(count, hosts, seed, ready), daemon=True)
+    process.start()
+    apiURL, farmURLs, totals = ready.get(timeout=600)
+    return process, apiURL, farmURLs, totals
@@ -1,7 +1,24 @@
-from django.shortcuts import render
+import hmac
+import json
+import time
+
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect
+from django.urls import reverse
 from tethys_sdk.permissions import login_required
 from tethys_sdk.gizmos import Button
 from .QueryCatalog import *
+from .RegionCache import GetCachedRegions
+from .app import Servicecatalogurls as app
+from .CheckJobs import start_job, get_job, JOB_FINISHED
+from .Metrics import PROMETHEUS_CONTENT_TYPE
+from .MetricsStore import metrics_store
+from .Tracing import span, trace_mode
+from .Snapshots import latest_snapshot
+
+# Seconds between looks for new entries while streaming a job's results, and between keep-alive comments.
+STREAM_POLL_SECONDS = 0.5
+STREAM_KEEPALIVE_SECONDS = 15
 
 
 @login_required()
@@ -10,10 +27,12 @@ def home(request):
     Controller for the app home page.
     """
     # dict = {'brand': "111", 'model': "222"}     # For testing
-    dict = GetAllRegions()
+    # dict = GetAllRegions()    # Calls the API on every page load - the cached copy is used instead.
+    dict = GetCachedRegions()
 
     context = {
-        'dict': dict
+        'dict': dict,
+        'deadlines': Run_Deadline_Choices
     }
 
     return render(request, 'servicecatalogurls/home.html', context)
@@ -28,26 +47,169 @@ def about(request):
     return render(request, 'servicecatalogurls/about.html', context)
 
 
+@login_required()
 def queryresult(request):
     """
     Controller for the QueryResult page.
+    The results of the latest scheduled check of the region (see Crawler.py and Snapshots.py) are shown right away.
+    A live check is only run when asked for (live=1), when the run is traced, or when there is no recent snapshot
+    (see Snapshots.MAX_SNAPSHOT_AGE): the check run is started as a background job and the browser is sent on to the
+    job's page (?job=<ID>), which shows the job's progress until it has finished, and then the results.
+    Adding trace=1 (or trace=cprofile, or trace=sample) traces (and profiles) the run - its trace, with the rendering of
+    the results page, is saved in the app workspace (see Tracing.py).
     """
-    regionID = request.GET['region_Picklist']
+    jobID = request.GET.get('job')
+    if jobID is None:
+        regionID = request.GET['region_Picklist']
+        trace = trace_mode(request.GET.get('trace'))
+        if not request.GET.get('live') and trace is None:
+            regionNames = dict((value, key) for key, value in GetCachedRegions().items())
+            snapshot = latest_snapshot(regionID, regionNames.get(regionID))
+            if snapshot is not None:
+                return render_snapshot(request, snapshot)
+
+        # Most seconds the run may take (blank = no limit).
+        runDeadline = request.GET.get('deadline_Picklist', '')
+        runDeadline = int(runDeadline) if runDeadline.isdigit() else None
+
+        # For debug/testing...
+        # time.sleep(2)
+        # errList, badCatalogList = QueryServiceCatalog_DummyTestReturn(regionID)    # For testing
+        job = start_job(regionID, run_deadline=runDeadline, trace=trace)
+        return redirect('{0}?job={1}'.format(reverse('servicecatalogurls:queryresult'), job.ID))
 
-    # For debug/testing...
-    # time.sleep(2)
-    # errList, badCatalogList = QueryServiceCatalog_DummyTestReturn(regionID)    # For testing
-    errList, badCatalogList = QueryServiceCatalog(regionID)
+    job = get_job(jobID)
+    if job is None:
+        raise Http404("No check job found with ID {0}.".format(jobID))
 
+    if job.State != JOB_FINISHED:
+        # Still running (or failed) - show the progress page, which polls queryprogress until the job is done.
+        return render(request, 'servicecatalogurls/queryprogress.html', {"job": job, "status": job.status()})
+
+    # (The job may have been started by another worker process - see CheckJobs.StoredJob.)
+    summary = job.summary()
     context = {
-        "errList": errList,
-        "badCatalogList": badCatalogList
+        "errList": job.ErrURLs,
+        "badCatalogList": job.ErrCatalogs,
+        "regionBreakdown": summary.get("regions"),
+        "hostBreakdown": summary.get("hosts")
     }
 
     # return render(request, 'servicecatalogurls/queryresult.html', {"errList": errList, "badCatalogList": badCatalogList})
-    return render(request, 'servicecatalogurls/queryresult.html', context)
+    with span(job.Tracer, "Render the results page", "render", entries=len(job.ErrURLs)):
+        response = render(request, 'servicecatalogurls/queryresult.html', context)
+    if job.Tracer is not None:
+        job.save_trace()
+    return response
 
 
 
     context = {}
     return render(request, 'servicecatalogurls/about.html', context)
+
+
+def render_snapshot(request, snapshot):
+    """
+    Renders the QueryResult page from a snapshot, with the time it was taken and a link to check the region live.
+    """
+    liveQuery = request.GET.copy()
+    liveQuery['live'] = '1'
+    context = {
+        "errList": snapshot.ErrURLs,
+        "badCatalogList": snapshot.ErrCatalogs,
+        "regionBreakdown": snapshot.Summary.get("regions"),
+        "hostBreakdown": snapshot.Summary.get("hosts"),
+        "snapshotTaken": time.strftime("%Y-%m-%d %H:%M", time.localtime(snapshot.Created)),
+        "snapshotAgeMinutes": int(snapshot.age() // 60),
+        "liveURL": "{0}?{1}".format(reverse('servicecatalogurls:queryresult'), liveQuery.urlencode())
+    }
+    return render(request, 'servicecatalogurls/queryresult.html', context)
+
+
+@login_required()
+def queryprogress(request):
+    """
+    Controller returning the progress of a background check job (?job=<ID>) as JSON.
+    """
+    job = get_job(request.GET.get('job', ''))
+    if job is None:
+        return JsonResponse({"error": "No check job found with that ID."}, status=404)
+
+    return JsonResponse(job.status())
+
+
+def sse_event(event, data, event_id=None):
+    # Formats one Server-Sent Event.
+    lines = "" if event_id is None else "id: {0}\n".format(event_id)
+    return lines + "event: {0}\ndata: {1}\n\n".format(event, json.dumps(data))
+
+
+def stream_job(job, start):
+    """
+    Generator of the Server-Sent Events for a background check job: an "entry" event for each invalid URL entry as
+    soon as it is found (starting after the first start ones), then a "catalog" event for each "INCORRECT CATALOG"
+    entry, and finally a "summary" event with the totals and run time.
+    """
+    sent = start
+    lastSent = time.time()
+    while True:
+        done = job.done()
+        for errEntry in job.entries_since(sent):
+            yield sse_event("entry", errEntry.as_dict(), sent)
+            sent += 1
+            lastSent = time.time()
+        if done:
+            break
+        if time.time() - lastSent >= STREAM_KEEPALIVE_SECONDS:
+            # A comment line keeps proxies from closing a quiet connection.
+            yield ": keep-alive\n\n"
+            lastSent = time.time()
+        time.sleep(STREAM_POLL_SECONDS)
+
+    for entry in job.catalog_entries():
+        yield sse_event("catalog", entry.as_dict())
+    summary = job.summary()
+    summary["state"] = job.State
+    summary["error"] = job.Error
+    yield sse_event("summary", summary)
+
+
+@login_required()
+def querystream(request):
+    """
+    Controller streaming the results of a background check job (?job=<ID>) as Server-Sent Events, so invalid URLs
+    show up on the page while the rest of the catalog is still being checked.  A reconnecting browser sends the
+    Last-Event-ID header and only gets the entries it has not seen yet.
+    """
+    job = get_job(request.GET.get('job', ''))
+    if job is None:
+        raise Http404("No check job found with that ID.")
+
+    lastEventID = request.META.get('HTTP_LAST_EVENT_ID', '')
+    start = int(lastEventID) + 1 if lastEventID.isdigit() else 0
+
+    response = StreamingHttpResponse(stream_job(job, start), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stops nginx from buffering the stream.
+    return response
+
+
+def metrics(request):
+    """
+    Controller serving the URL check metrics of every run of the app (by any of its processes - see MetricsStore.py),
+    in the Prometheus text format (see Metrics.py) - for a Prometheus server to scrape.
+    Only served to signed-in users, and to scrapers sending the app's metrics_token setting as a bearer token.
+    """
+    if not metrics_allowed(request):
+        return HttpResponse('Sign in, or send the metrics token as "Authorization: Bearer <token>".', status=403,
+                            content_type='text/plain')
+    return HttpResponse(metrics_store().registry().render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def metrics_allowed(request):
+    # True for a signed-in user, or a request with the metrics_token setting (if set) as its bearer token.
+    if request.user.is_authenticated:
+        return True
+    token = app.get_custom_setting('metrics_token')
+    scheme, _, sent = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return bool(token) and scheme.lower() == 'bearer' and hmac.compare_digest(sent.strip().encode(), token.encode())
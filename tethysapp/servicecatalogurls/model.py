@@ -1 +1,282 @@
-# Put your persistent store models in this file
+"""
+# Initial Creation:
+#   Run history - every finished check run and the invalid entries it found, kept across runs.
+# General Description:
+#   The results of a run used to be gone once its page was rendered (or its job dropped), so there was no telling
+#   which links broke since the last run and which ones were fixed - only the whole table again.  RunHistory keeps
+#   each finished run (see CheckJobs.CheckJob.record_history()) in a SQLite database in the app workspace, next to the
+#   URL status cache (see StatusCache.py), which every worker process and the headless crawler (see Crawler.py) share.
+#
+#   A run is kept with its scope - the region ID it was run for, ALL_REGIONS_SCOPE for "All" - and every run is only
+#   ever compared with the earlier runs of the same scope.  Its invalid URLs are kept as "url" findings (flagged down,
+#   or not down when the run's deadline left them NOT CHECKED) and its "INCORRECT CATALOG" entries as "catalog"
+#   findings.  URLs are compared by their canonical form (see URLIndex.py), as everywhere else in a run, so editing
+#   a link to another form of the same URL neither breaks nor fixes it.  The findings are indexed by run, canonical
+#   URL, service ID and region, and the runs by scope and run time, so
+#       newly_broken()  URLs down in a run that were not reported at all by the run before it
+#       fixed()         URLs down in the run before that are not reported at all by the run (fixed - or removed from
+#                       the catalog, either way they no longer break anything)
+#       down_streak()   URLs down in each of the last N runs (up to a given run)
+#   each only read the findings of the runs they compare, however long the history grows - as does history(), the
+#   latest findings of one URL or one service.  The newest HISTORY_MAX_RUNS runs of each scope are kept.
+#
+#   (Tethys persistent stores are PostgreSQL databases, and this app needs no database server for anything else - so
+#   the history is kept in SQLite, the way the status cache is.)
+"""
+import os
+
+from .CheckEngine import APP_WORKSPACE_PATH, DEADLINE_CODE
+from .ResultStore import InvalidEntry, ResultList, NO_DATA_STATUS
+from .StatusCache import connect, chunks
+from .URLIndex import canonical_url
+
+import logging
+Logfile = logging.getLogger(__name__)
+
+RunHistory_Path = os.path.join(APP_WORKSPACE_PATH, "run_history.sqlite3")
+
+# Runs kept for each scope (the older ones are deleted, findings and all, as new ones are recorded).
+HISTORY_MAX_RUNS = 200
+
+# Scope of the "All" runs (a region run's scope is its region ID).
+ALL_REGIONS_SCOPE = "all"
+
+# Kinds of findings.
+FINDING_URL = "url"
+FINDING_CATALOG = "catalog"
+
+# Columns of a finding read back as an InvalidEntry, in the order of the InvalidEntry arguments.
+ENTRY_COLUMNS = "status, region, service_area, title, service_id, section, section_entry, url"
+
+
+def run_scope(region_id):
+    return region_id or ALL_REGIONS_SCOPE
+
+
+class RunHistory(object):
+    """
+    # SQLite backed history of the check runs and their findings (see above).  The query methods take the scope's
+    # region ID ("" for "All") and, optionally, a region name to only look at the findings of one region (e.g. of an
+    # "All" run).  Run IDs default to the latest run of the scope.
+    """
+
+    def __init__(self, path=RunHistory_Path, max_runs=HISTORY_MAX_RUNS):
+        self.Path = path
+        self.MaxRuns = max_runs
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                             "  run_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                             "  scope TEXT NOT NULL,"
+                             "  started REAL,"
+                             "  finished REAL NOT NULL,"
+                             "  checked INTEGER,"
+                             "  down INTEGER,"
+                             "  not_checked INTEGER)")
+                conn.execute("CREATE INDEX IF NOT EXISTS runs_scope_finished ON runs (scope, finished)")
+                conn.execute("CREATE INDEX IF NOT EXISTS runs_finished ON runs (finished)")
+                conn.execute("CREATE TABLE IF NOT EXISTS findings ("
+                             "  run_id INTEGER NOT NULL,"
+                             "  kind TEXT NOT NULL,"
+                             "  down INTEGER NOT NULL,"
+                             "  status TEXT,"
+                             "  region TEXT,"
+                             "  service_area TEXT,"
+                             "  title TEXT,"
+                             "  service_id TEXT,"
+                             "  section TEXT,"
+                             "  section_entry TEXT,"
+                             "  url TEXT,"
+                             "  canonical TEXT)")
+                self._add_canonical(conn)
+                conn.execute("CREATE INDEX IF NOT EXISTS findings_run_canonical ON findings (run_id, kind, canonical)")
+                conn.execute("CREATE INDEX IF NOT EXISTS findings_canonical ON findings (canonical)")
+                conn.execute("CREATE INDEX IF NOT EXISTS findings_service ON findings (service_id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS findings_region ON findings (region, run_id)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return connect(self.Path)
+
+    def _add_canonical(self, conn):
+        # Adds the canonical column to a history saved before it was kept, filled in for the findings already there.
+        if "canonical" in [row[1] for row in conn.execute("PRAGMA table_info(findings)")]:
+            return
+        conn.execute("ALTER TABLE findings ADD COLUMN canonical TEXT")
+        conn.execute("DROP INDEX IF EXISTS findings_run_url")
+        conn.execute("DROP INDEX IF EXISTS findings_url")
+        rows = conn.execute("SELECT rowid, url FROM findings").fetchall()
+        conn.executemany("UPDATE findings SET canonical = ? WHERE rowid = ?",
+                         [(canonical_url(url or ""), rowid) for rowid, url in rows])
+
+    def record_run(self, region_id, started, finished, summary, err_urls, err_catalogs):
+        """
+        # Saves a finished run - its times, its summary totals (see CheckJobs.CheckJob.summary()) and the two lists
+        # returned by QueryServiceCatalog() - and returns its run ID.  Older runs of the scope are pruned.
+        """
+        rows = []
+        for kind, entries in ((FINDING_URL, err_urls or ()), (FINDING_CATALOG, err_catalogs or ())):
+            for entry in entries:
+                if entry.Status == NO_DATA_STATUS:
+                    continue
+                down = 0 if kind == FINDING_URL and entry.Status == DEADLINE_CODE else 1
+                rows.append((kind, down, str(entry.Status), entry.Region, entry.ServiceArea, entry.Title, entry.ID,
+                             entry.Section, entry.SectionEntry, entry.URL, canonical_url(entry.URL or "")))
+        scope = run_scope(region_id)
+        conn = self._connect()
+        try:
+            with conn:
+                runID = conn.execute("INSERT INTO runs (scope, started, finished, checked, down, not_checked) "
+                                     "VALUES (?, ?, ?, ?, ?, ?)",
+                                     (scope, started, finished, summary.get("checked"), summary.get("down"),
+                                      summary.get("not_checked"))).lastrowid
+                conn.executemany("INSERT INTO findings (run_id, kind, down, status, region, service_area, title, "
+                                 "service_id, section, section_entry, url, canonical) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [(runID,) + row for row in rows])
+                self._prune(conn, scope)
+        finally:
+            conn.close()
+        Logfile.info("Run {0} recorded in the run history ({1} findings).".format(runID, len(rows)))
+        return runID
+
+    def _prune(self, conn, scope):
+        # Deletes the runs of the scope older than its newest MaxRuns runs, along with their findings.
+        oldIDs = [row[0] for row in conn.execute("SELECT run_id FROM runs WHERE scope = ? ORDER BY finished DESC "
+                                                 "LIMIT -1 OFFSET ?", (scope, self.MaxRuns))]
+        for batch in chunks(oldIDs):
+            marks = ",".join("?" * len(batch))
+            conn.execute("DELETE FROM findings WHERE run_id IN ({0})".format(marks), batch)
+            conn.execute("DELETE FROM runs WHERE run_id IN ({0})".format(marks), batch)
+
+    def runs(self, region_id=None, limit=20):
+        """
+        # Returns the latest runs of the scope (of every scope, if region_id is None) as dictionaries, newest first.
+        """
+        conn = self._connect()
+        try:
+            if region_id is None:
+                return self._runs(conn, "", (), limit)
+            return self._runs(conn, "WHERE scope = ?", (run_scope(region_id),), limit)
+        finally:
+            conn.close()
+
+    def _runs(self, conn, where, params, limit):
+        rows = conn.execute("SELECT run_id, scope, started, finished, checked, down, not_checked FROM runs {0} "
+                            "ORDER BY finished DESC LIMIT ?".format(where), tuple(params) + (limit,))
+        return [{"run": run_id, "scope": scope, "started": started, "finished": finished, "checked": checked,
+                 "down": down, "not_checked": not_checked}
+                for run_id, scope, started, finished, checked, down, not_checked in rows]
+
+    def _run_and_previous(self, conn, region_id, run_id):
+        # The run compared (the scope's latest, if run_id is None) and the scope's run before it - either may be None.
+        scope = run_scope(region_id)
+        if run_id is None:
+            runs = self._runs(conn, "WHERE scope = ?", (scope,), 1)
+        else:
+            runs = self._runs(conn, "WHERE scope = ? AND run_id = ?", (scope, run_id), 1)
+        if not runs:
+            return None, None
+        previous = self._runs(conn, "WHERE scope = ? AND finished < ?", (scope, runs[0]["finished"]), 1)
+        return runs[0], previous[0] if previous else None
+
+    def _entries(self, conn, query, params):
+        # Runs a query selecting ENTRY_COLUMNS and returns its rows as a ResultList of InvalidEntry records.
+        entries = ResultList()
+        entries.extend(InvalidEntry(*row) for row in conn.execute(query, params))
+        return entries
+
+    def _compare(self, region_id, run_id, region, newer):
+        """
+        # The down URLs of one of two runs (the newer one if newer is True, otherwise the older one) that the other
+        # run does not report at all (in any form) - one entry per canonical URL (its first one), ordered as the
+        # results page orders them.
+        # Returns (run, previous run, entries).
+        """
+        conn = self._connect()
+        try:
+            run, previous = self._run_and_previous(conn, region_id, run_id)
+            if run is None or previous is None:
+                return run, previous, ResultList()
+            downRun, otherRun = (run, previous) if newer else (previous, run)
+            regionFilter = " AND region = ?" if region else ""
+            params = [downRun["run"], FINDING_URL] + ([region] if region else []) + [otherRun["run"], FINDING_URL]
+            entries = self._entries(
+                conn,
+                "SELECT {0} FROM findings f WHERE f.rowid IN ("
+                "  SELECT MIN(rowid) FROM findings WHERE run_id = ? AND kind = ? AND down = 1{1} GROUP BY canonical) "
+                "AND NOT EXISTS (SELECT 1 FROM findings o WHERE o.run_id = ? AND o.kind = ? "
+                "                AND o.canonical = f.canonical) "
+                "ORDER BY f.rowid".format(ENTRY_COLUMNS, regionFilter), params)
+            return run, previous, entries
+        finally:
+            conn.close()
+
+    def newly_broken(self, region_id, run_id=None, region=None):
+        """
+        # Returns (run, previous run, entries): the URLs down in the run that the scope's run before it did not report
+        # at all.  Nothing is newly broken in the first run of a scope (there is nothing to compare it with).
+        """
+        return self._compare(region_id, run_id, region, True)
+
+    def fixed(self, region_id, run_id=None, region=None):
+        """
+        # Returns (run, previous run, entries): the URLs down in the scope's run before the run that the run does not
+        # report at all - not as down, and not as NOT CHECKED either (so a run cut short by its deadline does not
+        # count the URLs it never got to as fixed).
+        """
+        return self._compare(region_id, run_id, region, False)
+
+    def down_streak(self, region_id, runs, region=None, run_id=None):
+        """
+        # Returns (run IDs, entries): the URLs down in each of the scope's last runs, up to the run (the latest, if
+        # run_id is None) - one entry per canonical URL, from that run.  No URLs are returned while the scope has
+        # fewer runs than that.
+        """
+        scope = run_scope(region_id)
+        conn = self._connect()
+        try:
+            if run_id is None:
+                window = self._runs(conn, "WHERE scope = ?", (scope,), runs)
+            else:
+                window = self._runs(conn, "WHERE scope = ? AND finished <= (SELECT finished FROM runs WHERE run_id = ? "
+                                    "AND scope = ?)", (scope, run_id, scope), runs)
+            runIDs = [run["run"] for run in window]
+            if runs < 1 or len(runIDs) < runs:
+                return runIDs, ResultList()
+            regionFilter = " AND region = ?" if region else ""
+            regionParams = [region] if region else []
+            params = ([runIDs[0], FINDING_URL] + regionParams + [FINDING_URL] + runIDs + regionParams + [runs])
+            entries = self._entries(
+                conn,
+                "SELECT {0} FROM findings WHERE rowid IN ("
+                "  SELECT MIN(rowid) FROM findings WHERE run_id = ? AND kind = ? AND down = 1{1} AND canonical IN ("
+                "    SELECT canonical FROM findings WHERE kind = ? AND down = 1 AND run_id IN ({2}){1} "
+                "    GROUP BY canonical HAVING COUNT(DISTINCT run_id) = ?) "
+                "  GROUP BY canonical) "
+                "ORDER BY rowid".format(ENTRY_COLUMNS, regionFilter, ",".join("?" * len(runIDs))), params)
+            return runIDs, entries
+        finally:
+            conn.close()
+
+    def history(self, url=None, service_id=None, limit=20):
+        """
+        # Returns the latest findings of the URL (in any of its forms) or of every URL of the service, in every scope,
+        # newest first, as dictionaries of the run (ID, scope, time finished) and the finding (kind, status, down,
+        # service ID, URL as it was written).
+        """
+        if url is None and service_id is None:
+            raise ValueError("A URL or a service ID is needed.")
+        column, value = ("f.canonical", canonical_url(url)) if url is not None else ("f.service_id", service_id)
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT r.run_id, r.scope, r.finished, f.kind, f.status, f.down, f.service_id, f.url "
+                                "FROM findings f JOIN runs r ON r.run_id = f.run_id WHERE {0} = ? "
+                                "ORDER BY r.finished DESC, f.rowid LIMIT ?".format(column), (value, limit))
+            return [{"run": run_id, "scope": scope, "finished": finished, "kind": kind, "status": status,
+                     "down": bool(down), "service": service, "url": findingURL}
+                    for run_id, scope, finished, kind, status, down, service, findingURL in rows]
+        finally:
+            conn.close()